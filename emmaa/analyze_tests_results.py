@@ -1,12 +1,20 @@
+import os
+import sys
 import json
 import logging
 import jsonpickle
 import datetime
-from collections import defaultdict
-from emmaa.util import (find_latest_s3_file, find_second_latest_s3_file,
-                        find_latest_s3_files, find_number_of_files_on_s3,
-                        make_date_str, get_s3_client)
-from indra.statements.statements import Statement
+import multiprocessing
+import numpy as np
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    as_completed
+from botocore.exceptions import ClientError
+from emmaa.util import (find_latest_s3_file, find_latest_s3_files,
+                        find_number_of_files_on_s3, make_date_str,
+                        get_s3_client, sort_s3_files_by_date, strip_out_date,
+                        fetch_s3_objects)
+from indra.statements.statements import Statement, get_statement_by_name
 from indra.assemblers.english.assembler import EnglishAssembler
 from indra.sources.indra_db_rest.api import get_statement_queries
 
@@ -14,6 +22,17 @@ from indra.sources.indra_db_rest.api import get_statement_queries
 logger = logging.getLogger(__name__)
 
 
+# The number of threads loading and saving stats and the number of processes
+# computing them in generate_stats_for_models can be set in the environment.
+STATS_IO_WORKERS = int(os.environ.get('EMMAA_STATS_IO_WORKERS', 8))
+STATS_PROCESSES = int(os.environ.get('EMMAA_STATS_PROCESSES',
+                                     os.cpu_count() or 1))
+# The number of times update_test_history_on_s3 reads and updates the test
+# history index again when it was changed by another process.
+TEST_HISTORY_MAX_ATTEMPTS = int(
+    os.environ.get('EMMAA_TEST_HISTORY_MAX_ATTEMPTS', 5))
+
+
 CONTENT_TYPE_FUNCTION_MAPPING = {
     'statements': 'get_stmt_hashes',
     'applied_tests': 'get_applied_test_hashes',
@@ -24,6 +43,13 @@ CONTENT_TYPE_FUNCTION_MAPPING = {
 class TestRound(object):
     """Analyzes the results of one test round.
 
+    The test results are kept in their JSON form and statements, tests and
+    model checker results are only deserialized when a method needs them.
+    Statement and test hashes (stored by
+    emmaa.model_tests.ModelManager.results_to_json), statement types,
+    evidence counts and test results in Pass/Fail form are read directly
+    from the JSON.
+
     Parameters
     ----------
     json_results : list[dict]
@@ -34,6 +60,8 @@ class TestRound(object):
 
     Attributes
     ----------
+    mc_types : list[str]
+        A list of the types of ModelCheckers the tests were run with.
     statements : list[indra.statements.Statement]
         A list of INDRA Statements used to assemble a model.
     mc_types_results : dict
@@ -41,6 +69,9 @@ class TestRound(object):
         results generated by this ModelChecker
     tests : list[indra.statements.Statement]
         A list of INDRA Statements used to make EMMAA tests.
+    english_test_results : dict
+        A dictionary mapping a test hash to its English description and its
+        results for each mc_type (see _get_applied_tests_results).
     function_mapping : dict
         A dictionary of strings mapping a type of content to a tuple of
         functions necessary to find delta for this type of content. First
@@ -50,15 +81,16 @@ class TestRound(object):
     """
     def __init__(self, json_results):
         self.json_results = json_results
-        self.statements = self._get_statements()
-        mc_types = self.json_results[0].get('mc_types', ['pysb'])
-        self.mc_types_results = {}
-        for mc_type in mc_types:
-            self.mc_types_results[mc_type] = self._get_results(mc_type)
+        self.mc_types = self.json_results[0].get('mc_types', ['pysb'])
         self.make_links = self.json_results[0].get('make_links', True)
-        self.tests = self._get_tests()
         self.function_mapping = CONTENT_TYPE_FUNCTION_MAPPING
-        self.english_test_results = self._get_applied_tests_results()
+        self._statements = None
+        self._stmt_hashes = None
+        self._tests = None
+        self._test_hashes = None
+        self._mc_types_results = {}
+        self._english_test_results = None
+        self._stmt_table = None
 
     @classmethod
     def load_from_s3_key(cls, key):
@@ -69,53 +101,109 @@ class TestRound(object):
         test_round = TestRound(json_results)
         return test_round
 
+    @property
+    def statements(self):
+        if self._statements is None:
+            self._statements = self._get_statements()
+        return self._statements
+
+    @property
+    def tests(self):
+        if self._tests is None:
+            self._tests = self._get_tests()
+        return self._tests
+
+    @property
+    def mc_types_results(self):
+        for mc_type in self.mc_types:
+            self._get_mc_type_results(mc_type)
+        return self._mc_types_results
+
+    @property
+    def english_test_results(self):
+        if self._english_test_results is None:
+            self._english_test_results = self._get_applied_tests_results()
+        return self._english_test_results
+
     # Model Summary Methods
     def get_total_statements(self):
         """Return a total number of statements in a model."""
-        total = len(self.statements)
+        total = len(self.json_results[0]['statements'])
         logger.info(f'An assembled model has {total} statements.')
         return total
 
     def get_stmt_hashes(self):
         """Return a list of hashes for all statements in a model."""
-        return [str(stmt.get_hash(refresh=True)) for stmt in self.statements]
+        if self._stmt_hashes is None:
+            self._stmt_hashes = self._get_hashes(
+                self.json_results[0]['statements'], lambda: self.statements)
+        return self._stmt_hashes
 
-    def get_statement_types(self):
+    def get_statement_types(self, top=None):
         """Return a sorted list of tuples containing a statement type and a
         number of times a statement of this type occured in a model.
+
+        Only the top most frequent types are returned if top is given.
         """
-        statement_types = defaultdict(int)
         logger.info('Finding a distribution of statements types.')
-        for stmt in self.statements:
-            statement_types[type(stmt).__name__] += 1
-        return sorted(statement_types.items(), key=lambda x: x[1], reverse=True)
+        return _count_sorted(self.get_stmt_table()['type'], top)
 
-    def get_agent_distribution(self):
+    def get_agent_distribution(self, top=None):
         """Return a sorted list of tuples containing an agent name and a number
-        of times this agent occured in statements of a model."""
+        of times this agent occured in statements of a model.
+
+        Only the top most frequent agents are returned if top is given.
+        """
         logger.info('Finding agent distribution among model statements.')
-        agent_count = defaultdict(int)
-        for stmt in self.statements:
-            for agent in stmt.agent_list():
-                if agent is not None:
-                    agent_count[agent.name] += 1
-        return sorted(agent_count.items(), key=lambda x: x[1], reverse=True)
-
-    def get_statements_by_evidence(self):
+        return _count_sorted(self.get_stmt_table()['agent'], top)
+
+    def get_statements_by_evidence(self, top=None):
         """Return a sorted list of tuples containing a statement hash and a
-        number of times this statement occured in a model."""
-        stmts_evidence = {}
-        for stmt in self.statements:
-            stmts_evidence[str(stmt.get_hash(refresh=True))] = len(stmt.evidence)
+        number of times this statement occured in a model.
+
+        Only the top statements with most evidence are returned if top is
+        given.
+        """
+        table = self.get_stmt_table()
+        # Statements with the same hash are counted once
+        stmts_evidence = dict(zip(table['hash'], table['evidence'].tolist()))
         logger.info('Sorting statements by evidence count.')
-        return sorted(stmts_evidence.items(), key=lambda x: x[1], reverse=True)
+        return _sort_by_count(list(stmts_evidence.keys()),
+                              list(stmts_evidence.values()), top)
+
+    def get_stmt_table(self):
+        """Return a columnar table of the statements in a model.
+
+        The table is built once from the statement JSON.
+
+        Returns
+        -------
+        table : dict
+            A dictionary with the statement hashes ('hash'), numpy arrays of
+            the statement types ('type') and evidence counts ('evidence') in
+            the order of statements, and a numpy array of the names of all
+            agents in the statements ('agent').
+        """
+        if self._stmt_table is None:
+            stmts_json = self.json_results[0]['statements']
+            agent_names = []
+            for stmt_json in stmts_json:
+                agent_names += _get_agent_names(stmt_json)
+            self._stmt_table = {
+                'hash': self.get_stmt_hashes(),
+                'type': np.array([stmt_json['type']
+                                  for stmt_json in stmts_json], dtype=str),
+                'evidence': np.array([len(stmt_json.get('evidence', []))
+                                      for stmt_json in stmts_json],
+                                     dtype=int),
+                'agent': np.array(agent_names, dtype=str)}
+        return self._stmt_table
 
     def get_english_statements_by_hash(self):
         """Return a dictionary mapping a statement and its English description."""
         stmts_by_hash = {}
-        for stmt in self.statements:
-            stmts_by_hash[str(stmt.get_hash(refresh=True))] = (
-                self.get_english_statement(stmt))
+        for stmt_hash, stmt in zip(self.get_stmt_hashes(), self.statements):
+            stmts_by_hash[stmt_hash] = self.get_english_statement(stmt)
         return stmts_by_hash
 
     def get_english_statement(self, stmt):
@@ -129,17 +217,18 @@ class TestRound(object):
 
     # Test Summary Methods
     def get_applied_test_hashes(self):
-        """Return a list of hashes for all applied tests."""
-        return list(self.english_test_results.keys())
+        """Return a list of unique hashes for all applied tests."""
+        return list(dict.fromkeys(self._get_test_hashes()))
 
     def get_passed_test_hashes(self, mc_type='pysb'):
-        """Return a list of hashes for passed tests."""
-        return [test_hash for test_hash in self.english_test_results.keys() if
-                self.english_test_results[test_hash][mc_type][0] == 'Pass']
+        """Return a list of unique hashes for passed tests."""
+        return [test_hash for test_hash, pass_fail in
+                self._get_pass_fail_by_hash(mc_type).items()
+                if pass_fail == 'Pass']
 
     def get_total_applied_tests(self):
         """Return a number of all applied tests."""
-        total = len(self.tests)
+        total = len(self.json_results) - 1
         logger.info(f'{total} tests were applied.')
         return total
 
@@ -159,59 +248,43 @@ class TestRound(object):
         was found or a result code if it was not."""
         tests_by_hash = {}
         logger.info('Retrieving test hashes, english tests and test results.')
-
-        def get_pass_fail(res):
-            # Here use result.path_found because we care if the path was found
-            # and do not care about path length
-            if res.path_found:
-                return 'Pass'
-            else:
-                return 'Fail'
-
-        for ix, test in enumerate(self.tests):
-            test_hash = str(test.get_hash(refresh=True))
+        test_hashes = self._get_test_hashes()
+        for test_hash, test in zip(test_hashes, self.tests):
             tests_by_hash[test_hash] = {
                 'test': self.get_english_statement(test)}
-            for mc_type in self.mc_types_results:
-                result = self.mc_types_results[mc_type][ix]
+        for mc_type in self.mc_types:
+            paths = self.get_path_descriptions(mc_type)
+            codes = self.get_english_codes(mc_type)
+            for test_hash, pass_fail in zip(test_hashes,
+                                            self._get_pass_fail(mc_type)):
+                # If we have a path description use it, otherwise use code
                 tests_by_hash[test_hash][mc_type] = [
-                        get_pass_fail(result),
-                        self.get_path_or_code_by_hash(test_hash, mc_type)]
+                    pass_fail, paths.get(test_hash, codes[test_hash])]
         return tests_by_hash
 
     def get_path_descriptions(self, mc_type='pysb'):
         paths_by_test = {}
-        results = self.mc_types_results[mc_type]
-        for ix, result in enumerate(results):
-            if result.paths:
-                try:
-                    paths = self.json_results[ix+1][mc_type]['path_json']
-                except KeyError:
-                    paths = []
-                paths_by_test[str(self.tests[ix].get_hash(refresh=True))] = paths
+        for ix, test_hash in enumerate(self._get_test_hashes()):
+            if self._get_result_attr(ix, mc_type, 'paths'):
+                paths = self.json_results[ix+1][mc_type].get('path_json', [])
+                paths_by_test[test_hash] = paths
         return paths_by_test
 
     def get_english_codes(self, mc_type):
         english_codes = {}
-        results = self.mc_types_results[mc_type]
-        for ix, result in enumerate(results):
+        for ix, test_hash in enumerate(self._get_test_hashes()):
             try:
                 code = self.json_results[ix+1][mc_type]['result_code']
             except KeyError:
-                code = result.result_code
-            english_codes[str(self.tests[ix].get_hash(refresh=True))] = code
+                code = self._get_result_attr(ix, mc_type, 'result_code')
+            english_codes[test_hash] = code
         return english_codes
 
     def get_pass_fail_by_hash(self, test_hash, mc_type='pysb'):
         return self.english_test_results[test_hash][mc_type][0]
 
     def get_path_or_code_by_hash(self, test_hash, mc_type='pysb'):
-        # If we have a path description return it, otherwise return code
-        try:
-            result = self.get_path_descriptions(mc_type)[test_hash]
-        except KeyError:
-            result = self.get_english_codes(mc_type)[test_hash]
-        return result
+        return self.english_test_results[test_hash][mc_type][1]
 
     # Methods to find delta
     def find_numeric_delta(self, other_round, one_round_numeric_func,
@@ -280,8 +353,10 @@ class TestRound(object):
             other_round.function_mapping[content_type])(**kwargs)
         logger.info(f'Found {len(previous_hashes)} hashes in other round.')
         # Find hashes unique for each of the rounds - this is delta
-        added_hashes = list(set(latest_hashes) - set(previous_hashes))
-        removed_hashes = list(set(previous_hashes) - set(latest_hashes))
+        latest_hashes = set(latest_hashes)
+        previous_hashes = set(previous_hashes)
+        added_hashes = list(latest_hashes - previous_hashes)
+        removed_hashes = list(previous_hashes - latest_hashes)
         hashes = {'added': added_hashes, 'removed': removed_hashes}
         return hashes
 
@@ -301,6 +376,52 @@ class TestRound(object):
                  for res in self.json_results[1:]]
         return tests
 
+    def _get_mc_type_results(self, mc_type):
+        if mc_type not in self._mc_types_results:
+            self._mc_types_results[mc_type] = self._get_results(mc_type)
+        return self._mc_types_results[mc_type]
+
+    def _get_result_attr(self, ix, mc_type, attr):
+        # Read an attribute of the result of a test from its flattened JSON
+        # and only unpickle the results of this mc_type if it is not there
+        result_json = self.json_results[ix+1][mc_type]['result_json']
+        if attr in result_json:
+            return result_json[attr]
+        return getattr(self._get_mc_type_results(mc_type)[ix], attr)
+
+    def _get_pass_fail(self, mc_type):
+        # Here use result.path_found because we care if the path was found
+        # and do not care about path length
+        return ['Pass' if self._get_result_attr(ix, mc_type, 'path_found')
+                else 'Fail' for ix in range(len(self.json_results) - 1)]
+
+    def _get_test_hashes(self):
+        # Return the hashes of the tests in the order of the results, the
+        # same test can be applied more than once
+        if self._test_hashes is None:
+            if all('test_hash' in res for res in self.json_results[1:]):
+                self._test_hashes = [res['test_hash']
+                                     for res in self.json_results[1:]]
+            else:
+                self._test_hashes = self._get_hashes(
+                    [res['test_json'] for res in self.json_results[1:]],
+                    lambda: self.tests)
+        return self._test_hashes
+
+    def _get_pass_fail_by_hash(self, mc_type):
+        # Map each unique test hash to its result in Pass/Fail form, the
+        # last result of a test applied more than once is used as in
+        # english_test_results
+        return dict(zip(self._get_test_hashes(), self._get_pass_fail(mc_type)))
+
+    @staticmethod
+    def _get_hashes(stmt_jsons, get_stmts):
+        # Statement JSONs store their hash, only statements serialized without
+        # one have to be deserialized to get it
+        if all('matches_hash' in stmt_json for stmt_json in stmt_jsons):
+            return [str(stmt_json['matches_hash']) for stmt_json in stmt_jsons]
+        return [str(stmt.get_hash(refresh=True)) for stmt in get_stmts()]
+
 
 class StatsGenerator(object):
     """Generates statistic for a given test round.
@@ -316,31 +437,54 @@ class StatsGenerator(object):
         A different instance of a TestRound to find delta between two rounds.
         If not given, will be generated by loading test results from s3.
 
+    previous_json_stats : dict
+        A JSON-formatted dictionary containing test model and test
+        statistics for previous test round. It is only used to get earlier
+        changes over time if previous_changes are not given and the model
+        does not have a changes over time log yet.
+    previous_changes : list[dict]
+        A list of rows of the changes over time log for earlier test rounds
+        (see load_changes_over_time). If not given, will be loaded from s3.
+    latest_round_date : Optional[str]
+        The date of the latest round, i.e. the date in the key of its test
+        results on s3. Rounds are logged and saved by this date, so
+        generating the statistics of a round again replaces them instead of
+        adding another round. If not given, the date of a latest round
+        loaded from s3 or the current date is used.
+    load_missing : Optional[bool]
+        If True, the rounds and changes over time that are not given are
+        loaded from s3. If False, they are treated as not existing, e.g.
+        when they were already looked up on s3. Default: True
+
     Attributes
     ----------
     json_stats : dict
         A JSON-formatted dictionary containing test model and test statistics.
-    previous_json_stats : list[dict]
-        A JSON-formatted dictionary containing test model and test
-        statistics for previous test round.
+        Its changes_over_time only contain the latest test round.
+    previous_changes : list[dict]
+        A list of rows of the changes over time log for earlier test rounds.
+    changes_row : dict
+        A row of the changes over time log for the latest test round.
     """
 
     def __init__(self, model_name, latest_round=None, previous_round=None,
-                 previous_json_stats=None):
+                 previous_json_stats=None, previous_changes=None,
+                 latest_round_date=None, load_missing=True):
         self.model_name = model_name
-        if not latest_round:
-            self.latest_round = self._get_latest_round()
-        else:
-            self.latest_round = latest_round
-        if not previous_round:
-            self.previous_round = self._get_previous_round()
-        else:
-            self.previous_round = previous_round
+        self.latest_round = latest_round
+        self.latest_round_date = latest_round_date
+        self.previous_round = previous_round
         self.json_stats = {}
-        if not previous_json_stats:
-            self.previous_json_stats = self._get_previous_json_stats()
-        else:
-            self.previous_json_stats = previous_json_stats
+        self.previous_json_stats = previous_json_stats
+        self.previous_changes = previous_changes
+        if previous_changes is None and previous_json_stats:
+            self.previous_changes = changes_over_time_to_rows(
+                previous_json_stats.get('changes_over_time'))
+        if load_missing:
+            self._load_missing_inputs()
+        elif self.previous_changes is None:
+            self.previous_changes = []
+        self.changes_row = None
 
     def make_stats(self):
         """Check if two latest test rounds were found and add statistics to
@@ -376,7 +520,7 @@ class StatsGenerator(object):
         self.json_stats['test_round_summary'] = {
             'number_applied_tests': self.latest_round.get_total_applied_tests(),
             'all_test_results': self.latest_round.english_test_results}
-        for mc_type in self.latest_round.mc_types_results:
+        for mc_type in self.latest_round.mc_types:
             self.json_stats['test_round_summary'][mc_type] = {
                 'number_passed_tests': (
                     self.latest_round.get_number_passed_tests(mc_type)),
@@ -404,9 +548,9 @@ class StatsGenerator(object):
                 'applied_hashes_delta': self.latest_round.find_delta_hashes(
                     self.previous_round, 'applied_tests')}
 
-        for mc_type in self.latest_round.mc_types_results:
+        for mc_type in self.latest_round.mc_types:
             if not self.previous_round or mc_type not in \
-                    self.previous_round.mc_types_results:
+                    self.previous_round.mc_types:
                 tests_delta[mc_type] = {
                     'passed_hashes_delta': {'added': [], 'removed': []}}
             else:
@@ -416,98 +560,674 @@ class StatsGenerator(object):
         self.json_stats['tests_delta'] = tests_delta
 
     def make_changes_over_time(self):
-        """Add changes to model and tests over time to json_stats."""
+        """Add changes to model and tests in the latest round to json_stats.
+
+        Only the latest round is added to json_stats, earlier rounds are kept
+        in the changes over time log which is updated in save_to_s3.
+        """
         logger.info(f'Comparing changes over time for {self.model_name}.')
-        self.json_stats['changes_over_time'] = {
-            'number_of_statements': self.get_over_time(
-                'model_summary', 'number_of_statements'),
-            'number_applied_tests': self.get_over_time(
-                'test_round_summary', 'number_applied_tests'),
-            'dates': self.get_dates()}
-        for mc_type in self.latest_round.mc_types_results:
-            self.json_stats['changes_over_time'][mc_type] = {
-                'number_passed_tests': self.get_over_time(
-                    'test_round_summary', 'number_passed_tests', mc_type),
-                'passed_ratio': self.get_over_time(
-                    'test_round_summary', 'passed_ratio', mc_type)}
-
-    def get_over_time(self, section, metrics, mc_type='pysb'):
-        logger.info(f'Getting changes over time in {metrics} '
-                    f'for {self.model_name}.')
-        # Not mc_type relevant data
-        if metrics == 'number_of_statements' or \
-                metrics == 'number_applied_tests':
-            # First available stats
-            if not self.previous_json_stats:
-                previous_data = []
+        test_summary = self.json_stats['test_round_summary']
+        self.changes_row = {
+            'date': self.latest_round_date or make_date_str(),
+            'number_of_statements': (
+                self.json_stats['model_summary']['number_of_statements']),
+            'number_applied_tests': test_summary['number_applied_tests']}
+        for mc_type in self.latest_round.mc_types:
+            self.changes_row[mc_type] = {
+                'number_passed_tests': (
+                    test_summary[mc_type]['number_passed_tests']),
+                'passed_ratio': test_summary[mc_type]['passed_ratio']}
+        self.json_stats['changes_over_time'] = rows_to_changes_over_time(
+            [self.changes_row])
+
+    def get_changes_over_time(self):
+        """Return changes over time in all rounds including the latest one."""
+        rows = list(self.previous_changes)
+        if self.changes_row:
+            rows = _add_changes_row(rows, self.changes_row)
+        return rows_to_changes_over_time(rows)
+
+    def save_to_s3(self):
+        changes = _add_changes_row(self.previous_changes, self.changes_row) \
+            if self.changes_row else None
+        save_stats_to_s3(self.model_name, self.json_stats, changes,
+                         self.latest_round_date)
+
+    def _load_missing_inputs(self):
+        # Rounds and changes that were not passed in are loaded from s3
+        # together, so they take about as long as the slowest of them
+        load_latest = not self.latest_round
+        load_previous = not self.previous_round
+        load_changes = self.previous_changes is None
+        if not (load_latest or load_previous or load_changes):
+            return
+        inputs = _load_round_inputs(self.model_name, load_latest,
+                                    load_previous, load_changes)
+        if load_latest:
+            if inputs['latest_results'] is None:
+                logger.info(f'Could not find a key to the latest test '
+                            f'results for {self.model_name} model.')
+                self.latest_round = None
             else:
-                previous_data = (
-                    self.previous_json_stats['changes_over_time'][metrics])
-            previous_data.append(self.json_stats[section][metrics])
-        # Mc_type relevant data
-        else:
-            # First available stats
-            if not self.previous_json_stats:
-                previous_data = []
+                self.latest_round = TestRound(inputs['latest_results'])
+                if not self.latest_round_date:
+                    self.latest_round_date = inputs['latest_date']
+        if load_previous:
+            if inputs['previous_results'] is None:
+                logger.info(f'Could not find a key to the previous test '
+                            f'results for {self.model_name} model.')
+                self.previous_round = None
             else:
-                # This mc_type wasn't available in previous stats
-                if mc_type not in \
-                        self.previous_json_stats['changes_over_time']:
-                    previous_data = []
-                else:
-                    previous_data = (
-                        self.previous_json_stats[
-                            'changes_over_time'][mc_type][metrics])
-            previous_data.append(self.json_stats[section][mc_type][metrics])
-        return previous_data
-
-    def get_dates(self):
-        if not self.previous_json_stats:
-            previous_dates = []
-        else:
-            previous_dates = (
-                self.previous_json_stats['changes_over_time']['dates'])
-        previous_dates.append(make_date_str())
-        return previous_dates
+                self.previous_round = TestRound(inputs['previous_results'])
+        if load_changes:
+            self.previous_changes = inputs['previous_changes']
 
-    def save_to_s3(self):
-        json_stats_str = json.dumps(self.json_stats, indent=1)
-        client = get_s3_client(unsigned=False)
-        date_str = make_date_str()
-        stats_key = f'stats/{self.model_name}/stats_{date_str}.json'
-        logger.info(f'Uploading test round statistics to {stats_key}')
-        client.put_object(Bucket='emmaa', Key=stats_key,
-                          Body=json_stats_str.encode('utf8'))
-
-    def _get_latest_round(self):
+
+def get_model_names():
+    """Return the names of all models in the emmaa bucket."""
+    client = get_s3_client()
+    paginator = client.get_paginator('list_objects_v2')
+    model_names = []
+    for page in paginator.paginate(Bucket='emmaa', Prefix='models/',
+                                   Delimiter='/'):
+        for prefix in page.get('CommonPrefixes', []):
+            model_names.append(prefix['Prefix'].split('/')[1])
+    return model_names
+
+
+def load_stats_inputs(model_name):
+    """Load everything needed to generate statistics for a model from s3.
+
+    The latest and previous test results are found with a single listing of
+    the model's results and are downloaded at the same time as the changes
+    over time log (see emmaa.util.fetch_s3_objects).
+
+    Parameters
+    ----------
+    model_name : str
+        A name of a model.
+
+    Returns
+    -------
+    inputs : dict or None
+        A dictionary with the model_name, the latest_results and
+        previous_results in JSON format, the latest_date of the latest
+        results and the previous_changes over time (see
+        make_stats_from_inputs) or None if the model has no results.
+    """
+    inputs = _load_round_inputs(model_name)
+    if inputs['latest_results'] is None:
+        logger.info(f'Could not find test results for {model_name} model.')
+        return None
+    return inputs
+
+
+def _load_round_inputs(model_name, latest=True, previous=True, changes=True):
+    # The results are found with one listing and the needed results and the
+    # changes over time log are downloaded at the same time
+    latest_key = previous_key = changes_key = None
+    if latest or previous:
+        files = sort_s3_files_by_date(
+            'emmaa', f'results/{model_name}/results_', extension='.json')
+        if latest and files:
+            latest_key = files[0]['Key']
+        if previous and len(files) > 1:
+            previous_key = files[1]['Key']
+    if changes:
+        changes_key = _get_changes_over_time_key(model_name)
+    latest_body, previous_body, changes_body = fetch_s3_objects(
+        [latest_key, previous_key, changes_key])
+    inputs = {'model_name': model_name,
+              'latest_results': (json.loads(latest_body.decode('utf8'))
+                                 if latest_body else None),
+              'latest_date': (strip_out_date(latest_key)
+                              if latest_body else None),
+              'previous_results': (json.loads(previous_body.decode('utf8'))
+                                   if previous_body else None),
+              'previous_changes': None}
+    if changes:
+        inputs['previous_changes'] = (
+            _parse_changes_over_time(changes_body) if changes_body is not None
+            else _load_changes_from_stats(model_name))
+    return inputs
+
+
+def make_stats_from_inputs(inputs):
+    """Generate statistics for a model from loaded inputs.
+
+    This does not access s3, so it can be run in a separate process.
+
+    Parameters
+    ----------
+    inputs : dict
+        A dictionary returned by load_stats_inputs.
+
+    Returns
+    -------
+    json_stats : dict
+        A JSON-formatted dictionary containing test model and test statistics.
+    changes : list[dict]
+        The rows of the changes over time log including the latest round.
+    """
+    previous_results = inputs.get('previous_results')
+    sg = StatsGenerator(
+        inputs['model_name'],
+        latest_round=TestRound(inputs['latest_results']),
+        previous_round=(TestRound(previous_results)
+                        if previous_results else None),
+        previous_changes=inputs['previous_changes'],
+        latest_round_date=inputs.get('latest_date'), load_missing=False)
+    sg.make_stats()
+    return sg.json_stats, _add_changes_row(sg.previous_changes,
+                                           sg.changes_row)
+
+
+def save_stats_to_s3(model_name, json_stats, changes=None, date_str=None):
+    """Upload statistics of a model and its changes over time log to s3.
+
+    Parameters
+    ----------
+    model_name : str
+        A name of a model.
+    json_stats : dict
+        A JSON-formatted dictionary containing test model and test
+        statistics.
+    changes : Optional[list[dict]]
+        The rows of the changes over time log including the latest round.
+        If given, they replace the log on s3.
+    date_str : Optional[str]
+        The date of the test round the statistics are for. If statistics
+        were already saved for this round (i.e., the latest statistics on
+        s3 are from this date or later), they are overwritten so that
+        generating statistics again does not add another round. If not
+        given, the statistics are saved as a new round at the current date.
+    """
+    json_stats_str = json.dumps(json_stats, indent=1)
+    client = get_s3_client(unsigned=False)
+    stats_key = None
+    if date_str:
         latest_key = find_latest_s3_file(
-            'emmaa', f'results/{self.model_name}/results_', extension='.json')
-        if latest_key is None:
-            logger.info(f'Could not find a key to the latest test results '
-                        f'for {self.model_name} model.')
-            return
-        tr = TestRound.load_from_s3_key(latest_key)
-        return tr
-
-    def _get_previous_round(self):
-        previous_key = find_second_latest_s3_file(
-            'emmaa', f'results/{self.model_name}/results_', extension='.json')
-        if previous_key is None:
-            logger.info(f'Could not find a key to the previous test results '
-                        f'for {self.model_name} model.')
-            return
-        tr = TestRound.load_from_s3_key(previous_key)
-        return tr
-
-    def _get_previous_json_stats(self):
-        key = find_latest_s3_file(
-            'emmaa', f'stats/{self.model_name}/stats_', extension='.json')
-        if key is None:
-            logger.info(f'Could not find a key to the previous statistics '
-                        f'for {self.model_name} model.')
-            return
-        client = get_s3_client()
-        logger.info(f'Loading earlier statistics from {key}')
+            'emmaa', f'stats/{model_name}/stats_', extension='.json')
+        if latest_key and strip_out_date(latest_key) >= date_str:
+            stats_key = latest_key
+    if stats_key is None:
+        date_str = date_str if date_str else make_date_str()
+        stats_key = f'stats/{model_name}/stats_{date_str}.json'
+    logger.info(f'Uploading test round statistics to {stats_key}')
+    client.put_object(Bucket='emmaa', Key=stats_key,
+                      Body=json_stats_str.encode('utf8'))
+    if changes:
+        save_changes_over_time(model_name, changes, client=client)
+
+
+def generate_stats_for_models(model_names=None, upload=True,
+                              io_workers=STATS_IO_WORKERS,
+                              processes=STATS_PROCESSES):
+    """Generate statistics for several models in one batch.
+
+    The inputs of all models are loaded from s3 by a pool of threads. The
+    statistics of each model are computed in a pool of processes as soon as
+    its inputs are loaded and uploaded by the pool of threads as soon as they
+    are computed. A failure for one model is logged and does not stop the
+    others.
+
+    Parameters
+    ----------
+    model_names : Optional[list[str]]
+        A list of names of models. If not given, statistics are generated
+        for all models in the bucket.
+    upload : Optional[bool]
+        If True, the statistics are uploaded to s3. Default: True
+    io_workers : Optional[int]
+        The number of threads loading inputs and uploading statistics.
+    processes : Optional[int]
+        The number of processes computing statistics. If 1 or less, the
+        statistics are computed in this process.
+
+    Returns
+    -------
+    stats : dict
+        A dictionary mapping a model name to its statistics.
+    """
+    if model_names is None:
+        model_names = get_model_names()
+    logger.info(f'Generating stats for {len(model_names)} models.')
+    stats = {}
+    io_pool = ThreadPoolExecutor(max_workers=io_workers)
+    compute_pool = None
+    if processes > 1:
+        # Processes are spawned rather than forked because the threads of
+        # the io_pool may be using the shared S3 client (and holding its
+        # locks and connections) when the processes are started. The
+        # processes do not access s3 (see make_stats_from_inputs), which
+        # keeps forking safe on Python 3.6 without mp_context.
+        pool_kwargs = {}
+        if sys.version_info >= (3, 7):
+            pool_kwargs['mp_context'] = multiprocessing.get_context('spawn')
+        compute_pool = ProcessPoolExecutor(max_workers=processes,
+                                           **pool_kwargs)
+    try:
+        loads = {io_pool.submit(load_stats_inputs, model_name): model_name
+                 for model_name in model_names}
+        computes = {}
+        round_dates = {}
+        for future in as_completed(loads):
+            model_name = loads[future]
+            try:
+                inputs = future.result()
+            except Exception as e:
+                logger.exception(e)
+                continue
+            if inputs is None:
+                continue
+            round_dates[model_name] = inputs['latest_date']
+            if compute_pool:
+                computes[compute_pool.submit(
+                    make_stats_from_inputs, inputs)] = model_name
+            else:
+                computes[io_pool.submit(
+                    make_stats_from_inputs, inputs)] = model_name
+        saves = []
+        for future in as_completed(computes):
+            model_name = computes[future]
+            try:
+                json_stats, changes = future.result()
+            except Exception as e:
+                logger.exception(e)
+                continue
+            stats[model_name] = json_stats
+            if upload:
+                saves.append(io_pool.submit(
+                    save_stats_to_s3, model_name, json_stats, changes,
+                    round_dates[model_name]))
+        for future in as_completed(saves):
+            try:
+                future.result()
+            except Exception as e:
+                logger.exception(e)
+    finally:
+        io_pool.shutdown()
+        if compute_pool:
+            compute_pool.shutdown()
+    logger.info(f'Generated stats for {len(stats)} models.')
+    return stats
+
+
+def _add_changes_row(rows, row):
+    # Rows are dated by their round, so a row from the date of the new row
+    # or later is an earlier version of the same round which is replaced
+    return [r for r in rows if r['date'] < row['date']] + [row]
+
+
+def _load_changes_from_stats(model_name):
+    # Models without a log yet get their history from the latest stats
+    key = find_latest_s3_file(
+        'emmaa', f'stats/{model_name}/stats_', extension='.json')
+    if key is None:
+        logger.info(f'Could not find a key to the previous statistics '
+                    f'for {model_name} model.')
+        return []
+    client = get_s3_client()
+    logger.info(f'Loading earlier statistics from {key}')
+    obj = client.get_object(Bucket='emmaa', Key=key)
+    previous_json_stats = json.loads(obj['Body'].read().decode('utf8'))
+    return changes_over_time_to_rows(
+        previous_json_stats.get('changes_over_time'))
+
+
+@lru_cache(100)
+def _get_agent_order(stmt_type):
+    try:
+        return get_statement_by_name(stmt_type)._agent_order
+    except Exception:
+        return NotImplemented
+
+
+def _get_agent_names(stmt_json):
+    # Get the names of agents of a statement from its JSON in the order of
+    # Statement.agent_list without deserializing the statement
+    agent_order = _get_agent_order(stmt_json['type'])
+    if agent_order is NotImplemented:
+        stmt = Statement._from_json(stmt_json)
+        return [agent.name for agent in stmt.agent_list() if agent is not None]
+    names = []
+    for key in agent_order:
+        agents = stmt_json.get(key)
+        if not isinstance(agents, list):
+            agents = [agents]
+        for agent in agents:
+            if agent is None:
+                continue
+            # Events (e.g. in Influence) refer to their concept
+            names.append(agent['concept']['name'] if 'concept' in agent
+                         else agent['name'])
+    return names
+
+
+def _count_sorted(values, top=None):
+    # Count values and sort them by decreasing count, values with the same
+    # count are in the order of their first occurrence
+    labels, first_ixs, counts = np.unique(values, return_index=True,
+                                          return_counts=True)
+    order = np.argsort(first_ixs, kind='stable')
+    return _sort_by_count(labels[order].tolist(), counts[order], top)
+
+
+def _sort_by_count(labels, counts, top=None):
+    # Return (label, count) tuples sorted by decreasing count and keeping
+    # the order of labels with the same count. If top is given, the top
+    # counts are selected in linear time and only they are sorted.
+    counts = np.asarray(counts, dtype=int)
+    ixs = np.arange(len(counts))
+    if top is not None and top < len(counts):
+        if top <= 0:
+            return []
+        threshold = np.partition(counts, len(counts) - top)[len(counts) - top]
+        ixs = np.flatnonzero(counts >= threshold)
+    ixs = ixs[np.argsort(-counts[ixs], kind='stable')][:top]
+    return [(labels[ix], int(counts[ix])) for ix in ixs]
+
+
+def _get_changes_over_time_key(model_name):
+    return f'stats/{model_name}/changes_over_time.jsonl'
+
+
+def load_changes_over_time(model_name, start_date=None, end_date=None,
+                           client=None):
+    """Load the changes over time log of a model from s3.
+
+    The log has one JSON row per test round with the date of the round, the
+    number of statements and applied tests and the number of passed tests
+    and passed ratio per mc_type.
+
+    Parameters
+    ----------
+    model_name : str
+        A name of a model.
+    start_date : Optional[str]
+        If given, only rounds on or after this date are returned. A date
+        string in the format of emmaa.util.make_date_str or a prefix of it
+        (e.g. 2019-08).
+    end_date : Optional[str]
+        If given, only rounds on or before this date (or date prefix) are
+        returned.
+    client : Optional[boto3.client]
+        An s3 client to use.
+
+    Returns
+    -------
+    rows : list[dict] or None
+        A list of rows of the log in the order of rounds or None if the
+        model does not have a log.
+    """
+    client = client if client else get_s3_client()
+    key = _get_changes_over_time_key(model_name)
+    try:
         obj = client.get_object(Bucket='emmaa', Key=key)
-        previous_json_stats = json.loads(obj['Body'].read().decode('utf8'))
-        return previous_json_stats
+    except ClientError:
+        logger.info(f'Could not find changes over time for {model_name}.')
+        return None
+    return _parse_changes_over_time(obj['Body'].read(), start_date, end_date)
+
+
+def _parse_changes_over_time(body, start_date=None, end_date=None):
+    rows = []
+    for line in body.decode('utf8').splitlines():
+        if not line:
+            continue
+        row = json.loads(line)
+        if start_date and row['date'][:len(start_date)] < start_date:
+            continue
+        if end_date and row['date'][:len(end_date)] > end_date:
+            continue
+        rows.append(row)
+    return rows
+
+
+def save_changes_over_time(model_name, rows, client=None):
+    """Save the rows of the changes over time log of a model to s3."""
+    client = client if client else get_s3_client(unsigned=False)
+    key = _get_changes_over_time_key(model_name)
+    logger.info(f'Uploading changes over time to {key}')
+    body = ''.join(json.dumps(row) + '\n' for row in rows)
+    client.put_object(Bucket='emmaa', Key=key, Body=body.encode('utf8'))
+
+
+def rows_to_changes_over_time(rows):
+    """Return changes over time in the columnar format of the stats JSON.
+
+    Parameters
+    ----------
+    rows : list[dict]
+        A list of rows of the changes over time log.
+
+    Returns
+    -------
+    changes : dict
+        A dictionary with lists of dates, numbers of statements and applied
+        tests and for each mc_type, numbers of passed tests and passed ratios.
+        The lists of an mc_type only contain the rounds it was tested in.
+    """
+    changes = {'number_of_statements': [], 'number_applied_tests': [],
+               'dates': []}
+    for row in rows:
+        changes['dates'].append(row['date'])
+        for metrics in ['number_of_statements', 'number_applied_tests']:
+            changes[metrics].append(row[metrics])
+        for mc_type, mc_type_row in row.items():
+            if not isinstance(mc_type_row, dict):
+                continue
+            if mc_type not in changes:
+                changes[mc_type] = {'number_passed_tests': [],
+                                    'passed_ratio': []}
+            for metrics in ['number_passed_tests', 'passed_ratio']:
+                changes[mc_type][metrics].append(mc_type_row[metrics])
+    return changes
+
+
+def changes_over_time_to_rows(changes):
+    """Return rows of the changes over time log from the columnar format.
+
+    This is the inverse of rows_to_changes_over_time. The lists of an mc_type
+    that are shorter than the list of dates belong to the latest rounds.
+    """
+    if not changes:
+        return []
+    dates = changes['dates']
+    rows = [{'date': date,
+             'number_of_statements': changes['number_of_statements'][ix],
+             'number_applied_tests': changes['number_applied_tests'][ix]}
+            for ix, date in enumerate(dates)]
+    for mc_type, mc_type_changes in changes.items():
+        if not isinstance(mc_type_changes, dict):
+            continue
+        passed = mc_type_changes['number_passed_tests']
+        ratios = mc_type_changes['passed_ratio']
+        for row, num_passed, ratio in zip(rows[len(dates) - len(passed):],
+                                          passed, ratios):
+            row[mc_type] = {'number_passed_tests': num_passed,
+                            'passed_ratio': ratio}
+    return rows
+
+
+def _get_test_history_key(model_name):
+    return f'results/{model_name}/test_history.json'
+
+
+def update_test_history(history, test_round, date):
+    """Add the results of a test round to a test history index.
+
+    The index maps each test hash and mc_type to a run-length-encoded
+    history of its results. Each run is a list [status, first round, last
+    round] of consecutive rounds with the same status ('Pass' or 'Fail'),
+    with rounds given as indices into the list of dates of the index. A test
+    that was not applied in a round starts a new run in the next round it
+    is applied in.
+
+    Parameters
+    ----------
+    history : dict or None
+        A test history index to update in place. If None, a new one is made.
+    test_round : emmaa.analyze_tests_results.TestRound
+        A test round to add.
+    date : str
+        The date of the test round in the format of emmaa.util.make_date_str.
+
+    Returns
+    -------
+    history : dict
+        The updated test history index.
+    """
+    if history is None:
+        history = {'dates': [], 'tests': {}}
+    # The same round cannot be added twice
+    if history['dates'] and history['dates'][-1] >= date:
+        logger.info(f'Test history already has results from {date}.')
+        return history
+    history['dates'].append(date)
+    round_ix = len(history['dates']) - 1
+    for mc_type in test_round.mc_types:
+        for test_hash, status in \
+                test_round._get_pass_fail_by_hash(mc_type).items():
+            runs = history['tests'].setdefault(
+                test_hash, {}).setdefault(mc_type, [])
+            if runs and runs[-1][0] == status and \
+                    runs[-1][2] == round_ix - 1:
+                runs[-1][2] = round_ix
+            else:
+                runs.append([status, round_ix, round_ix])
+    return history
+
+
+def load_test_history(model_name, client=None):
+    """Load the test history index of a model from s3.
+
+    Returns None if the model does not have a test history index.
+    """
+    client = client if client else get_s3_client()
+    history, _ = _load_test_history_with_etag(model_name, client)
+    return history
+
+
+def get_test_history_etag(model_name, client=None):
+    """Return the ETag of the test history index of a model on s3.
+
+    Returns None if the model does not have a test history index.
+    """
+    client = client if client else get_s3_client()
+    key = _get_test_history_key(model_name)
+    try:
+        return client.head_object(Bucket='emmaa', Key=key)['ETag']
+    except ClientError:
+        return None
+
+
+def _load_test_history_with_etag(model_name, client):
+    key = _get_test_history_key(model_name)
+    try:
+        obj = client.get_object(Bucket='emmaa', Key=key)
+    except ClientError:
+        logger.info(f'Could not find test history for {model_name}.')
+        return None, None
+    return json.loads(obj['Body'].read().decode('utf8')), obj.get('ETag')
+
+
+def save_test_history(model_name, history, client=None):
+    """Save the test history index of a model to s3."""
+    client = client if client else get_s3_client(unsigned=False)
+    key = _get_test_history_key(model_name)
+    logger.info(f'Uploading test history to {key}')
+    client.put_object(Bucket='emmaa', Key=key,
+                      Body=json.dumps(history).encode('utf8'))
+
+
+def update_test_history_on_s3(model_name, test_round, date):
+    """Add the results of a test round to the test history index on s3.
+
+    The index is only written if it was not changed since it was read (or,
+    for a new index, if it was not created in the meantime). If another
+    process changed it, it is read and updated again, at most
+    TEST_HISTORY_MAX_ATTEMPTS times.
+
+    Returns
+    -------
+    history : dict or None
+        The updated test history index or None if it could not be written.
+    """
+    client = get_s3_client(unsigned=False)
+    key = _get_test_history_key(model_name)
+    for _ in range(TEST_HISTORY_MAX_ATTEMPTS):
+        history, etag = _load_test_history_with_etag(model_name, client)
+        history = update_test_history(history, test_round, date)
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        logger.info(f'Uploading test history to {key}')
+        try:
+            client.put_object(Bucket='emmaa', Key=key,
+                              Body=json.dumps(history).encode('utf8'),
+                              **condition)
+            return history
+        except ClientError as e:
+            if e.response['Error']['Code'] not in (
+                    'PreconditionFailed', 'ConditionalRequestConflict'):
+                raise
+            logger.info(f'Test history of {model_name} was changed by '
+                        f'another process, updating it again.')
+    logger.warning(f'Could not update the test history of {model_name} '
+                   f'with the results from {date}.')
+    return None
+
+
+def build_test_history(model_name):
+    """Build the test history index of a model from all its results on s3.
+
+    This reads every test results file of the model, so it is only needed
+    once to make the index for earlier rounds. Later rounds are added with
+    update_test_history_on_s3.
+    """
+    keys = [f['Key'] for f in sort_s3_files_by_date(
+        'emmaa', f'results/{model_name}/results_', extension='.json')]
+    history = None
+    for key in reversed(keys):
+        history = update_test_history(
+            history, TestRound.load_from_s3_key(key), strip_out_date(key))
+    if history:
+        save_test_history(model_name, history)
+    return history
+
+
+def get_test_history(model_name, test_hash, mc_type=None, history=None):
+    """Return the history of results of a test from the test history index.
+
+    Parameters
+    ----------
+    model_name : str
+        A name of a model.
+    test_hash : str
+        A hash of a test.
+    mc_type : Optional[str]
+        If given, only return the history for this type of ModelChecker.
+    history : Optional[dict]
+        A test history index. If not given, it is loaded from s3.
+
+    Returns
+    -------
+    test_history : dict or None
+        A dictionary mapping an mc_type to a list of runs of consecutive
+        rounds with the same result. Each run is a dictionary with the
+        status ('Pass' or 'Fail'), the start and end dates of the run and the
+        number of rounds in it. None if the model does not have a test
+        history index.
+    """
+    if history is None:
+        history = load_test_history(model_name)
+    if history is None:
+        return None
+    dates = history['dates']
+    test_history = {}
+    for mt, runs in history['tests'].get(test_hash, {}).items():
+        if mc_type and mt != mc_type:
+            continue
+        test_history[mt] = [{'status': status, 'start': dates[first],
+                             'end': dates[last], 'rounds': last - first + 1}
+                            for status, first, last in runs]
+    return test_history
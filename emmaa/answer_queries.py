@@ -1,14 +1,60 @@
-import logging
+import os
+import json
+import time
 import pickle
+import hashlib
+import logging
+import weakref
+import itertools
+import threading
+from uuid import uuid4
+from functools import partial
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError, \
+    as_completed
 from datetime import datetime
 from emmaa.util import get_s3_client, make_date_str
 from emmaa.db import get_db
+from emmaa.db.manager import hash_result_json
 
 
 logger = logging.getLogger(__name__)
 
 
-model_manager_cache = {}
+# The limits of the ModelManager cache can be set in the environment.
+MM_CACHE_MAX_ENTRIES = int(os.environ.get('EMMAA_MM_CACHE_MAX_ENTRIES', 10))
+MM_CACHE_MAX_BYTES = int(os.environ.get('EMMAA_MM_CACHE_MAX_BYTES',
+                                        4 * 1024 ** 3))
+MM_CACHE_CHECK_INTERVAL = float(os.environ.get(
+    'EMMAA_MM_CACHE_CHECK_INTERVAL', 300))
+# How often the background preloader checks S3 for new ModelManagers.
+MM_PRELOAD_INTERVAL = float(os.environ.get('EMMAA_MM_PRELOAD_INTERVAL', 600))
+# The number of threads answering queries on several models, the number of
+# threads answering queries submitted as jobs in the background and the
+# number of seconds for which the status of a finished query job is kept.
+QUERY_WORKERS = int(os.environ.get('EMMAA_QUERY_WORKERS', 4))
+QUERY_JOB_WORKERS = int(os.environ.get('EMMAA_QUERY_JOB_WORKERS', 4))
+QUERY_JOB_TTL = float(os.environ.get('EMMAA_QUERY_JOB_TTL', 3600))
+# The number of seconds answer_immediate_query waits for the models to be
+# answered before returning the results that are available.
+QUERY_TIMEOUT = float(os.environ.get('EMMAA_QUERY_TIMEOUT', 600))
+# The maximum number of query results kept in the in-process result cache.
+QUERY_CACHE_MAX_ENTRIES = int(
+    os.environ.get('EMMAA_QUERY_CACHE_MAX_ENTRIES', 1000))
+
+
+# Objects with locks or threads that have to be reset in forked children
+# (e.g., Gunicorn workers forked after the app was imported with --preload).
+_after_fork_objects = weakref.WeakSet()
+
+
+def _reset_after_fork():
+    for obj in list(_after_fork_objects):
+        obj._reset_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
 
 
 class QueryManager(object):
@@ -21,12 +67,47 @@ class QueryManager(object):
     model_managers : list[emmaa.model_tests.ModelManager]
         Optional list of ModelManagers to use for running queries. If not
         given, the methods will load ModelManager from S3 when needed.
+    max_workers : Optional[int]
+        The number of threads used to answer a query on several models.
+    job_workers : Optional[int]
+        The number of threads used to answer the queries submitted with
+        submit_immediate_query. These are separate from the threads
+        answering queries with answer_immediate_query so background jobs
+        cannot hold up the queries a client is waiting for.
+    timeout : Optional[float]
+        The number of seconds answer_immediate_query waits for the results
+        from the models. Models that are not answered in time are left out
+        of the returned results and their results are saved when they are
+        available if the user subscribed to the query.
+    result_cache : Optional[emmaa.answer_queries.QueryResultCache]
+        A cache of query results shared between queries. Default: the shared
+        query_result_cache.
+    job_store : Optional[emmaa.answer_queries.QueryJobStore]
+        A store of the status of the queries submitted with
+        submit_immediate_query. Default: a new LocalQueryJobStore.
     """
-    def __init__(self, db=None, model_managers=None):
+    def __init__(self, db=None, model_managers=None,
+                 max_workers=QUERY_WORKERS, timeout=QUERY_TIMEOUT,
+                 result_cache=None, job_workers=QUERY_JOB_WORKERS,
+                 job_store=None):
         self.db = db
         if db is None:
             self.db = get_db('primary')
         self.model_managers = model_managers if model_managers else []
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.result_cache = result_cache if result_cache is not None \
+            else query_result_cache
+        self.job_workers = job_workers
+        self.job_store = job_store if job_store is not None \
+            else LocalQueryJobStore()
+        self._executor = None
+        self._job_executor = None
+        self._executor_lock = threading.Lock()
+        self._local_versions = {}
+        self._running = {}
+        self._late_futures = set()
+        _after_fork_objects.add(self)
 
     def answer_immediate_query(
             self, user_email, user_id, query, model_names, subscribe):
@@ -44,23 +125,199 @@ class QueryManager(object):
         if checked_models == set(model_names):
             return format_results(saved_results)
         # Run queries mechanism for models for which result was not found.
-        new_results = []
+        # The models are answered in parallel and results are gathered as
+        # they complete within the timeout.
         new_date = datetime.now()
+        futures = {}
         for model_name in model_names:
             if model_name not in checked_models:
-                mm = self.get_model_manager(model_name)
-                response_list = mm.answer_query(query)
-                for (mc_type, response) in response_list:
-                    new_results.append(
-                        (model_name, query, mc_type, response, new_date))
-                if subscribe:
-                    self.db.put_results(
-                        model_name,
-                        [(query, mc_type, response)
-                         for mc_type, response in response_list])
+                future = self._submit_query_for_model(
+                    model_name, query, new_date)
+                futures[future] = model_name
+        new_results = []
+        to_save = {}
+        try:
+            for future in as_completed(futures, timeout=self.timeout):
+                model_name = futures[future]
+                try:
+                    model_results = future.result()
+                except Exception as e:
+                    logger.exception(e)
+                    logger.warning(f'Could not answer {query} on '
+                                   f'{model_name}.')
+                    continue
+                new_results += model_results
+                to_save[model_name] = [
+                    (query, mc_type, response)
+                    for _, query, mc_type, response, _ in model_results]
+        except TimeoutError:
+            timed_out = [model_name for future, model_name in futures.items()
+                         if not future.done()]
+            logger.warning(f'Answering {query} timed out after '
+                           f'{self.timeout} seconds on {timed_out}.')
+            # Models that are not answered in time keep running and their
+            # results are saved when they are available.
+            if subscribe:
+                for future, model_name in futures.items():
+                    if model_name in timed_out:
+                        self._save_results_when_done(model_name, future)
+        if subscribe:
+            self.db.put_results_batch(to_save)
         all_results = saved_results + new_results
         return format_results(all_results)
 
+    def submit_immediate_query(
+            self, user_email, user_id, query, model_names, subscribe):
+        """Start answering a query in the background and return a job ID.
+
+        Saved results are retrieved from the database right away and the
+        query is answered for each of the remaining models in a pool of
+        worker threads. The status of the job, including the results for
+        the models that are already done, is kept in the job_store and can
+        be retrieved with get_job_status.
+
+        Returns
+        -------
+        job_id : str
+            The ID of the job answering the query.
+        """
+        self.db.put_queries(user_email, user_id, query, model_names, subscribe)
+        saved_results = self.db.get_results_from_query(query, model_names)
+        if not saved_results:
+            saved_results = []
+        job_id = uuid4().hex
+        self.job_store.add_job(job_id, query, model_names)
+        checked_models = {res[0] for res in saved_results}
+        for model_name in checked_models:
+            self.job_store.add_results(
+                job_id, model_name,
+                [res for res in saved_results if res[0] == model_name])
+        new_date = datetime.now()
+        for model_name in model_names:
+            if model_name in checked_models:
+                continue
+            future = self._get_job_executor().submit(
+                self._answer_query_for_model, model_name, query, new_date)
+            future.add_done_callback(
+                partial(self._finish_job_model, job_id, model_name,
+                        subscribe))
+        logger.info(f'Submitted query job {job_id} for {query}.')
+        return job_id
+
+    def get_job_status(self, job_id):
+        """Return the status of a query job and the results found so far.
+
+        Returns
+        -------
+        status : dict or None
+            A dictionary with the job status (see QueryJob.get_status) or
+            None if no job with the given ID exists.
+        """
+        return self.job_store.get_job_status(job_id)
+
+    def _answer_query_for_model(self, model_name, query, date):
+        # Return the results of answering a query on one model. Results are
+        # cached per version of the model manager so identical queries are
+        # only answered once until a new model manager is loaded.
+        mm = self.get_model_manager(model_name)
+        version = self._get_model_manager_version(model_name, mm)
+        if version is None:
+            response_list = mm.answer_query(query)
+        else:
+            key = (query.get_hash_with_model(model_name), version)
+            response_list = self.result_cache.get_or_compute(
+                key, partial(mm.answer_query, query))
+        return [(model_name, query, mc_type, response, date)
+                for mc_type, response in response_list]
+
+    def _submit_query_for_model(self, model_name, query, date):
+        # Answer a query on a model in the pool unless the same query is
+        # still being answered on the model (e.g., after an earlier request
+        # for it timed out) so a slow query occupies at most one thread.
+        key = (query.get_hash_with_model(model_name), model_name)
+        executor = self._get_executor()
+        with self._executor_lock:
+            future = self._running.get(key)
+            if future is not None:
+                return future
+            future = executor.submit(
+                self._answer_query_for_model, model_name, query, date)
+            self._running[key] = future
+        future.add_done_callback(partial(self._remove_running, key))
+        return future
+
+    def _remove_running(self, key, future):
+        with self._executor_lock:
+            if self._running.get(key) is future:
+                self._running.pop(key)
+
+    def _save_results_when_done(self, model_name, future):
+        # Several requests can time out on the same future, the results are
+        # only saved once
+        with self._executor_lock:
+            if future in self._late_futures:
+                return
+            self._late_futures.add(future)
+        future.add_done_callback(partial(self._save_late_results, model_name))
+
+    def _save_late_results(self, model_name, future):
+        # Save the results for a model that were not available in time
+        with self._executor_lock:
+            self._late_futures.discard(future)
+        try:
+            results = future.result()
+        except Exception as e:
+            logger.exception(e)
+            return
+        try:
+            self.db.put_results(
+                model_name, [(query, mc_type, response)
+                             for _, query, mc_type, response, _ in results])
+        except Exception as e:
+            logger.exception(e)
+            return
+        logger.info(f'Saved late results for {model_name}.')
+
+    def _finish_job_model(self, job_id, model_name, subscribe, future):
+        # Store the results for one model of a job once they are available
+        try:
+            results = future.result()
+        except Exception as e:
+            logger.exception(e)
+            self.job_store.add_error(job_id, model_name, str(e))
+            return
+        self.job_store.add_results(job_id, model_name, results)
+        if subscribe:
+            try:
+                self.db.put_results(
+                    model_name, [(query, mc_type, response)
+                                 for _, query, mc_type, response, _
+                                 in results])
+            except Exception as e:
+                logger.exception(e)
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers)
+            return self._executor
+
+    def _get_job_executor(self):
+        with self._executor_lock:
+            if self._job_executor is None:
+                self._job_executor = ThreadPoolExecutor(
+                    max_workers=self.job_workers)
+            return self._job_executor
+
+    def _reset_after_fork(self):
+        # The threads of the executors are not copied into a forked child.
+        self._executor = None
+        self._job_executor = None
+        self._executor_lock = threading.Lock()
+        self._running = {}
+        self._late_futures = set()
+
     def answer_registered_queries(
             self, model_name, find_delta=True, notify=False):
         """Retrieve queries registered on database for a given model,
@@ -83,6 +340,79 @@ class QueryManager(object):
                     logger.info(report)
             self.db.put_results(model_name, results)
 
+    def answer_changed_registered_queries(self, model_name, find_delta=True):
+        """Answer registered queries and only store results that changed.
+
+        The hashes of the latest stored results for the model are retrieved
+        in one bulk query and compared with the hashes of the new results (see
+        emmaa.db.manager.hash_result_json). New rows are only added for
+        results that changed while the last_checked date is updated for the
+        ones that did not.
+
+        Parameters
+        ----------
+        model_name : str
+            The name of the model to answer registered queries for.
+        find_delta : Optional[bool]
+            If True, log a report for each changed result. Default: True
+
+        Returns
+        -------
+        timings : dict
+            A dictionary mapping the name of each phase to the number of
+            seconds it took.
+        """
+        timings = {}
+        start = time.time()
+        model_manager = self.get_model_manager(model_name)
+        timings['load_model_manager'] = time.time() - start
+        start = time.time()
+        queries = self.db.get_queries(model_name)
+        timings['get_queries'] = time.time() - start
+        if not queries:
+            logger.info(f'No registered queries for {model_name}.')
+            return timings
+        start = time.time()
+        results = model_manager.answer_queries(queries)
+        timings['answer_queries'] = time.time() - start
+        start = time.time()
+        latest_results = self.db.get_latest_results_for_model(model_name)
+        timings['get_latest_results'] = time.time() - start
+        start = time.time()
+        changed_results = []
+        unchanged_ids = []
+        previous_ids = []
+        for query, mc_type, result_json in results:
+            key = (query.get_hash_with_model(model_name), mc_type)
+            result_id, result_hash = latest_results.get(key, (None, None))
+            if result_hash is not None and \
+                    hash_result_json(result_json) == result_hash:
+                unchanged_ids.append(result_id)
+                continue
+            changed_results.append((query, mc_type, result_json))
+            previous_ids.append(result_id)
+        if find_delta:
+            # Only load the previous results that changed to report them
+            old_result_jsons = self.db.get_result_jsons(
+                [result_id for result_id in previous_ids
+                 if result_id is not None])
+            for (query, mc_type, result_json), result_id in zip(
+                    changed_results, previous_ids):
+                logger.info(self.make_str_report_one_query(
+                    model_name, query, mc_type, result_json,
+                    old_result_jsons.get(result_id)))
+        timings['compare_results'] = time.time() - start
+        start = time.time()
+        self.db.put_results(model_name, changed_results)
+        self.db.update_results_checked(unchanged_ids)
+        timings['store_results'] = time.time() - start
+        logger.info(f'Answered {len(results)} registered queries for '
+                    f'{model_name}: {len(changed_results)} changed, '
+                    f'{len(unchanged_ids)} unchanged.')
+        for phase, seconds in timings.items():
+            logger.info(f'{phase}: {seconds:.2f} seconds')
+        return timings
+
     def get_registered_queries(self, user_email):
         """Get formatted results to queries registered by user."""
         results = self.db.get_results(user_email)
@@ -106,54 +436,141 @@ class QueryManager(object):
         reports : list[str]
             A list of reports on changes for each of the queries.
         """
-        processed_query_mc = []
-        reports = []
-        # If latest results are in db, retrieve the second latest
+        # Compare results by their hashes and only load the previous results
+        # that changed from the database.
+        query_hashes = {query.get_hash_with_model(model_name)
+                        for model_name, query, _, _, _ in new_results}
+        # If latest results are in db, compare them with the second latest
         if stored:
-            order = 2
-        # If latest results are not in db, retrieve the latest stored
+            deltas = self.db.get_result_deltas(query_hashes)
+        # If latest results are not in db, compare with the latest stored
         else:
-            order = 1
+            result_hashes = self.db.get_result_hashes(query_hashes)
+            deltas = {key: (None, result_id, None) for key, (result_id, _)
+                      in result_hashes.items()}
+        old_results = []
         for model_name, query, mc_type, new_result_json, _ in new_results:
+            key = (query.get_hash_with_model(model_name), mc_type)
+            _, previous_id, changed = deltas.get(key, (None, None, True))
+            if not stored and previous_id is not None:
+                result_hash = result_hashes[key][1]
+                changed = result_hash is None or \
+                    result_hash != hash_result_json(new_result_json)
+            old_results.append((previous_id, changed))
+        old_result_jsons = self.db.get_result_jsons(
+            [previous_id for previous_id, changed in old_results
+             if previous_id is not None and changed])
+
+        processed_query_mc = []
+        reports = []
+        for (model_name, query, mc_type, new_result_json, _), \
+                (previous_id, changed) in zip(new_results, old_results):
             if (model_name, query, mc_type) in processed_query_mc:
                 continue
-            try:
-                old_results = self.db.get_results_from_query(
-                    query, [model_name], order)
-                if old_results:
-                    for old_result in old_results:
-                        if mc_type == old_result[2]:
-                            old_result_json = old_result[3]
-                            if report_format == 'str':
-                                report = self.make_str_report_one_query(
-                                    model_name, query, mc_type,
-                                    new_result_json, old_result_json)
-                            elif report_format == 'html':
-                                report = self._make_html_one_query_inner(
-                                    model_name, query, mc_type,
-                                    new_result_json, old_result_json)
-                            reports.append(report)
-                else:
-                    logger.info('No previous result was found.')
-                    if report_format == 'str':
-                        report = self.make_str_report_one_query(
-                            model_name, query, mc_type, new_result_json, None)
-                    elif report_format == 'html':
-                        report = self._make_html_one_query_inner(
-                            model_name, query, mc_type, new_result_json, None)
-                    reports.append(report)
-            except IndexError:
-                logger.info('No result for desired date back was found.')
-                if report_format == 'str':
-                    report = self.make_str_report_one_query(
-                        model_name, query, mc_type, new_result_json, None)
-                elif report_format == 'html':
-                    report = self._make_html_one_query_inner(
-                        model_name, query, mc_type, new_result_json, None)
-                reports.append(report)
+            # An unchanged result is reported the same way as a result with
+            # the same hashes as the new one
+            if not changed:
+                old_result_json = new_result_json
+            elif previous_id is None:
+                logger.info('No previous result was found.')
+                old_result_json = None
+            else:
+                old_result_json = old_result_jsons.get(previous_id)
+            if report_format == 'str':
+                report = self.make_str_report_one_query(
+                    model_name, query, mc_type, new_result_json,
+                    old_result_json)
+            elif report_format == 'html':
+                report = self._make_html_one_query_inner(
+                    model_name, query, mc_type, new_result_json,
+                    old_result_json)
+            reports.append(report)
             processed_query_mc.append((model_name, query, mc_type))
         return reports
 
+    def iter_user_reports(self, only_changed=True):
+        """Generate reports on subscribed queries for all users.
+
+        The latest results of all subscribed queries are compared with the
+        results last reported to their users in one query and reports are
+        made for one user at a time.
+
+        Parameters
+        ----------
+        only_changed : Optional[bool]
+            If True, only results that changed since they were last reported
+            to the user (see send_user_reports) are included and users
+            without such results are left out. Default: True
+
+        Returns
+        -------
+        generator of tuple
+            Tuples (user_email, str_report, html_report) for each user with
+            subscribed queries.
+        """
+        for user_email, rows in self._iter_user_result_deltas(only_changed):
+            yield (user_email,) + self._make_user_report(rows)
+
+    def send_user_reports(self, sender, only_changed=True):
+        """Make reports on subscribed queries for all users and send them.
+
+        Once a report was sent to a user, the results in it are not reported
+        as changed to the user again.
+
+        Parameters
+        ----------
+        sender : emmaa.answer_queries.ReportSender
+            A sender to send the report of each user with.
+        only_changed : Optional[bool]
+            If True, only results that changed since they were last reported
+            to the user are included and users without such results are not
+            sent a report. Default: True
+
+        Returns
+        -------
+        int
+            The number of users reports were sent to.
+        """
+        num_users = 0
+        for user_email, rows in self._iter_user_result_deltas(only_changed):
+            str_report, html_report = self._make_user_report(rows)
+            try:
+                sender.send(user_email, str_report, html_report)
+            except Exception as e:
+                logger.exception(e)
+                logger.warning(f'Could not send a report to {user_email}.')
+                continue
+            self.db.update_results_reported(
+                user_email, max(row[5] for row in rows))
+            num_users += 1
+        logger.info(f'Sent reports to {num_users} users.')
+        return num_users
+
+    def _iter_user_result_deltas(self, only_changed):
+        # Group the rows of subscribed results by user
+        rows = self.db.get_subscribed_result_deltas(only_changed=only_changed)
+        for user_email, user_rows in itertools.groupby(
+                rows, key=lambda row: row[0]):
+            yield user_email, list(user_rows)
+
+    def _make_user_report(self, rows):
+        # Return the text and html report on the results of one user
+        str_reports = []
+        html_reports = []
+        for _, model_name, query, mc_type, result_json, _, previous_json, \
+                changed in rows:
+            # An unchanged result is reported the same way as a result with
+            # the same hashes as the new one
+            if not changed:
+                previous_json = result_json
+            str_reports.append(self.make_str_report_one_query(
+                model_name, query, mc_type, result_json, previous_json))
+            html_reports.append(self._make_html_one_query_inner(
+                model_name, query, mc_type, result_json, previous_json))
+        html_report = '<html><body>' + ''.join(html_reports) + \
+            '</body></html>'
+        return ''.join(str_reports), html_report
+
     def get_user_query_delta(
             self, user_email, filename='query_delta', report_format='str'):
         """Produce a report for all query results per user in a given format."""
@@ -166,10 +583,9 @@ class QueryManager(object):
             self.make_html_report_per_user(results, filename=filename)
 
     def get_report_per_query(self, model_name, query):
-        try:
-            new_results = self.db.get_results_from_query(
-                            query, [model_name], latest_order=1)
-        except IndexError:
+        new_results = self.db.get_results_from_query(
+                        query, [model_name], latest_order=1)
+        if not new_results:
             logger.info('No latest result was found.')
             return None
         return self.make_reports_from_results(new_results, True, 'str')
@@ -270,11 +686,76 @@ class QueryManager(object):
                 return mm
         return load_model_manager_from_s3(model_name)
 
+    def _get_model_manager_version(self, model_name, mm):
+        # Model managers given explicitly are versioned by their content
+        # while the ones from S3 are versioned by ETag.
+        if any(mm is local_mm for local_mm in self.model_managers):
+            return self._get_local_version(mm)
+        return model_manager_cache.get_version(model_name, mm)
+
+    def _get_local_version(self, mm):
+        # The version of an explicitly given model manager is a hash of its
+        # model checker types and assembled statements so that results
+        # cached for one model manager are never returned for another.
+        # Model managers are kept in self.model_managers, so their ids are
+        # not reused while this QueryManager exists.
+        version = self._local_versions.get(id(mm))
+        if version is None:
+            stmt_hashes = sorted(stmt.get_hash()
+                                 for stmt in mm.model.assembled_stmts)
+            content = json.dumps([sorted(mm.mc_types), stmt_hashes])
+            version = ('local', hashlib.md5(
+                content.encode('utf-8')).hexdigest())
+            self._local_versions[id(mm)] = version
+        return version
+
     def _recreate_db(self):
         self.db.drop_tables(force=True)
         self.db.create_tables()
 
 
+class ReportSender(object):
+    """A base class for sending query result reports to users.
+
+    Subclasses implement the send method delivering one report to one user.
+    """
+    def send(self, user_email, str_report, html_report):
+        """Send a report to a user.
+
+        Parameters
+        ----------
+        user_email : str
+            The email of the user.
+        str_report : str
+            The report in plain text.
+        html_report : str
+            The report as an html page.
+        """
+        raise NotImplementedError('Method must be implemented in a child '
+                                  'class.')
+
+
+class FileReportSender(ReportSender):
+    """Writes reports to text and html files named by the user's email.
+
+    Parameters
+    ----------
+    directory : str
+        The directory to write the reports to. It is created if needed.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def send(self, user_email, str_report, html_report):
+        base_name = os.path.join(self.directory,
+                                 user_email.replace(os.sep, '_'))
+        with open(base_name + '.txt', 'w') as f:
+            f.write(str_report)
+        with open(base_name + '.html', 'w') as f:
+            f.write(html_report)
+
+
 def is_query_result_diff(new_result_json, old_result_json=None):
     """Return True if there is a delta between results."""
     # NOTE: this function is query-type specific so it may need to be
@@ -306,20 +787,635 @@ def format_results(results):
     return formatted_results
 
 
-def load_model_manager_from_s3(model_name):
-    model_manager = model_manager_cache.get(model_name)
-    if model_manager:
-        logger.info(f'Loaded model manager for {model_name} from cache.')
-        return model_manager
+class QueryJob(object):
+    """Keeps track of a query being answered on several models.
+
+    Parameters
+    ----------
+    job_id : str
+        The ID of the job.
+    query : emmaa.queries.Query
+        The query being answered.
+    model_names : list[str]
+        The names of the models the query is answered on.
+
+    Attributes
+    ----------
+    results : dict
+        A dictionary mapping a model name to a list of result tuples (with
+        the format (model_name, query, mc_type, result_json, date)) for the
+        models the query was answered on.
+    errors : dict
+        A dictionary mapping a model name to an error message for the models
+        on which answering the query failed.
+    submitted : float
+        The time the job was submitted.
+    finished : float or None
+        The time the last model was done or None if the job is running.
+    """
+    def __init__(self, job_id, query, model_names):
+        self.job_id = job_id
+        self.query = query
+        self.model_names = list(model_names)
+        self.results = {}
+        self.errors = {}
+        self.submitted = time.time()
+        self.finished = None
+        self._lock = threading.Lock()
+        self._check_finished()
+
+    def add_results(self, model_name, results):
+        """Add the results of answering the query on a model."""
+        with self._lock:
+            self.results[model_name] = results
+            self._check_finished()
+
+    def add_error(self, model_name, error):
+        """Record that answering the query on a model failed."""
+        with self._lock:
+            self.errors[model_name] = error
+            self._check_finished()
+
+    def get_pending_models(self):
+        """Return the names of the models that are not done yet."""
+        with self._lock:
+            return [model_name for model_name in self.model_names
+                    if model_name not in self.results and
+                    model_name not in self.errors]
+
+    def get_status(self):
+        """Return a JSON compatible status of the job.
+
+        Returns
+        -------
+        status : dict
+            A dictionary containing the job_id, the status ('running' or
+            'done'), lists of done and pending models, errors per model and
+            the formatted results for the models that are done.
+        """
+        pending = self.get_pending_models()
+        with self._lock:
+            results = [res for model_name in self.model_names
+                       for res in self.results.get(model_name, [])]
+            status = {'job_id': self.job_id,
+                      'status': 'running' if pending else 'done',
+                      'done_models': [model_name for model_name
+                                      in self.model_names
+                                      if model_name not in pending],
+                      'pending_models': pending,
+                      'errors': dict(self.errors)}
+        status['result'] = format_results(results)
+        return status
+
+    def _check_finished(self):
+        if self.finished is None and \
+                len(self.results) + len(self.errors) >= len(self.model_names):
+            self.finished = time.time()
+
+
+class QueryJobStore(object):
+    """A base class for storing the status of query jobs.
+
+    The QueryManager records the jobs submitted with submit_immediate_query
+    and their results per model in a store and reads the status of a job
+    from it. A store shared between processes (e.g., backed by the database
+    or Redis) can implement these methods to let any worker of the service
+    report the status of a job answered by another worker.
+    """
+    def add_job(self, job_id, query, model_names):
+        """Add a new job answering a query on the given models."""
+        raise NotImplementedError('Need to implement the add_job method')
+
+    def add_results(self, job_id, model_name, results):
+        """Add the results of answering the query of a job on a model."""
+        raise NotImplementedError('Need to implement the add_results method')
+
+    def add_error(self, job_id, model_name, error):
+        """Record that answering the query of a job on a model failed."""
+        raise NotImplementedError('Need to implement the add_error method')
+
+    def get_job_status(self, job_id):
+        """Return the status of a job (see QueryJob.get_status) or None."""
+        raise NotImplementedError(
+            'Need to implement the get_job_status method')
+
+
+class LocalQueryJobStore(QueryJobStore):
+    """Keeps QueryJobs in the memory of this process.
+
+    NOTE: the status of a job can only be retrieved from the process that
+    answers it, so a service using this store has to run a single worker
+    process (e.g., gunicorn -w 1 --threads 8) until a store shared between
+    processes is used.
+
+    Parameters
+    ----------
+    ttl : Optional[float]
+        The number of seconds for which a finished job is kept.
+
+    Attributes
+    ----------
+    jobs : dict
+        A dictionary mapping a job ID to a QueryJob.
+    """
+    def __init__(self, ttl=QUERY_JOB_TTL):
+        self.ttl = ttl
+        self.jobs = {}
+        self._lock = threading.Lock()
+        _after_fork_objects.add(self)
+
+    def add_job(self, job_id, query, model_names):
+        with self._lock:
+            self._remove_expired_jobs()
+            self.jobs[job_id] = QueryJob(job_id, query, model_names)
+
+    def add_results(self, job_id, model_name, results):
+        job = self._get_job(job_id)
+        if job is not None:
+            job.add_results(model_name, results)
+
+    def add_error(self, job_id, model_name, error):
+        job = self._get_job(job_id)
+        if job is not None:
+            job.add_error(model_name, error)
+
+    def get_job_status(self, job_id):
+        job = self._get_job(job_id)
+        if job is None:
+            return None
+        return job.get_status()
+
+    def _get_job(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def _remove_expired_jobs(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job.finished is not None and
+                   now - job.finished > self.ttl]
+        for job_id in expired:
+            self.jobs.pop(job_id)
+
+    def _reset_after_fork(self):
+        self._lock = threading.Lock()
+
+
+class ModelManagerCache(object):
+    """A bounded LRU cache of ModelManagers loaded from S3.
+
+    The size of a ModelManager is estimated as the size of its pickle on S3.
+    A cached ModelManager is considered stale and is reloaded when the ETag
+    of the latest pickle on S3 differs from the one it was loaded from.
+
+    Parameters
+    ----------
+    max_entries : Optional[int]
+        The maximum number of ModelManagers to keep in the cache.
+    max_bytes : Optional[int]
+        The maximum total estimated size of cached ModelManagers in bytes.
+    check_interval : Optional[float]
+        The minimum number of seconds between two checks of whether a cached
+        ModelManager is up to date with S3.
+
+    Attributes
+    ----------
+    entries : collections.OrderedDict
+        An ordered dictionary mapping a model name to a cache entry, the least
+        recently used entry first. Each entry is a dictionary containing the
+        model manager, its etag, last_modified date, estimated size in bytes
+        and the time it was last checked against S3.
+    metrics : dict
+        A dictionary containing the number of cache hits, misses, stale
+        reloads and evictions as well as the number of loads from S3 and the
+        total time spent on them.
+    """
+    def __init__(self, max_entries=MM_CACHE_MAX_ENTRIES,
+                 max_bytes=MM_CACHE_MAX_BYTES,
+                 check_interval=MM_CACHE_CHECK_INTERVAL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        self.entries = OrderedDict()
+        self.metrics = {'hits': 0, 'misses': 0, 'stale': 0, 'evictions': 0,
+                        'loads': 0, 'load_time': 0.0}
+        self._lock = threading.RLock()
+        self._load_locks = {}
+        _after_fork_objects.add(self)
+
+    def get(self, model_name, force_check=False):
+        """Return a ModelManager for the model, loading it from S3 if needed.
+
+        Parameters
+        ----------
+        model_name : str
+            The name of the model to get the ModelManager for.
+        force_check : Optional[bool]
+            If True, check whether the cached ModelManager is up to date with
+            S3 regardless of when it was last checked. Default: False
+
+        Returns
+        -------
+        emmaa.model_tests.ModelManager
+            The latest ModelManager for the model.
+        """
+        with self._lock:
+            entry = self.entries.get(model_name)
+        if entry is not None and \
+                not self._is_stale(model_name, entry, force_check):
+            with self._lock:
+                self.metrics['hits'] += 1
+                if model_name in self.entries:
+                    self.entries.move_to_end(model_name)
+            logger.info(f'Loaded model manager for {model_name} from cache.')
+            return entry['model_manager']
+        # Make sure that only one thread is loading a given model at a time
+        with self._get_load_lock(model_name):
+            with self._lock:
+                new_entry = self.entries.get(model_name)
+            # Another thread could have reloaded the model in the meantime
+            if new_entry is not None and new_entry is not entry:
+                return new_entry['model_manager']
+            with self._lock:
+                if entry is None:
+                    self.metrics['misses'] += 1
+                else:
+                    self.metrics['stale'] += 1
+            new_entry = self._load(model_name)
+            self.put(model_name, new_entry)
+        return new_entry['model_manager']
+
+    def refresh(self, model_name):
+        """Reload a cached ModelManager if it is out of date with S3.
+
+        Unlike get, this does not count as a use of the ModelManager, so it
+        does not change which ModelManagers are evicted first, and models
+        that are not cached are not loaded.
+        """
+        with self._lock:
+            entry = self.entries.get(model_name)
+        if entry is None or \
+                not self._is_stale(model_name, entry, force_check=True):
+            return
+        with self._get_load_lock(model_name):
+            with self._lock:
+                # The model could have been reloaded or evicted meanwhile
+                if self.entries.get(model_name) is not entry:
+                    return
+                self.metrics['stale'] += 1
+            new_entry = self._load(model_name)
+            with self._lock:
+                if model_name in self.entries:
+                    # Replacing the value keeps the position of the entry
+                    self.entries[model_name] = new_entry
+                    self._evict()
+
+    def put(self, model_name, entry):
+        """Add an entry to the cache and evict least recently used entries."""
+        with self._lock:
+            self.entries[model_name] = entry
+            self.entries.move_to_end(model_name)
+            self._evict()
+
+    def remove(self, model_name):
+        """Remove a model from the cache."""
+        with self._lock:
+            self.entries.pop(model_name, None)
+            self._drop_load_lock(model_name)
+
+    def clear(self):
+        """Remove all models from the cache."""
+        with self._lock:
+            for model_name in list(self.entries):
+                self._drop_load_lock(model_name)
+            self.entries.clear()
+
+    def get_version(self, model_name, model_manager=None):
+        """Return the ETag of the cached ModelManager for a model.
+
+        If a ModelManager is given, the ETag is only returned if it is the
+        one currently cached, otherwise None is returned.
+        """
+        with self._lock:
+            entry = self.entries.get(model_name)
+        if entry is None or (model_manager is not None and
+                             entry['model_manager'] is not model_manager):
+            return None
+        return entry['etag']
+
+    def is_cached(self, model_name):
+        """Return True if a ModelManager for the model is in the cache."""
+        with self._lock:
+            return model_name in self.entries
+
+    def has_room_for(self, model_name):
+        """Return True if the model can be loaded without evicting others.
+
+        The size of the ModelManager is estimated as the size of its latest
+        pickle on S3.
+        """
+        size = self._get_size(model_name)
+        with self._lock:
+            return len(self.entries) < self.max_entries and \
+                self.get_total_bytes() + size <= self.max_bytes
+
+    def get_total_bytes(self):
+        """Return the total estimated size of the cached ModelManagers."""
+        with self._lock:
+            return sum(entry['size'] for entry in self.entries.values())
+
+    def get_metrics(self):
+        """Return cache metrics together with the current size of the cache.
+        """
+        with self._lock:
+            metrics = dict(self.metrics)
+            metrics['entries'] = len(self.entries)
+        metrics['bytes'] = self.get_total_bytes()
+        return metrics
+
+    def _evict(self):
+        # Always keep the most recently added entry even if it exceeds limits
+        while len(self.entries) > 1 and (
+                len(self.entries) > self.max_entries or
+                self.get_total_bytes() > self.max_bytes):
+            model_name, _ = self.entries.popitem(last=False)
+            self._drop_load_lock(model_name)
+            self.metrics['evictions'] += 1
+            logger.info(f'Evicted model manager for {model_name} from cache.')
+
+    def _reset_after_fork(self):
+        # A forked child inherits the locks in the state the threads of the
+        # parent held them in, so it gets new ones
+        self._lock = threading.RLock()
+        self._load_locks = {}
+
+    def _get_load_lock(self, model_name):
+        with self._lock:
+            if model_name not in self._load_locks:
+                self._load_locks[model_name] = threading.Lock()
+            return self._load_locks[model_name]
+
+    def _drop_load_lock(self, model_name):
+        # Called with self._lock held when a model leaves the cache so the
+        # load locks do not accumulate. A lock held by a loading thread is
+        # kept so that other threads keep waiting for that load.
+        lock = self._load_locks.get(model_name)
+        if lock is not None and not lock.locked():
+            self._load_locks.pop(model_name)
+
+    def _get_size(self, model_name):
+        client = get_s3_client()
+        key = f'results/{model_name}/latest_model_manager.pkl'
+        resp = client.head_object(Bucket='emmaa', Key=key)
+        return resp.get('ContentLength', 0)
+
+    def _is_stale(self, model_name, entry, force_check=False):
+        # The time of the check is recorded before checking, so other threads
+        # do not check the same entry at the same time and a failed check is
+        # only repeated after the check interval.
+        with self._lock:
+            if not force_check and \
+                    time.time() - entry['checked'] < self.check_interval:
+                return False
+            entry['checked'] = time.time()
+        try:
+            etag, last_modified = _get_model_manager_version(model_name)
+        except Exception as e:
+            logger.warning(f'Could not check the latest model manager for '
+                           f'{model_name}: {e}')
+            return False
+        if etag == entry['etag'] and last_modified == entry['last_modified']:
+            return False
+        logger.info(f'Model manager for {model_name} in cache is stale.')
+        return True
+
+    def _load(self, model_name):
+        start = time.time()
+        client = get_s3_client()
+        key = f'results/{model_name}/latest_model_manager.pkl'
+        logger.info(f'Loading latest model manager for {model_name} model '
+                    f'from S3.')
+        obj = client.get_object(Bucket='emmaa', Key=key)
+        body = obj['Body'].read()
+        model_manager = pickle.loads(body)
+        load_time = time.time() - start
+        with self._lock:
+            self.metrics['loads'] += 1
+            self.metrics['load_time'] += load_time
+        logger.info(f'Loaded model manager for {model_name} in '
+                    f'{load_time:.2f} seconds.')
+        return {'model_manager': model_manager, 'etag': obj.get('ETag'),
+                'last_modified': obj.get('LastModified'), 'size': len(body),
+                'checked': time.time()}
+
+
+def _get_model_manager_version(model_name):
     client = get_s3_client()
     key = f'results/{model_name}/latest_model_manager.pkl'
-    logger.info(f'Loading latest model manager for {model_name} model from '
-                f'S3.')
-    obj = client.get_object(Bucket='emmaa', Key=key)
-    body = obj['Body'].read()
-    model_manager = pickle.loads(body)
-    model_manager_cache[model_name] = model_manager
-    return model_manager
+    resp = client.head_object(Bucket='emmaa', Key=key)
+    return resp.get('ETag'), resp.get('LastModified')
+
+
+model_manager_cache = ModelManagerCache()
+
+
+class QueryResultCache(object):
+    """A bounded LRU cache of query results shared between all users.
+
+    Results are stored as futures, so when several threads ask for a result
+    that is being computed, it is only computed once and the other threads
+    wait for it. Failed computations are not cached.
+
+    Parameters
+    ----------
+    max_entries : Optional[int]
+        The maximum number of results to keep in the cache.
+
+    Attributes
+    ----------
+    entries : collections.OrderedDict
+        An ordered dictionary mapping a key to a future of the result, the
+        least recently used entry first.
+    metrics : dict
+        A dictionary containing the number of cache hits, misses and the
+        number of times a thread waited for a result computed by another
+        thread.
+    """
+    def __init__(self, max_entries=QUERY_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.metrics = {'hits': 0, 'misses': 0, 'waits': 0}
+        self._lock = threading.Lock()
+        _after_fork_objects.add(self)
+
+    def get_or_compute(self, key, compute):
+        """Return a cached result or compute and cache it.
+
+        Parameters
+        ----------
+        key : tuple
+            A hashable key of the result, e.g., a query hash with a model
+            manager version.
+        compute : function
+            A function without arguments computing the result.
+
+        Returns
+        -------
+        result
+            The cached or computed result.
+        """
+        with self._lock:
+            future = self.entries.get(key)
+            if future is not None:
+                self.entries.move_to_end(key)
+                if future.done():
+                    self.metrics['hits'] += 1
+                else:
+                    self.metrics['waits'] += 1
+                owner = False
+            else:
+                future = Future()
+                self.entries[key] = future
+                self.metrics['misses'] += 1
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+                owner = True
+        if not owner:
+            return future.result()
+        try:
+            result = compute()
+        except BaseException as e:
+            # Any exception, including KeyboardInterrupt or SystemExit, has
+            # to resolve the future so waiting threads are not blocked.
+            with self._lock:
+                if self.entries.get(key) is future:
+                    self.entries.pop(key)
+            future.set_exception(e)
+            raise
+        future.set_result(result)
+        return result
+
+    def clear(self):
+        """Remove all results from the cache."""
+        with self._lock:
+            self.entries.clear()
+
+    def get_metrics(self):
+        """Return cache metrics together with the number of entries."""
+        with self._lock:
+            metrics = dict(self.metrics)
+            metrics['entries'] = len(self.entries)
+        return metrics
+
+    def _reset_after_fork(self):
+        # The threads computing the pending results are not copied into a
+        # forked child, so their futures would never be resolved there
+        self._lock = threading.Lock()
+        self.entries = OrderedDict(
+            (key, future) for key, future in self.entries.items()
+            if future.done())
+
+
+query_result_cache = QueryResultCache()
+
+
+class ModelManagerPreloader(object):
+    """Loads ModelManagers into the cache in a background thread.
+
+    The thread first loads the ModelManagers for as many models as fit in
+    the cache and then periodically checks whether newer ModelManagers were
+    uploaded to S3 and reloads them. Preloading never evicts a cached
+    ModelManager, so once the cache is full, only the cached ModelManagers
+    are refreshed and the other models are loaded when they are queried. A
+    reloaded ModelManager replaces the cached one only after it was fully
+    loaded so that queries are answered by the previous ModelManager in the
+    meantime.
+
+    Parameters
+    ----------
+    get_model_names : function
+        A function returning the names of the models to preload.
+    cache : Optional[emmaa.answer_queries.ModelManagerCache]
+        The cache to load ModelManagers into. Default: the shared
+        model_manager_cache.
+    refresh_interval : Optional[float]
+        The number of seconds to wait between two checks for new
+        ModelManagers on S3.
+    """
+    def __init__(self, get_model_names, cache=None,
+                 refresh_interval=MM_PRELOAD_INTERVAL):
+        self.get_model_names = get_model_names
+        self.cache = cache if cache is not None else model_manager_cache
+        self.refresh_interval = refresh_interval
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        _after_fork_objects.add(self)
+
+    def start(self):
+        """Start the preloading thread unless it is already running.
+
+        This can be called repeatedly (e.g., before each request), which makes
+        sure there is a running thread in each worker process of a forking
+        server.
+
+        Returns
+        -------
+        bool
+            True if a new thread was started.
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            self._stop_event.clear()
+            self._thread = threading.Thread(
+                target=self._run, name='model_manager_preloader',
+                daemon=True)
+            self._thread.start()
+            logger.info('Started preloading model managers.')
+            return True
+
+    def stop(self):
+        """Stop the preloading thread after the current model is loaded."""
+        self._stop_event.set()
+
+    def preload(self):
+        """Refresh the cached ModelManagers and load the ones that fit."""
+        try:
+            model_names = self.get_model_names()
+        except Exception as e:
+            logger.warning(f'Could not get the models to preload: {e}')
+            return
+        for model_name in model_names:
+            if self._stop_event.is_set():
+                return
+            try:
+                if self.cache.is_cached(model_name):
+                    self.cache.refresh(model_name)
+                elif self.cache.has_room_for(model_name):
+                    self.cache.get(model_name)
+                else:
+                    logger.info(f'Not preloading model manager for '
+                                f'{model_name}, the cache is full.')
+            except Exception as e:
+                logger.warning(f'Could not preload model manager for '
+                               f'{model_name}: {e}')
+
+    def _reset_after_fork(self):
+        # The thread of the parent does not exist in a forked child
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self.preload()
+            self._stop_event.wait(self.refresh_interval)
+
+
+def load_model_manager_from_s3(model_name):
+    """Return the latest ModelManager for a model using a shared cache."""
+    return model_manager_cache.get(model_name)
 
 
 def _process_result_to_str(result_json):
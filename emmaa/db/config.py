@@ -12,6 +12,15 @@ DEFAULT_DB_CONFIG_PATH = path.join(HERE, path.pardir,
 
 DB_STR_FMT = "{prefix}://{username}{password}{host}{port}/{name}"
 ENV_PREFIX = 'EMMAADB'
+POOL_ENV_PREFIX = 'EMMAA_DB_'
+
+# Connection pool settings that can be given in the config file or in the
+# environment (e.g. EMMAA_DB_POOL_SIZE), with their types and defaults.
+POOL_SETTINGS = {'pool_size': (int, 5),
+                 'max_overflow': (int, 10),
+                 'pool_timeout': (float, 30),
+                 'pool_recycle': (int, 3600),
+                 'pool_pre_ping': (bool, True)}
 
 
 logger = logging.getLogger('db_config')
@@ -61,3 +70,42 @@ def get_databases(force_update=False, include_config=True):
                           for k, v in environ.items()
                           if k.startswith(ENV_PREFIX)})
     return DATABASES
+
+
+def get_pool_settings(name=None, include_config=True):
+    """Get the connection pool settings for a database.
+
+    Settings are read from the section of the database in the config file and
+    can be overridden by environment variables named EMMAA_DB_<SETTING>, e.g.
+    EMMAA_DB_POOL_SIZE.
+
+    Parameters
+    ----------
+    name : Optional[str]
+        The name of the database in the config file.
+    include_config : Optional[bool]
+        Whether to read settings from the config file. Default: True
+
+    Returns
+    -------
+    settings : dict
+        A dictionary of keyword arguments for sqlalchemy.create_engine.
+    """
+    values = {key: default for key, (_, default) in POOL_SETTINGS.items()}
+    if CONFIG_EXISTS and include_config and name:
+        parser = ConfigParser()
+        parser.read(DB_CONFIG_PATH)
+        if parser.has_section(name):
+            values.update({key: parser.get(name, key)
+                           for key in POOL_SETTINGS
+                           if parser.has_option(name, key)})
+    values.update({key: environ[POOL_ENV_PREFIX + key.upper()]
+                   for key in POOL_SETTINGS
+                   if POOL_ENV_PREFIX + key.upper() in environ})
+    settings = {}
+    for key, value in values.items():
+        value_type = POOL_SETTINGS[key][0]
+        if value_type is bool and isinstance(value, str):
+            value = value.lower() in ('1', 'true', 'yes', 'on')
+        settings[key] = value_type(value)
+    return settings
@@ -1,7 +1,7 @@
 import re
 import logging
 
-from .config import get_databases
+from .config import get_databases, get_pool_settings
 from .manager import EmmaaDatabaseManager
 
 logger = logging.getLogger(__name__)
@@ -15,4 +15,5 @@ def get_db(name):
     if m is None:
         logger.error("Poorly formed db name: %s" % db_name)
         return
-    return EmmaaDatabaseManager(db_name, label=name)
+    return EmmaaDatabaseManager(db_name, label=name,
+                                pool_settings=get_pool_settings(name))
@@ -1,14 +1,16 @@
-from collections import defaultdict
-
 from fnvhash import fnv1a_32
 from sqlalchemy.exc import IntegrityError
 
 __all__ = ['EmmaaDatabaseManager', 'EmmaaDatabaseError']
 
+import time
 import logging
+import threading
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, func, or_, and_
+from sqlalchemy.orm import sessionmaker, aliased
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 from .schema import EmmaaTable, User, Query, Base, Result, UserQuery
 from emmaa.queries import Query as QueryObject
@@ -23,16 +25,23 @@ class EmmaaDatabaseError(Exception):
 class EmmaaDatabaseSessionManager(object):
     """A Database session context manager that is used by EmmaaDatabaseManager.
     """
-    def __init__(self, host, engine):
+    def __init__(self, host, engine, session_factory=None, metrics=None):
         logger.debug(f"Grabbing a session to {host}...")
-        DBSession = sessionmaker(bind=engine)
+        if session_factory is None:
+            session_factory = sessionmaker(bind=engine)
         logger.debug("Session grabbed.")
-        self.session = DBSession()
+        self.session = session_factory()
         if self.session is None:
             raise EmmaaDatabaseError("Could not acquire session.")
+        self.metrics = metrics
         return
 
     def __enter__(self):
+        if self.metrics is not None:
+            # Check out a connection from the pool now to time it
+            start = time.time()
+            self.session.connection()
+            self.metrics.add_checkout(time.time() - start)
         return self.session
 
     def __exit__(self, exception_type, exception_value, traceback):
@@ -48,21 +57,75 @@ class EmmaaDatabaseSessionManager(object):
         self.session.close()
 
 
+class PoolMetrics(object):
+    """Collects the number and latency of connection pool checkouts."""
+    def __init__(self):
+        self.checkouts = 0
+        self.checkout_time = 0.0
+        self.max_checkout_time = 0.0
+        self._lock = threading.Lock()
+
+    def add_checkout(self, seconds):
+        with self._lock:
+            self.checkouts += 1
+            self.checkout_time += seconds
+            self.max_checkout_time = max(self.max_checkout_time, seconds)
+
+    def to_json(self):
+        with self._lock:
+            mean = self.checkout_time / self.checkouts if self.checkouts \
+                else 0.0
+            return {'checkouts': self.checkouts,
+                    'mean_checkout_time': mean,
+                    'max_checkout_time': self.max_checkout_time}
+
+
 class EmmaaDatabaseManager(object):
-    """A class used to manage sessions with EMMAA's database."""
-    table_order = ['user', 'query', 'user_query', 'result']
+    """A class used to manage sessions with EMMAA's database.
+
+    Parameters
+    ----------
+    host : str
+        The address of the database.
+    label : Optional[str]
+        The name of the database.
+    pool_settings : Optional[dict]
+        Keyword arguments for sqlalchemy.create_engine configuring the
+        connection pool (see emmaa.db.config.get_pool_settings). They are not
+        used for sqlite databases.
+    """
+    table_order = ['user', 'query', 'user_query', 'result',
+                   'result_archive']
 
-    def __init__(self, host, label=None):
+    def __init__(self, host, label=None, pool_settings=None):
         self.host = host
         self.label = label
-        self.engine = create_engine(host)
+        if pool_settings and not host.startswith('sqlite'):
+            self.engine = create_engine(host, **pool_settings)
+        else:
+            self.engine = create_engine(host)
+        self.session_factory = sessionmaker(bind=self.engine)
+        self.pool_metrics = PoolMetrics()
         self.tables = {tbl.__tablename__: tbl
                        for tbl in EmmaaTable.__subclasses__()}
         self.session = None
         return
 
     def get_session(self):
-        return EmmaaDatabaseSessionManager(self.host, self.engine)
+        return EmmaaDatabaseSessionManager(self.host, self.engine,
+                                           self.session_factory,
+                                           self.pool_metrics)
+
+    def get_pool_status(self):
+        """Return checkout metrics and the state of the connection pool."""
+        status = self.pool_metrics.to_json()
+        pool = self.engine.pool
+        if isinstance(pool, QueuePool):
+            status.update({'size': pool.size(),
+                           'checkedin': pool.checkedin(),
+                           'checkedout': pool.checkedout(),
+                           'overflow': pool.overflow()})
+        return status
 
     def create_tables(self, tables=None):
         """Create the tables from the EMMAA database
@@ -184,13 +247,10 @@ class EmmaaDatabaseManager(object):
             user_email = 'anonymous@emmaa.bio'
             user_id = None
 
+        hashes = {model_id: query.get_hash_with_model(model_id)
+                  for model_id in model_ids}
         # Open database session
         with self.get_session() as sess:
-            # Get existing hashes, user's id and user's subscriptions
-            existing_hashes = {h for h, in sess.query(Query.hash).all()}
-            existing_user_queries = {h for h, in sess.query(
-                UserQuery.query_hash).filter(UserQuery.user_id == user_id)}
-
             # Check if logged in user is in the emmaa user table
             if user_email and user_id:
                 res = \
@@ -202,49 +262,85 @@ class EmmaaDatabaseManager(object):
                     logger.info(f'{user_email} not in user table. Adding...')
                     self.add_user(user_id=user_id, email=user_email)
 
-            new_queries = []
-            new_user_queries = []
-            for model_id in model_ids:
-                qh = query.get_hash_with_model(model_id)
-
-                # Add to queries if not present
-                if qh not in existing_hashes:
-                    logger.info(f"Adding query on {model_id} to the db.")
-                    new_queries.append(Query(model_id=model_id,
-                                             json=query.to_json(),
-                                             hash=qh))
-                else:
-                    logger.info(f"Query for {model_id} already in db.")
-
-                # Add query to UserQuery table or update existing one
-                if qh not in existing_user_queries:
-                    new_user_queries.append(UserQuery(user_id=user_id,
-                                                      query_hash=qh,
-                                                      subscription=subscribe,
-                                                      count=1))
-                    logger.info(f'Registering query on {model_id} for user '
-                                f'{user_email}')
-                # Update existing query
-                else:
-                    user_query = sess.query(UserQuery).filter(
-                        UserQuery.user_id == user_id,
-                        UserQuery.query_hash == qh
-                    ).first()
-                    logger.info(f'Updating existing query for {user_email} '
-                                f'on {model_id} ({qh})')
-                    # Update subscription
-                    # Set subscribe to True, handle un-subscribe elsewhere
-                    if subscribe:
-                        user_query = update_subscription(user_query, subscribe)
-
-                    # Update query count
-                    user_query.count += 1
-
-            # Add new queries and register them for the user
-            sess.add_all(new_queries)
-            sess.add_all(new_user_queries)
+            # Anonymous queries have a NULL user_id which never conflicts
+            # with a unique constraint so they can't be upserted
+            if self.engine.dialect.name == 'postgresql' and \
+                    user_id is not None:
+                self._upsert_queries(sess, user_id, query, hashes, subscribe)
+            else:
+                self._add_queries(sess, user_email, user_id, query, hashes,
+                                  subscribe)
         return
 
+    def _upsert_queries(self, sess, user_id, query, hashes, subscribe):
+        # Insert queries and user queries with INSERT ... ON CONFLICT
+        query_json = query.to_json()
+        sess.execute(
+            pg_insert(Query.__table__)
+            .values([{'hash': qh, 'model_id': model_id, 'json': query_json}
+                     for model_id, qh in hashes.items()])
+            .on_conflict_do_nothing())
+        user_query_table = UserQuery.__table__
+        # Set subscription to True, handle un-subscribe elsewhere
+        update = {'count': user_query_table.c.count + 1}
+        if subscribe:
+            update['subscription'] = True
+        sess.execute(
+            pg_insert(user_query_table)
+            .values([{'user_id': user_id, 'query_hash': qh,
+                      'subscription': subscribe, 'count': 1}
+                     for qh in set(hashes.values())])
+            .on_conflict_do_update(index_elements=['user_id', 'query_hash'],
+                                   set_=update))
+        logger.info(f'Upserted query on {list(hashes)} for user {user_id}.')
+
+    def _add_queries(self, sess, user_email, user_id, query, hashes,
+                     subscribe):
+        # Look up only the given hashes and add or update rows with the ORM
+        existing_hashes = {h for h, in sess.query(Query.hash).filter(
+            Query.hash.in_(hashes.values()))}
+        existing_user_queries = {
+            uq.query_hash: uq for uq in sess.query(UserQuery).filter(
+                UserQuery.user_id == user_id,
+                UserQuery.query_hash.in_(hashes.values()))}
+
+        new_queries = []
+        new_user_queries = []
+        for model_id, qh in hashes.items():
+            # Add to queries if not present
+            if qh not in existing_hashes:
+                logger.info(f"Adding query on {model_id} to the db.")
+                new_queries.append(Query(model_id=model_id,
+                                         json=query.to_json(),
+                                         hash=qh))
+            else:
+                logger.info(f"Query for {model_id} already in db.")
+
+            # Add query to UserQuery table or update existing one
+            if qh not in existing_user_queries:
+                new_user_queries.append(UserQuery(user_id=user_id,
+                                                  query_hash=qh,
+                                                  subscription=subscribe,
+                                                  count=1))
+                logger.info(f'Registering query on {model_id} for user '
+                            f'{user_email}')
+            # Update existing query
+            else:
+                user_query = existing_user_queries[qh]
+                logger.info(f'Updating existing query for {user_email} '
+                            f'on {model_id} ({qh})')
+                # Update subscription
+                # Set subscribe to True, handle un-subscribe elsewhere
+                if subscribe:
+                    user_query = update_subscription(user_query, subscribe)
+
+                # Update query count
+                user_query.count += 1
+
+        # Add new queries and register them for the user
+        sess.add_all(new_queries)
+        sess.add_all(new_user_queries)
+
     def get_queries(self, model_id):
         """Get queries that refer to the given model_id.
 
@@ -281,22 +377,179 @@ class EmmaaDatabaseManager(object):
             query_hash = query.get_hash_with_model(model_id)
             results.append(Result(query_hash=query_hash,
                                   mc_type=mc_type,
-                                  result_json=result_json))
+                                  result_json=result_json,
+                                  result_hash=hash_result_json(result_json)))
+
+        with self.get_session() as sess:
+            sess.add_all(results)
+        return
 
+    def put_results_batch(self, results_by_model):
+        """Add new results for several models in a single transaction.
+
+        Parameters
+        ----------
+        results_by_model : dict
+            A dictionary mapping a model ID to a list of tuples of the form
+            (query, mc_type, result_json) as in put_results.
+        """
+        results = []
+        for model_id, query_results in results_by_model.items():
+            for query, mc_type, result_json in query_results:
+                query_hash = query.get_hash_with_model(model_id)
+                results.append(Result(
+                    query_hash=query_hash, mc_type=mc_type,
+                    result_json=result_json,
+                    result_hash=hash_result_json(result_json)))
+        if not results:
+            return
         with self.get_session() as sess:
             sess.add_all(results)
         return
 
+    def get_latest_results_for_model(self, model_id):
+        """Get the hash of the latest result of each query for a model.
+
+        Parameters
+        ----------
+        model_id : str
+            The short, standard model ID.
+
+        Returns
+        -------
+        latest_results : dict
+            A dictionary mapping a tuple (query_hash, mc_type) to a tuple
+            (result_id, result_hash) of the latest result. The result_hash is
+            None for results stored before hashes were added.
+        """
+        with self.get_session() as sess:
+            ranked = _rank_results(sess, Result.query_hash.in_(
+                sess.query(Query.hash).filter(Query.model_id == model_id)))
+            q = (sess.query(Result.id, Result.query_hash, Result.mc_type,
+                            Result.result_hash)
+                 .filter(Result.id == ranked.c.id, ranked.c.order == 1))
+            latest_results = {(query_hash, mc_type): (result_id, result_hash)
+                              for result_id, query_hash, mc_type, result_hash
+                              in q.all()}
+        return latest_results
+
+    def get_result_hashes(self, query_hashes, latest_order=1):
+        """Get the id and hash of results to the given queries.
+
+        Parameters
+        ----------
+        query_hashes : list[int]
+            The hashes of queries with models (see
+            emmaa.queries.Query.get_hash_with_model).
+        latest_order : Optional[int]
+            Which result to get counting from the latest one. Default: 1
+
+        Returns
+        -------
+        result_hashes : dict
+            A dictionary mapping a tuple (query_hash, mc_type) to a tuple
+            (result_id, result_hash).
+        """
+        if not query_hashes:
+            return {}
+        with self.get_session() as sess:
+            ranked = _rank_results(sess, Result.query_hash.in_(query_hashes))
+            q = (sess.query(Result.id, Result.query_hash, Result.mc_type,
+                            Result.result_hash)
+                 .filter(Result.id == ranked.c.id,
+                         ranked.c.order == latest_order))
+            result_hashes = {(query_hash, mc_type): (result_id, result_hash)
+                             for result_id, query_hash, mc_type, result_hash
+                             in q.all()}
+        return result_hashes
+
+    def get_result_deltas(self, query_hashes):
+        """Find whether the latest results to queries changed in the database.
+
+        The latest result to each query and mc_type is compared with the one
+        before it by their hashes without loading the results. Results are
+        only stored when they change (see
+        emmaa.answer_queries.QueryManager.answer_changed_registered_queries),
+        so a latest result that was checked again after it was stored (its
+        last_checked is later than its date) did not change in the latest
+        check and is reported as unchanged.
+
+        Parameters
+        ----------
+        query_hashes : list[int]
+            The hashes of queries with models (see
+            emmaa.queries.Query.get_hash_with_model).
+
+        Returns
+        -------
+        deltas : dict
+            A dictionary mapping a tuple (query_hash, mc_type) to a tuple
+            (latest_id, previous_id, changed). The previous_id is None for
+            the first result. Results without hashes are reported as changed.
+        """
+        if not query_hashes:
+            return {}
+        with self.get_session() as sess:
+            window = {'partition_by': (Result.query_hash, Result.mc_type),
+                      'order_by': (Result.date.desc(), Result.id.desc())}
+            ranked = (sess.query(
+                        Result.id.label('id'),
+                        Result.query_hash.label('query_hash'),
+                        Result.mc_type.label('mc_type'),
+                        Result.result_hash.label('result_hash'),
+                        Result.date.label('date'),
+                        Result.last_checked.label('last_checked'),
+                        func.row_number().over(**window).label('order'),
+                        func.lead(Result.id).over(**window)
+                        .label('previous_id'),
+                        func.lead(Result.result_hash).over(**window)
+                        .label('previous_hash'))
+                      .filter(Result.query_hash.in_(query_hashes))
+                      .subquery())
+            not_checked_again = or_(
+                ranked.c.last_checked.is_(None),
+                ranked.c.last_checked <= ranked.c.date)
+            changed = or_(
+                ranked.c.result_hash.is_(None),
+                and_(not_checked_again,
+                     or_(ranked.c.previous_hash.is_(None),
+                         ranked.c.result_hash != ranked.c.previous_hash)))
+            q = (sess.query(ranked.c.query_hash, ranked.c.mc_type,
+                            ranked.c.id, ranked.c.previous_id, changed)
+                 .filter(ranked.c.order == 1))
+            deltas = {(query_hash, mc_type): (latest_id, previous_id,
+                                              bool(is_changed))
+                      for query_hash, mc_type, latest_id, previous_id,
+                      is_changed in q.all()}
+        return deltas
+
+    def get_result_jsons(self, result_ids):
+        """Return a dictionary mapping result ids to their result_json."""
+        if not result_ids:
+            return {}
+        with self.get_session() as sess:
+            q = (sess.query(Result.id, Result.result_json)
+                 .filter(Result.id.in_(result_ids)))
+            result_jsons = dict(q.all())
+        return result_jsons
+
+    def update_results_checked(self, result_ids):
+        """Set the last_checked date of the given results to now."""
+        if not result_ids:
+            return
+        with self.get_session() as sess:
+            (sess.query(Result).filter(Result.id.in_(result_ids))
+             .update({Result.last_checked: func.now()},
+                     synchronize_session=False))
+        return
+
     def get_results_from_query(self, query, model_ids, latest_order=1):
         logger.info(f"Got request for results of {query} on {model_ids}.")
         hashes = {query.get_hash_with_model(model_id) for model_id in model_ids}
         with self.get_session() as sess:
-            q = (sess.query(Query.model_id, Query.json, Result.mc_type,
-                            Result.result_json, Result.date)
-                 .filter(Result.query_hash.in_(hashes),
-                         Query.hash == Result.query_hash))
+            ranked = _rank_results(sess, Result.query_hash.in_(hashes))
+            q = _query_ranked_results(sess, ranked, latest_order)
             results = _make_queries_in_results(q.all())
-            results = _weed_results(results, latest_order=latest_order)
         logger.info(f"Found {len(results)} results.")
         return results
 
@@ -307,6 +560,9 @@ class EmmaaDatabaseManager(object):
         ----------
         user_email : str
             The email of a user.
+        latest_order : Optional[int]
+            Which result to get counting from the latest one, e.g., 1 for the
+            latest and 2 for the one before it. Default: 1
 
         Returns
         -------
@@ -317,18 +573,126 @@ class EmmaaDatabaseManager(object):
         """
         logger.info(f"Got request for results for {user_email}")
         with self.get_session() as sess:
-            q = (sess.query(Query.model_id, Query.json, Result.mc_type,
-                            Result.result_json, Result.date)
-                 .filter(Query.hash == Result.query_hash,
-                         Query.hash == UserQuery.query_hash,
-                         UserQuery.user_id == User.id,
-                         UserQuery.subscription,
-                         User.email == user_email))
+            subscribed = (sess.query(UserQuery.query_hash)
+                          .filter(UserQuery.user_id == User.id,
+                                  UserQuery.subscription,
+                                  User.email == user_email))
+            ranked = _rank_results(sess, Result.query_hash.in_(subscribed))
+            q = _query_ranked_results(sess, ranked, latest_order)
             results = _make_queries_in_results(q.all())
-            results = _weed_results(results, latest_order=latest_order)
         logger.info(f"Found {len(results)} results.")
         return results
 
+    def get_subscribed_result_deltas(self, only_changed=False,
+                                     batch_size=100):
+        """Get the latest results of all subscribed queries with their deltas.
+
+        The latest result to each subscribed query and mc_type is compared
+        with the result that was the latest when results were last reported
+        to the user (see update_results_reported) by their hashes in the
+        database. The reported result is only loaded if it is different from
+        the latest one. The results are loaded for a batch of users at a time
+        and no database session is open while they are yielded, so callers
+        can take their time (e.g., to send emails) without holding a
+        connection.
+
+        Parameters
+        ----------
+        only_changed : Optional[bool]
+            If True, only results that changed since they were last reported
+            to the user are returned. Default: False
+        batch_size : Optional[int]
+            The number of users whose results are loaded from the database at
+            a time.
+
+        Returns
+        -------
+        generator of tuple
+            Tuples of the form (user_email, model_id, query, mc_type,
+            result_json, date, previous_result_json, changed) ordered by the
+            user email. The date is the date the result was last checked.
+            previous_result_json is the last reported result or None if no
+            result was reported to the user yet or if the result did not
+            change.
+        """
+        with self.get_session() as sess:
+            user_ids = [user_id for _, user_id in (
+                sess.query(User.email, User.id)
+                .filter(User.id == UserQuery.user_id, UserQuery.subscription)
+                .distinct()
+                .order_by(User.email, User.id))]
+        # Queries are shared between users so they are only made once
+        queries = {}
+        for start in range(0, len(user_ids), batch_size):
+            with self.get_session() as sess:
+                rows = self._get_subscribed_result_deltas(
+                    sess, user_ids[start:start + batch_size], only_changed)
+            for email, model_id, query_hash, query_json, mc_type, \
+                    result_json, date, previous_json, is_changed in rows:
+                if query_hash not in queries:
+                    queries[query_hash] = QueryObject._from_json(query_json)
+                yield (email, model_id, queries[query_hash], mc_type,
+                       result_json, date, previous_json, bool(is_changed))
+
+    def _get_subscribed_result_deltas(self, sess, user_ids, only_changed):
+        # Return the rows of subscribed results with their deltas for users
+        subscribed = (sess.query(UserQuery.query_hash)
+                      .filter(UserQuery.subscription,
+                              UserQuery.user_id.in_(user_ids)))
+        latest = _rank_results(sess, Result.query_hash.in_(subscribed))
+        # The latest result of each subscription when it was reported
+        reported = _rank_reported_results(sess,
+                                          UserQuery.user_id.in_(user_ids))
+        changed = or_(reported.c.id.is_(None),
+                      Result.result_hash.is_(None),
+                      reported.c.result_hash.is_(None),
+                      Result.result_hash != reported.c.result_hash)
+        previous = aliased(Result)
+        q = (sess.query(User.email, Query.model_id, Query.hash, Query.json,
+                        Result.mc_type, Result.result_json,
+                        func.coalesce(Result.last_checked, Result.date),
+                        previous.result_json, changed)
+             .select_from(latest)
+             .join(Result, Result.id == latest.c.id)
+             .join(Query, Query.hash == Result.query_hash)
+             .join(UserQuery, and_(UserQuery.query_hash == Query.hash,
+                                   UserQuery.subscription,
+                                   UserQuery.user_id.in_(user_ids)))
+             .join(User, User.id == UserQuery.user_id)
+             .outerjoin(reported,
+                        and_(reported.c.user_query_id == UserQuery.id,
+                             reported.c.mc_type == Result.mc_type,
+                             reported.c.order == 1))
+             .outerjoin(previous, and_(previous.id == reported.c.id,
+                                       changed))
+             .filter(latest.c.order == 1))
+        if only_changed:
+            q = q.filter(changed)
+        return (q.order_by(User.email, Query.model_id, Result.query_hash,
+                           Result.mc_type)
+                .all())
+
+    def update_results_reported(self, user_email, date):
+        """Record the date up to which results were reported to a user.
+
+        Results to the subscribed queries of the user stored up to this date
+        are compared with later results in get_subscribed_result_deltas.
+
+        Parameters
+        ----------
+        user_email : str
+            The email of the user.
+        date : datetime.datetime
+            The latest date of the reported results.
+        """
+        with self.get_session() as sess:
+            user_ids = sess.query(User.id).filter(User.email == user_email)
+            (sess.query(UserQuery)
+             .filter(UserQuery.user_id.in_(user_ids), UserQuery.subscription)
+             .update({UserQuery.last_reported: date},
+                     synchronize_session=False))
+        return
+
     def get_users(self, query, model_id):
         logger.info(f"Got request for users for {query} in {model_id}.")
         with self.get_session() as sess:
@@ -339,16 +703,50 @@ class EmmaaDatabaseManager(object):
         return users
 
 
-def _weed_results(result_iter, latest_order=1):
-    # Each element of result_iter: (model_id, query(object), result_json, date)
-    result_dict = defaultdict(list)
-    for res in result_iter:
-        result_dict[(res[1].get_hash_with_model(res[0]), res[2])].append(
-            tuple(res))
-    sorted_results = [sorted(res_list, key=lambda r: r[-1])
-                      for res_list in result_dict.values()]
-    results = [result[-latest_order] for result in sorted_results]
-    return results
+def _rank_results(sess, *filters):
+    # Return a subquery of the ids of the results matching the filters with
+    # their order counting from the latest result for each query and mc_type
+    return (sess.query(
+                Result.id.label('id'),
+                func.row_number().over(
+                    partition_by=(Result.query_hash, Result.mc_type),
+                    order_by=(Result.date.desc(), Result.id.desc())
+                ).label('order'))
+            .filter(*filters)
+            .subquery())
+
+
+def _rank_reported_results(sess, *filters):
+    # Return a subquery of the results to subscribed user queries matching
+    # the filters that are at most as recent as the last report to the user,
+    # with their order counting from the latest one for each user query and
+    # mc_type. The result with order 1 is the one that was last reported.
+    return (sess.query(
+                UserQuery.id.label('user_query_id'),
+                Result.mc_type.label('mc_type'),
+                Result.id.label('id'),
+                Result.result_hash.label('result_hash'),
+                func.row_number().over(
+                    partition_by=(UserQuery.id, Result.mc_type),
+                    order_by=(Result.date.desc(), Result.id.desc())
+                ).label('order'))
+            .filter(UserQuery.subscription,
+                    Result.query_hash == UserQuery.query_hash,
+                    Result.date <= UserQuery.last_reported,
+                    *filters)
+            .subquery())
+
+
+def _query_ranked_results(sess, ranked, latest_order):
+    # Get the results with a given order from a subquery of ranked results.
+    # The date of a result is the date it was last checked.
+    return (sess.query(Query.model_id, Query.json, Result.mc_type,
+                       Result.result_json,
+                       func.coalesce(Result.last_checked, Result.date))
+            .filter(Result.id == ranked.c.id,
+                    ranked.c.order == latest_order,
+                    Query.hash == Result.query_hash)
+            .order_by(Result.query_hash, Result.mc_type))
 
 
 def _make_queries_in_results(result_iter):
@@ -383,6 +781,18 @@ def hash_query(query_json, model_id):
     return fnv1a_32(unique_string.encode('utf-8'))
 
 
+def hash_result_json(result_json):
+    """Return a hash of a result that changes only if the result changes.
+
+    Results are dictionaries keyed by the hashes of their responses (see
+    emmaa.model_tests.ModelManager.hash_response_list), so two results are
+    the same if their keys are. Keys are compared as strings as they are
+    stored in the database.
+    """
+    keys = sorted(str(key) for key in result_json.keys())
+    return fnv1a_32(','.join(keys).encode('utf-8'))
+
+
 def update_subscription(user_query, new_sub_status):
     """Update a UserQuery object's subscription status
 
@@ -0,0 +1,220 @@
+"""Schema migrations and retention of the history of query results.
+
+The migrations bring an existing PostgreSQL database up to date with the
+schema (indexes, constraints and columns added after the tables were
+created) and can be applied repeatedly. The retention functions keep the
+result table small by moving old results to the result_archive table and by
+removing results that did not change since the previous result to the same
+query.
+"""
+__all__ = ['migrate', 'backfill_result_hashes', 'archive_results',
+           'compact_results']
+
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import text, select, case
+
+from .schema import Result, ResultArchive
+from .manager import _rank_results, _rank_reported_results, \
+    hash_result_json
+
+logger = logging.getLogger(__name__)
+
+
+# Each migration is a name and a list of idempotent PostgreSQL statements
+MIGRATIONS = [
+    ('result-last-checked', [
+        'ALTER TABLE result ADD COLUMN IF NOT EXISTS last_checked '
+        'TIMESTAMP WITHOUT TIME ZONE DEFAULT now()']),
+    ('result-hash', [
+        'ALTER TABLE result ADD COLUMN IF NOT EXISTS result_hash BIGINT',
+        'ALTER TABLE result_archive ADD COLUMN IF NOT EXISTS '
+        'result_hash BIGINT']),
+    ('result-query-mc-type-date', [
+        'CREATE INDEX IF NOT EXISTS "result-query-mc-type-date" '
+        'ON result (query_hash, mc_type, date)']),
+    # Merge duplicate user queries into the oldest one before they are made
+    # unique. Anonymous queries (NULL user_id) are not unique.
+    ('user-query-uniqueness', [
+        'UPDATE user_query SET count = agg.total, '
+        'subscription = agg.subscription '
+        'FROM (SELECT min(id) AS id, sum(count) AS total, '
+        'bool_or(subscription) AS subscription FROM user_query '
+        'WHERE user_id IS NOT NULL GROUP BY user_id, query_hash '
+        'HAVING count(*) > 1) AS agg WHERE user_query.id = agg.id',
+        'DELETE FROM user_query USING user_query AS other '
+        'WHERE user_query.user_id = other.user_id '
+        'AND user_query.query_hash = other.query_hash '
+        'AND user_query.id > other.id',
+        'CREATE UNIQUE INDEX IF NOT EXISTS "user-query-uniqueness" '
+        'ON user_query (user_id, query_hash)']),
+    ('user-query-last-reported', [
+        'ALTER TABLE user_query ADD COLUMN IF NOT EXISTS last_reported '
+        'TIMESTAMP WITHOUT TIME ZONE']),
+]
+
+ARCHIVE_COLUMNS = ['id', 'query_hash', 'date', 'result_json', 'mc_type',
+                   'last_checked', 'result_hash']
+
+
+def migrate(db):
+    """Create missing tables and apply all migrations to a database.
+
+    Hashes of results stored before the result_hash column was added are
+    filled in after the migrations.
+
+    Parameters
+    ----------
+    db : emmaa.db.manager.EmmaaDatabaseManager
+        The database to migrate.
+    """
+    db.create_tables()
+    if db.engine.dialect.name != 'postgresql':
+        logger.warning(f'Migrations are only defined for PostgreSQL, not '
+                       f'{db.engine.dialect.name}.')
+        return
+    with db.get_session() as sess:
+        for name, statements in MIGRATIONS:
+            logger.info(f'Applying migration {name}.')
+            for statement in statements:
+                sess.execute(text(statement))
+    backfill_result_hashes(db)
+
+
+def backfill_result_hashes(db, batch_size=1000):
+    """Set the result_hash of results that do not have one.
+
+    Parameters
+    ----------
+    db : emmaa.db.manager.EmmaaDatabaseManager
+        The database to update.
+    batch_size : Optional[int]
+        The number of results to update at a time.
+
+    Returns
+    -------
+    int
+        The number of updated results.
+    """
+    total = 0
+    while True:
+        with db.get_session() as sess:
+            q = (sess.query(Result.id, Result.result_json)
+                 .filter(Result.result_hash.is_(None))
+                 .limit(batch_size))
+            updates = [{'id': result_id,
+                        'result_hash': hash_result_json(result_json)}
+                       for result_id, result_json in q.all()]
+            sess.bulk_update_mappings(Result, updates)
+        total += len(updates)
+        if len(updates) < batch_size:
+            break
+    logger.info(f'Set the hash of {total} results.')
+    return total
+
+
+def archive_results(db, days=90):
+    """Move results older than a number of days to the archive table.
+
+    The latest result to each query and mc_type is always kept in the result
+    table regardless of its age. So is the result that was last reported to
+    each subscriber of a query, as the next report is compared to it.
+
+    Parameters
+    ----------
+    db : emmaa.db.manager.EmmaaDatabaseManager
+        The database to archive results in.
+    days : Optional[int]
+        The age in days of the results to archive. Default: 90
+
+    Returns
+    -------
+    int
+        The number of archived results.
+    """
+    before = datetime.now() - timedelta(days=days)
+    with db.get_session() as sess:
+        ranked = _rank_results(sess)
+        reported = _rank_reported_results(sess)
+        reported_ids = (sess.query(reported.c.id)
+                        .filter(reported.c.order == 1))
+        ids = [result_id for result_id, in sess.query(Result.id).filter(
+            Result.id == ranked.c.id, ranked.c.order > 1,
+            Result.date < before, Result.id.notin_(reported_ids))]
+        _move_to_archive(sess, ids)
+    logger.info(f'Archived {len(ids)} results older than {before}.')
+    return len(ids)
+
+
+def compact_results(db, archive=True, batch_size=1000):
+    """Remove results that are the same as the previous result to a query.
+
+    Only the first of consecutive identical results to a query and mc_type
+    (see emmaa.db.manager.hash_result_json) is kept and its last_checked
+    date is set to the date of the last one. Results are compared by their
+    result_hash and the result_json is only loaded for results without one.
+
+    Parameters
+    ----------
+    db : emmaa.db.manager.EmmaaDatabaseManager
+        The database to compact results in.
+    archive : Optional[bool]
+        If True, the removed results are moved to the archive table,
+        otherwise they are deleted. Default: True
+    batch_size : Optional[int]
+        The number of results to load from the database at a time.
+
+    Returns
+    -------
+    int
+        The number of removed results.
+    """
+    redundant_ids = []
+    last_checked = {}
+    with db.get_session() as sess:
+        missing_json = case([(Result.result_hash.is_(None),
+                              Result.result_json)])
+        q = (sess.query(Result.id, Result.query_hash, Result.mc_type,
+                        Result.result_hash, missing_json, Result.date,
+                        Result.last_checked)
+             .order_by(Result.query_hash, Result.mc_type, Result.date,
+                       Result.id)
+             .yield_per(batch_size))
+        prev_key = prev_hash = kept_id = None
+        for result_id, query_hash, mc_type, result_hash, result_json, date, \
+                checked in q:
+            key = (query_hash, mc_type)
+            if result_hash is None:
+                result_hash = hash_result_json(result_json)
+            if key == prev_key and result_hash == prev_hash:
+                redundant_ids.append(result_id)
+                last_checked[kept_id] = checked or date
+            else:
+                prev_key, prev_hash, kept_id = key, result_hash, result_id
+        for start in range(0, len(redundant_ids), batch_size):
+            ids = redundant_ids[start:start + batch_size]
+            if archive:
+                _move_to_archive(sess, ids)
+            else:
+                (sess.query(Result).filter(Result.id.in_(ids))
+                 .delete(synchronize_session=False))
+        sess.bulk_update_mappings(
+            Result, [{'id': result_id, 'last_checked': checked}
+                     for result_id, checked in last_checked.items()])
+    logger.info(f'Removed {len(redundant_ids)} unchanged results.')
+    return len(redundant_ids)
+
+
+def _move_to_archive(sess, ids):
+    # Copy the results with the given ids to the archive and delete them
+    if not ids:
+        return
+    result_table = Result.__table__
+    sess.execute(
+        ResultArchive.__table__.insert().from_select(
+            ARCHIVE_COLUMNS,
+            select([result_table.c[col] for col in ARCHIVE_COLUMNS])
+            .where(result_table.c.id.in_(ids))))
+    (sess.query(Result).filter(Result.id.in_(ids))
+     .delete(synchronize_session=False))
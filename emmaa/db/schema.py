@@ -1,10 +1,10 @@
-__all__ = ['User', 'Query', 'UserQuery', 'Result']
+__all__ = ['User', 'Query', 'UserQuery', 'Result', 'ResultArchive']
 
 import logging
 
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, Integer, String, UniqueConstraint, ForeignKey, \
-    Boolean, DateTime, func, BigInteger
+    Boolean, DateTime, func, BigInteger, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.dialects.postgresql import JSONB
 
@@ -107,6 +107,9 @@ class UserQuery(Base, EmmaaTable):
     count : int
         Record the number of times the user associated with user id has done
         this query
+    last_reported : datetime
+        The date up to which the results to this query were reported to the
+        user. Results stored after it are new to the user.
     """
     __tablename__ = 'user_query'
     id = Column(Integer, primary_key=True)
@@ -117,6 +120,11 @@ class UserQuery(Base, EmmaaTable):
     date = Column(DateTime, default=func.now())
     subscription = Column(Boolean, nullable=False)
     count = Column(Integer, nullable=False)
+    last_reported = Column(DateTime)
+    __table_args__ = (
+        UniqueConstraint('user_id', 'query_hash',
+                         name='user-query-uniqueness'),
+        )
 
 
 class Result(Base, EmmaaTable):
@@ -137,6 +145,12 @@ class Result(Base, EmmaaTable):
         A json dict containing the results for the query.
     mc_type : str
         A name of a ModelChecker used to answer the query.
+    last_checked : datetime
+        (auto) The date the query was last answered with this result. This is
+        updated instead of adding a new row when the result did not change.
+    result_hash : big-int
+        A hash of the result_json which is the same for results that are the
+        same (see emmaa.db.manager.hash_result_json).
     """
     __tablename__ = 'result'
     id = Column(Integer, primary_key=True)
@@ -145,3 +159,46 @@ class Result(Base, EmmaaTable):
     date = Column(DateTime, default=func.now())
     result_json = Column(JSONB, nullable=False)
     mc_type = Column(String(20), default='pysb')
+    last_checked = Column(DateTime, default=func.now())
+    result_hash = Column(BigInteger)
+    __table_args__ = (
+        Index('result-query-mc-type-date', 'query_hash', 'mc_type', 'date'),
+        )
+
+
+class ResultArchive(Base, EmmaaTable):
+    """Old results moved out of the result table:
+
+    ``ResultArchive(_id_, query_hash, date, result_json, mc_type,
+    last_checked, archived)``
+
+    Parameters
+    ----------
+    id : int
+        (primary key) The id the result had in the result table.
+    query_hash : big-int
+        (foreign key -> Query.hash) The hash of the query json, which can be
+        directly generated.
+    date : datetime
+        The date the result was entered into the result table.
+    result_json : json
+        A json dict containing the results for the query.
+    mc_type : str
+        A name of a ModelChecker used to answer the query.
+    last_checked : datetime
+        The date the query was last answered with this result.
+    result_hash : big-int
+        A hash of the result_json (see emmaa.db.manager.hash_result_json).
+    archived : datetime
+        (auto) The date the result was moved to the archive.
+    """
+    __tablename__ = 'result_archive'
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    query_hash = Column(BigInteger, ForeignKey('query.hash'), nullable=False)
+    query = relationship(Query)
+    date = Column(DateTime)
+    result_json = Column(JSONB, nullable=False)
+    mc_type = Column(String(20), default='pysb')
+    last_checked = Column(DateTime)
+    result_hash = Column(BigInteger)
+    archived = Column(DateTime, default=func.now())
@@ -3,24 +3,12 @@ import time
 import pickle
 import logging
 import datetime
-from indra.databases import ndex_client
-import indra.tools.assemble_corpus as ac
-from indra.literature import pubmed_client, elsevier_client
-from indra.assemblers.cx import CxAssembler
-from indra.assemblers.pysb import PysbAssembler
-from indra.assemblers.pybel import PybelAssembler
-from indra.assemblers.indranet import IndraNetAssembler
-from indra.mechlinker import MechLinker
-from indra.preassembler.hierarchy_manager import get_wm_hierarchies
-from indra.preassembler import Preassembler
-from indra.belief.wm_scorer import get_eidos_scorer
 from indra.statements import Event, Association
 from emmaa.priors import SearchTerm
-from emmaa.readers.aws_reader import read_pmid_search_terms
-from emmaa.readers.db_client_reader import read_db_pmid_search_terms
-from emmaa.readers.elsevier_eidos_reader import \
-    read_elsevier_eidos_search_terms
 from emmaa.util import make_date_str, find_latest_s3_file, get_s3_client
+# NOTE: assemblers, readers and literature clients are imported in the
+# methods using them since importing them is slow and most code using this
+# module (e.g., the API, loading configs) does not need them.
 
 
 logger = logging.getLogger(__name__)
@@ -151,6 +139,7 @@ class EmmaaModel(object):
             A dict representing given search terms as keys and PMIDs returned
             by searches as values.
         """
+        from indra.literature import pubmed_client
         terms_to_pmids = {}
         for term in search_terms:
             pmids = pubmed_client.get_ids(term.search_term, reldate=date_limit)
@@ -176,6 +165,7 @@ class EmmaaModel(object):
             A dict representing given search terms as keys and PIIs returned
             by searches as values.
         """
+        from indra.literature import elsevier_client
         start_date = (
             datetime.datetime.utcnow() - datetime.timedelta(days=date_limit))
         start_date = start_date.isoformat(timespec='seconds') + 'Z'
@@ -194,10 +184,15 @@ class EmmaaModel(object):
         reader = self.reading_config.get('reader', 'indra_db')
         ids_to_terms = self.search_literature(date_limit=date_limit)
         if reader == 'aws':
+            from emmaa.readers.aws_reader import read_pmid_search_terms
             estmts = read_pmid_search_terms(ids_to_terms)
         elif reader == 'indra_db':
+            from emmaa.readers.db_client_reader import \
+                read_db_pmid_search_terms
             estmts = read_db_pmid_search_terms(ids_to_terms)
         elif reader == 'elsevier_eidos':
+            from emmaa.readers.elsevier_eidos_reader import \
+                read_elsevier_eidos_search_terms
             estmts = read_elsevier_eidos_search_terms(ids_to_terms)
         else:
             raise ValueError('Unknown reader: %s' % reader)
@@ -223,6 +218,7 @@ class EmmaaModel(object):
 
     def run_assembly(self):
         """Run INDRA's assembly pipeline on the Statements."""
+        import indra.tools.assemble_corpus as ac
         self.eliminate_copies()
         stmts = self.get_indra_stmts()
         stmts = self.filter_event_association(stmts)
@@ -249,6 +245,9 @@ class EmmaaModel(object):
         # Use WM hierarchies and belief scorer for WM preassembly
         preassembly_mode = self.assembly_config.get('preassembly_mode')
         if preassembly_mode == 'wm':
+            from indra.preassembler.hierarchy_manager import \
+                get_wm_hierarchies
+            from indra.belief.wm_scorer import get_eidos_scorer
             hierarchies = get_wm_hierarchies()
             belief_scorer = get_eidos_scorer()
             stmts = ac.run_preassembly(
@@ -268,6 +267,7 @@ class EmmaaModel(object):
             stmts = ac.filter_transcription_factor(stmts)
 
         if self.assembly_config.get('mechanism_linking'):
+            from indra.mechlinker import MechLinker
             ml = MechLinker(stmts)
             ml.gather_explicit_activities()
             ml.reduce_activities()
@@ -307,6 +307,8 @@ class EmmaaModel(object):
 
     def update_to_ndex(self):
         """Update assembled model as CX on NDEx, updates existing network."""
+        from indra.databases import ndex_client
+        from indra.assemblers.cx import CxAssembler
         if not self.assembled_stmts:
             self.run_assembly()
         cxa = CxAssembler(self.assembled_stmts, network_name=self.name)
@@ -316,6 +318,7 @@ class EmmaaModel(object):
 
     def upload_to_ndex(self):
         """Upload the assembled model as CX to NDEx, creates new network."""
+        from indra.assemblers.cx import CxAssembler
         if not self.assembled_stmts:
             self.run_assembly()
         cxa = CxAssembler(self.assembled_stmts, network_name=self.name)
@@ -379,6 +382,7 @@ class EmmaaModel(object):
 
     def assemble_pysb(self):
         """Assemble the model into PySB and return the assembled model."""
+        from indra.assemblers.pysb import PysbAssembler
         if not self.assembled_stmts:
             self.run_assembly()
         pa = PysbAssembler()
@@ -388,6 +392,7 @@ class EmmaaModel(object):
 
     def assemble_pybel(self):
         """Assemble the model into PyBEL and return the assembled model."""
+        from indra.assemblers.pybel import PybelAssembler
         if not self.assembled_stmts:
             self.run_assembly()
         pba = PybelAssembler(self.assembled_stmts)
@@ -396,6 +401,7 @@ class EmmaaModel(object):
 
     def assemble_signed_graph(self):
         """Assemble the model into signed graph and return the assembled graph."""
+        from indra.assemblers.indranet import IndraNetAssembler
         if not self.assembled_stmts:
             self.run_assembly()
         ia = IndraNetAssembler(self.assembled_stmts)
@@ -404,6 +410,7 @@ class EmmaaModel(object):
 
     def assemble_unsigned_graph(self):
         """Assemble the model into unsigned graph and return the assembled graph."""
+        from indra.assemblers.indranet import IndraNetAssembler
         if not self.assembled_stmts:
             self.run_assembly()
         ia = IndraNetAssembler(self.assembled_stmts)
@@ -1,15 +1,16 @@
 """This module implements the object model for EMMAA model testing."""
+import os
 import json
 import boto3
 import pickle
 import logging
 import datetime
+import threading
 import itertools
 import jsonpickle
+import networkx as nx
 from collections import defaultdict
 from fnvhash import fnv1a_32
-from indra.explanation.model_checker import PysbModelChecker, \
-    PybelModelChecker, SignedGraphModelChecker, UnsignedGraphModelChecker
 from indra.explanation.reporting import stmts_from_pysb_path, \
     stmts_from_pybel_path, stmts_from_indranet_path
 from indra.assemblers.english.assembler import EnglishAssembler
@@ -18,8 +19,9 @@ from indra.statements import Statement, Agent, Concept, Event
 from indra.util.statement_presentation import group_and_sort_statements
 from emmaa.model import EmmaaModel
 from emmaa.util import make_date_str, get_s3_client, get_class_from_name
-from emmaa.analyze_tests_results import TestRound, StatsGenerator
-from emmaa.answer_queries import QueryManager
+from emmaa.analyze_tests_results import TestRound, StatsGenerator, \
+    update_test_history_on_s3
+from emmaa.answer_queries import QueryManager, _after_fork_objects
 
 
 logger = logging.getLogger(__name__)
@@ -39,6 +41,12 @@ RESULT_CODES = {
     'MAX_PATHS_ZERO': 'Path found but not reconstructed',
     'QUERY_NOT_APPLICABLE': 'Query is not applicable for this model'
 }
+# The ReachabilityIndex needs memory quadratic in the number of nodes of the
+# graph, so it is only built for graphs with at most this many nodes.
+REACHABILITY_INDEX_MAX_NODES = int(os.environ.get(
+    'EMMAA_REACHABILITY_INDEX_MAX_NODES', 20000))
+# Creating the lock of a ModelManager on first use has to be atomic.
+_mc_lock_creation_lock = threading.Lock()
 ARROW_DICT = {'Complex': u"\u2194",
               'Inhibition': u"\u22A3",
               'DecreaseAmount': u"\u22A3"}
@@ -60,7 +68,9 @@ class ModelManager(object):
     mc_types : dict
         A dictionary in which each key is a type of a ModelChecker and value is
         a dictionary containing an instance of a model, an instance of a
-        ModelChecker and a list of test results.
+        ModelChecker and a list of test results. For graph based
+        ModelCheckers it also contains a ReachabilityIndex of the graph
+        once it is built by get_reachability_index.
     entities : list[indra.statements.agent.Agent]
         A list of entities of EMMAA model.
     applicable_tests : list[emmaa.model_tests.EmmaaTest]
@@ -69,6 +79,11 @@ class ModelManager(object):
         Whether to include links to INDRA db in test results.
     """
     def __init__(self, model):
+        # Model checkers are imported here because importing them (and the
+        # assemblers they depend on) is slow.
+        from indra.explanation.model_checker import PysbModelChecker, \
+            PybelModelChecker, SignedGraphModelChecker, \
+            UnsignedGraphModelChecker
         self.model = model
         self.mc_mapping = {
             'pysb': (self.model.assemble_pysb, PysbModelChecker,
@@ -93,6 +108,55 @@ class ModelManager(object):
         self.applicable_tests = []
         self.make_links = model.test_config.get('make_links', True)
 
+    def __getstate__(self):
+        # The ReachabilityIndex is not pickled with the ModelManager, it is
+        # rebuilt by get_reachability_index when it is needed. Locks cannot
+        # be pickled and are created again on first use.
+        state = self.__dict__.copy()
+        state.pop('_mc_lock', None)
+        state['mc_types'] = {
+            mc_type: {key: value for key, value in mc_dict.items()
+                      if key != 'reachability'}
+            for mc_type, mc_dict in self.mc_types.items()}
+        return state
+
+    def get_reachability_index(self, mc_type):
+        """Return the ReachabilityIndex of the graph of a ModelChecker.
+
+        The index is built on first use. None is returned for ModelCheckers
+        that are not graph based and for graphs with more nodes than
+        REACHABILITY_INDEX_MAX_NODES.
+        """
+        if mc_type not in ('signed_graph', 'unsigned_graph'):
+            return None
+        mc_dict = self.mc_types[mc_type]
+        if 'reachability' not in mc_dict:
+            graph = mc_dict['model_checker'].get_graph()
+            if graph.number_of_nodes() > REACHABILITY_INDEX_MAX_NODES:
+                logger.info(f'Not building a ReachabilityIndex for a graph '
+                            f'with {graph.number_of_nodes()} nodes.')
+                mc_dict['reachability'] = None
+            else:
+                mc_dict['reachability'] = ReachabilityIndex(graph)
+        return mc_dict['reachability']
+
+    def get_mc_lock(self):
+        """Return the lock to hold while updating and using ModelCheckers.
+
+        get_updated_mc changes the ModelCheckers of the ModelManager in
+        place, so threads answering queries on the same ModelManager have to
+        hold this lock from updating a ModelChecker until they are done
+        checking statements with it.
+        """
+        with _mc_lock_creation_lock:
+            if self.__dict__.get('_mc_lock') is None:
+                self._mc_lock = threading.RLock()
+                _after_fork_objects.add(self)
+            return self._mc_lock
+
+    def _reset_after_fork(self):
+        self._mc_lock = threading.RLock()
+
     def get_updated_mc(self, mc_type, stmts):
         """Update the ModelChecker and graph with stmts for tests/queries."""
         mc = self.mc_types[mc_type]['model_checker']
@@ -118,14 +182,101 @@ class ModelManager(object):
 
     def run_tests_per_mc(self, mc_type, max_path_length, max_paths):
         """Run all applicable tests with one ModelChecker."""
-        mc = self.get_updated_mc(
-            mc_type, [test.stmt for test in self.applicable_tests])
-        logger.info(f'Running the tests with {mc_type} ModelChecker.')
-        results = mc.check_model(
-            max_path_length=max_path_length, max_paths=max_paths)
-        for (stmt, result) in results:
+        with self.get_mc_lock():
+            mc = self.get_updated_mc(
+                mc_type, [test.stmt for test in self.applicable_tests])
+            logger.info(f'Running the tests with {mc_type} ModelChecker.')
+            results = self.check_statements(
+                mc_type, mc, max_path_length=max_path_length,
+                max_paths=max_paths)
+        for result in results:
             self.add_result(mc_type, result)
 
+    def check_statements(self, mc_type, mc, max_path_length=5, max_paths=1):
+        """Check all statements of a ModelChecker and return the results.
+
+        For graph based ModelCheckers the statements are grouped by their
+        source node and one search is done per source node (or the
+        ReachabilityIndex of the graph is used) to find the statements whose
+        target is not reachable, so only the statements with a reachable
+        target are checked one by one. The results are identical
+        to the ones from ModelChecker.check_model. This can be disabled by
+        setting batch_path_search to False in the test config of the model.
+
+        Parameters
+        ----------
+        mc_type : str
+            The type of the ModelChecker.
+        mc : indra.explanation.model_checker.ModelChecker
+            The ModelChecker with the statements to check.
+        max_path_length : Optional[int]
+            The maximum length of paths to return. Default: 5
+        max_paths : Optional[int]
+            The maximum number of paths to return per statement. Default: 1
+
+        Returns
+        -------
+        results : list[indra.explanation.model_checker.PathResult]
+            A list of results in the order of the statements of the
+            ModelChecker.
+        """
+        if mc_type not in ('signed_graph', 'unsigned_graph') or \
+                not self.model.test_config.get('batch_path_search', True):
+            return [self.check_statement(mc_type, mc, stmt, max_path_length,
+                                         max_paths)
+                    for stmt in mc.statements]
+        graph = mc.get_graph()
+        results = [None] * len(mc.statements)
+        stmts_by_source = defaultdict(list)
+        for ix, stmt in enumerate(mc.statements):
+            subj_list, obj_list, result_code = mc.process_statement(stmt)
+            if result_code:
+                results[ix] = mc.make_false_result(
+                    result_code, max_paths, max_path_length)
+            else:
+                # Graph based ModelCheckers have one source and one target
+                stmts_by_source[subj_list[0]].append((ix, obj_list[0]))
+        logger.info(f'Checking {len(mc.statements)} statements from '
+                    f'{len(stmts_by_source)} sources.')
+        index = self.get_reachability_index(mc_type)
+        for source, targets in stmts_by_source.items():
+            if index is None:
+                reachable = nx.single_source_shortest_path_length(
+                    graph, source)
+            for ix, target in targets:
+                if index is not None:
+                    no_path = not index.has_path(source, target)
+                else:
+                    # A path from a node to itself has to go through a
+                    # cycle, which the search above does not tell us about
+                    no_path = target != source and target not in reachable
+                if no_path:
+                    results[ix] = mc.make_false_result(
+                        'NO_PATHS_FOUND', max_paths, max_path_length)
+                else:
+                    results[ix] = mc.check_statement(
+                        mc.statements[ix], max_paths, max_path_length)
+        return results
+
+    def check_statement(self, mc_type, mc, stmt, max_path_length=5,
+                        max_paths=1):
+        """Check a statement, using the ReachabilityIndex if available.
+
+        A statement for which the index shows that there is no path between
+        its subject and object gets a NO_PATHS_FOUND result without path
+        search, other statements are checked by the ModelChecker.
+        """
+        index = self.get_reachability_index(mc_type)
+        if index is not None:
+            mc.get_graph()
+            subj_list, obj_list, result_code = mc.process_statement(stmt)
+            if not result_code and not any(
+                    index.has_path(subj, obj) for subj, obj
+                    in itertools.product(subj_list, obj_list)):
+                return mc.make_false_result(
+                    'NO_PATHS_FOUND', max_paths, max_path_length)
+        return mc.check_statement(stmt, max_paths, max_path_length)
+
     def make_english_path(self, mc_type, result):
         """Create an English description of a path."""
         paths = []
@@ -257,11 +408,13 @@ class ModelManager(object):
         """Answer user query with a path if it is found."""
         if ScopeTestConnector.applicable(self, query):
             results = []
+            max_path_length, max_paths = self._get_test_configs()
             for mc_type in self.mc_types:
-                mc = self.get_updated_mc(mc_type, [query.path_stmt])
-                max_path_length, max_paths = self._get_test_configs()
-                result = mc.check_statement(
-                    query.path_stmt, max_paths, max_path_length)
+                with self.get_mc_lock():
+                    mc = self.get_updated_mc(mc_type, [query.path_stmt])
+                    result = self.check_statement(
+                        mc_type, mc, query.path_stmt, max_path_length,
+                        max_paths)
                 results.append((mc_type, self.process_response(mc_type, result)))
             return results
         else:
@@ -297,9 +450,10 @@ class ModelManager(object):
         # Only do the following steps if there are applicable queries
         if applicable_queries:
             for mc_type in self.mc_types:
-                mc = self.get_updated_mc(mc_type, applicable_stmts)
-                results = mc.check_model()
-                for ix, (_, result) in enumerate(results):
+                with self.get_mc_lock():
+                    mc = self.get_updated_mc(mc_type, applicable_stmts)
+                    results = self.check_statements(mc_type, mc)
+                for ix, result in enumerate(results):
                     responses.append(
                         (applicable_queries[ix], mc_type,
                          self.process_response(mc_type, result)))
@@ -358,14 +512,18 @@ class ModelManager(object):
         """Put test results to json format."""
         pickler = jsonpickle.pickler.Pickler()
         results_json = []
+        # The statement JSONs contain their matches_hash, so the results can
+        # be compared without deserializing statements
         results_json.append({
             'model_name': self.model.name,
             'statements': self.assembled_stmts_to_json(),
             'mc_types': [mc_type for mc_type in self.mc_types.keys()],
             'make_links': self.make_links})
         for ix, test in enumerate(self.applicable_tests):
+            test_json = test.to_json()
             test_ix_results = {'test_type': test.__class__.__name__,
-                               'test_json': test.to_json()}
+                               'test_json': test_json,
+                               'test_hash': test_json['matches_hash']}
             for mc_type in self.mc_types:
                 result = self.mc_types[mc_type]['test_results'][ix]
                 test_ix_results[mc_type] = {
@@ -376,6 +534,51 @@ class ModelManager(object):
         return results_json
 
 
+class ReachabilityIndex(object):
+    """Answers whether there is any path between two nodes of a graph.
+
+    The strongly connected components of the graph are condensed into a
+    directed acyclic graph and the set of components reachable from each
+    component is stored as a bitset (a Python int), so a lookup takes
+    constant time independently of the size of the graph.
+
+    Parameters
+    ----------
+    graph : networkx.DiGraph
+        The graph to index.
+
+    Attributes
+    ----------
+    components : dict
+        A dictionary mapping a node to the index of its component.
+    descendants : list[int]
+        A list of bitsets of the components reachable from each component
+        with a path of length at least one.
+    """
+    def __init__(self, graph):
+        condensed = nx.condensation(graph)
+        self.components = condensed.graph['mapping']
+        self.descendants = [0] * condensed.number_of_nodes()
+        for comp in reversed(list(nx.topological_sort(condensed))):
+            members = condensed.nodes[comp]['members']
+            # A component reaches itself if it has a cycle
+            if len(members) > 1 or any(graph.has_edge(node, node)
+                                       for node in members):
+                self.descendants[comp] |= 1 << comp
+            for succ in condensed.successors(comp):
+                self.descendants[comp] |= \
+                    (1 << succ) | self.descendants[succ]
+
+    def has_path(self, source, target):
+        """Return True if there is a path from source to target."""
+        try:
+            source_comp = self.components[source]
+            target_comp = self.components[target]
+        except KeyError:
+            return False
+        return bool(self.descendants[source_comp] >> target_comp & 1)
+
+
 class TestManager(object):
     """Manager to generate and run a set of tests on a set of models.
 
@@ -523,7 +726,8 @@ def save_model_manager_to_s3(model_name, model_manager):
 
 def run_model_tests_from_s3(model_name, upload_mm=True,
                             upload_results=True, upload_stats=True,
-                            registered_queries=True, db=None):
+                            registered_queries=True, db=None,
+                            only_changed_queries=False):
     """Run a given set of tests on a given model, both loaded from S3.
 
     After loading both the model and the set of tests, model/test overlap
@@ -548,6 +752,9 @@ def run_model_tests_from_s3(model_name, upload_mm=True,
         executed, the results are then saved to the database. Default: True
     db : Optional[emmaa.db.manager.EmmaaDatabaseManager]
         If given over-rides the default primary database.
+    only_changed_queries : Optional[bool]
+        If True, only the results of registered queries that changed since
+        they were last answered are saved to the database. Default: False
 
     Returns
     -------
@@ -569,6 +776,7 @@ def run_model_tests_from_s3(model_name, upload_mm=True,
     results_json_dict = mm.results_to_json()
     results_json_str = json.dumps(results_json_dict, indent=1)
     # Optionally upload test results to S3
+    date_str = None
     if upload_results:
         client = get_s3_client(unsigned=False)
         date_str = make_date_str()
@@ -577,7 +785,10 @@ def run_model_tests_from_s3(model_name, upload_mm=True,
         client.put_object(Bucket='emmaa', Key=result_key,
                           Body=results_json_str.encode('utf8'))
     tr = TestRound(results_json_dict)
-    sg = StatsGenerator(model_name, latest_round=tr)
+    if upload_results:
+        update_test_history_on_s3(model_name, tr, date_str)
+    sg = StatsGenerator(model_name, latest_round=tr,
+                        latest_round_date=date_str)
     sg.make_stats()
 
     # Optionally upload statistics to S3
@@ -585,5 +796,8 @@ def run_model_tests_from_s3(model_name, upload_mm=True,
         sg.save_to_s3()
     if registered_queries:
         qm = QueryManager(db=db, model_managers=[mm])
-        qm.answer_registered_queries(model_name)
+        if only_changed_queries:
+            qm.answer_changed_registered_queries(model_name)
+        else:
+            qm.answer_registered_queries(model_name)
     return (mm, sg)
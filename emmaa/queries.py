@@ -4,10 +4,6 @@ from collections import OrderedDict as _o
 from .util import get_class_from_name
 from indra.statements.statements import Statement, Agent, get_all_descendants,\
     mk_str, make_hash
-from indra.databases.hgnc_client import get_hgnc_id
-from indra.databases.chebi_client import get_chebi_id_from_name
-from indra.databases.mesh_client import get_mesh_id_name
-from indra.preassembler.grounding_mapper import gm
 
 
 class Query(object):
@@ -177,6 +173,11 @@ def get_agent_from_text(ag_name, use_grouding_service=True):
 
 def get_grounding_from_name(name):
     """Return grounding given an agent name."""
+    # These are imported here since loading their resources is slow
+    from indra.databases.hgnc_client import get_hgnc_id
+    from indra.databases.chebi_client import get_chebi_id_from_name
+    from indra.databases.mesh_client import get_mesh_id_name
+    from indra.preassembler.grounding_mapper import gm
     # See if it's a gene name
     hgnc_id = get_hgnc_id(name)
     if hgnc_id:
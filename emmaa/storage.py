@@ -0,0 +1,272 @@
+"""Storage backends that stand in for S3.
+
+EMMAA reads and writes all of its data through the client returned by
+emmaa.util.get_s3_client. By default this is a boto3 S3 client, but the
+EMMAA_STORAGE_BACKEND environment variable can select a local backend
+instead:
+
+- s3 (default): Amazon S3.
+- local: a directory given by EMMAA_STORAGE_PATH in which each bucket is a
+  subdirectory and each key a file.
+- memory: a dictionary in memory shared by all clients of the process, which
+  is useful for tests and benchmarks.
+
+The local backends implement the subset of the boto3 S3 client interface
+used in EMMAA (get_object, put_object, head_object, list_objects,
+list_objects_v2 and the list_objects_v2 paginator) and raise
+botocore.exceptions.ClientError for missing keys like S3 does, so the full
+update, test and stats cycle can be run without AWS. Like S3, put_object
+supports conditional writes with IfMatch and IfNoneMatch='*'.
+"""
+import io
+import os
+import hashlib
+import logging
+import threading
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError
+
+
+logger = logging.getLogger(__name__)
+
+
+STORAGE_BACKENDS = ['s3', 'local', 'memory']
+
+
+def get_storage_backend():
+    """Return the name of the storage backend set in the environment."""
+    backend = os.environ.get('EMMAA_STORAGE_BACKEND', 's3').lower()
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f'Unknown storage backend {backend}, use one of '
+                         f'{", ".join(STORAGE_BACKENDS)}.')
+    return backend
+
+
+def get_local_storage_client(backend=None):
+    """Return a client of a local storage backend.
+
+    Parameters
+    ----------
+    backend : Optional[str]
+        The name of the backend, local or memory. If not given, it is taken
+        from the environment.
+
+    Returns
+    -------
+    emmaa.storage.LocalStorageClient
+        A client with the interface of a boto3 S3 client.
+    """
+    backend = backend if backend else get_storage_backend()
+    if backend == 'memory':
+        return memory_storage_client
+    if backend == 'local':
+        path = os.environ.get('EMMAA_STORAGE_PATH')
+        if not path:
+            raise ValueError('EMMAA_STORAGE_PATH has to be set to use the '
+                             'local storage backend.')
+        return DirectoryStorageClient(path)
+    raise ValueError(f'{backend} is not a local storage backend.')
+
+
+class LocalStorageClient(object):
+    """A stand-in for a boto3 S3 client storing objects locally.
+
+    Child classes implement storing, loading, describing and listing the
+    objects of a bucket.
+    """
+    def get_object(self, Bucket, Key, **kwargs):
+        body = self._load(Bucket, Key)
+        if body is None:
+            raise _no_such_key('GetObject', Key)
+        response = self._describe(Bucket, Key, body)
+        response['Body'] = io.BytesIO(body)
+        return response
+
+    def head_object(self, Bucket, Key, **kwargs):
+        body = self._load(Bucket, Key)
+        if body is None:
+            # S3 does not return an error message for HEAD requests
+            raise ClientError({'Error': {'Code': '404',
+                                         'Message': 'Not Found'}},
+                              'HeadObject')
+        return self._describe(Bucket, Key, body)
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None,
+                   **kwargs):
+        if isinstance(Body, str):
+            Body = Body.encode('utf8')
+        elif not isinstance(Body, bytes):
+            Body = Body.read()
+        # Checking the condition and storing has to be atomic. This holds
+        # within one process, which is what the local backends are used for.
+        with _put_lock:
+            if IfMatch is not None or IfNoneMatch is not None:
+                current = self._load(Bucket, Key)
+                if IfNoneMatch == '*' and current is not None or \
+                        IfMatch is not None and (
+                            current is None or
+                            _make_etag(current) != IfMatch):
+                    raise ClientError(
+                        {'Error': {'Code': 'PreconditionFailed',
+                                   'Message': 'At least one of the pre-'
+                                              'conditions you specified did '
+                                              'not hold'}}, 'PutObject')
+            self._store(Bucket, Key, Body)
+        return {'ETag': _make_etag(Body)}
+
+    def list_objects(self, Bucket, Prefix='', Delimiter=None, **kwargs):
+        contents = []
+        common_prefixes = []
+        for key in sorted(self._keys(Bucket)):
+            if not key.startswith(Prefix):
+                continue
+            if Delimiter:
+                ix = key.find(Delimiter, len(Prefix))
+                if ix >= 0:
+                    common_prefix = key[:ix + len(Delimiter)]
+                    if common_prefix not in common_prefixes:
+                        common_prefixes.append(common_prefix)
+                    continue
+            body = self._load(Bucket, key)
+            entry = self._describe(Bucket, key, body)
+            contents.append({'Key': key, 'Size': len(body),
+                             'ETag': entry['ETag'],
+                             'LastModified': entry['LastModified']})
+        response = {'Name': Bucket, 'Prefix': Prefix, 'IsTruncated': False}
+        # S3 leaves out these fields when they are empty
+        if contents:
+            response['Contents'] = contents
+        if common_prefixes:
+            response['CommonPrefixes'] = [{'Prefix': prefix}
+                                          for prefix in common_prefixes]
+        return response
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, **kwargs):
+        response = self.list_objects(Bucket, Prefix, Delimiter)
+        response['KeyCount'] = len(response.get('Contents', [])) + \
+            len(response.get('CommonPrefixes', []))
+        return response
+
+    def get_paginator(self, operation_name):
+        return _SinglePagePaginator(getattr(self, operation_name))
+
+    def _describe(self, bucket, key, body):
+        return {'ETag': _make_etag(body), 'ContentLength': len(body),
+                'LastModified': self._last_modified(bucket, key)}
+
+    def _load(self, bucket, key):
+        raise NotImplementedError('Method must be implemented in a child '
+                                  'class.')
+
+    def _store(self, bucket, key, body):
+        raise NotImplementedError('Method must be implemented in a child '
+                                  'class.')
+
+    def _keys(self, bucket):
+        raise NotImplementedError('Method must be implemented in a child '
+                                  'class.')
+
+    def _last_modified(self, bucket, key):
+        raise NotImplementedError('Method must be implemented in a child '
+                                  'class.')
+
+
+class DirectoryStorageClient(LocalStorageClient):
+    """Stores objects as files in a directory with a subdirectory per bucket.
+
+    Parameters
+    ----------
+    path : str
+        The directory to store objects in.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def _get_path(self, bucket, key):
+        path = os.path.abspath(os.path.join(self.path, bucket, key))
+        # Keys cannot point outside of the bucket
+        if not path.startswith(os.path.join(self.path, bucket) + os.sep):
+            raise _no_such_key('GetObject', key)
+        return path
+
+    def _load(self, bucket, key):
+        path = self._get_path(bucket, key)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _store(self, bucket, key, body):
+        path = self._get_path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see partial files
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+
+    def _keys(self, bucket):
+        bucket_path = os.path.join(self.path, bucket)
+        for root, _, fnames in os.walk(bucket_path):
+            for fname in fnames:
+                if fname.endswith('.tmp'):
+                    continue
+                rel_path = os.path.relpath(os.path.join(root, fname),
+                                           bucket_path)
+                yield rel_path.replace(os.sep, '/')
+
+    def _last_modified(self, bucket, key):
+        mtime = os.path.getmtime(self._get_path(bucket, key))
+        return datetime.fromtimestamp(mtime, tz=timezone.utc)
+
+
+class MemoryStorageClient(LocalStorageClient):
+    """Stores objects in a dictionary in memory."""
+    def __init__(self):
+        self.objects = {}
+        self._lock = threading.Lock()
+
+    def _load(self, bucket, key):
+        with self._lock:
+            body, _ = self.objects.get((bucket, key), (None, None))
+        return body
+
+    def _store(self, bucket, key, body):
+        with self._lock:
+            self.objects[(bucket, key)] = (body, datetime.now(timezone.utc))
+
+    def _keys(self, bucket):
+        with self._lock:
+            return [key for b, key in self.objects if b == bucket]
+
+    def _last_modified(self, bucket, key):
+        with self._lock:
+            return self.objects[(bucket, key)][1]
+
+    def clear(self):
+        """Remove all objects."""
+        with self._lock:
+            self.objects = {}
+
+
+class _SinglePagePaginator(object):
+    # Local listings are never truncated, so there is only one page
+    def __init__(self, operation):
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        yield self.operation(**kwargs)
+
+
+def _no_such_key(operation_name, key):
+    return ClientError({'Error': {'Code': 'NoSuchKey', 'Key': key,
+                                  'Message': 'The specified key does not '
+                                             'exist.'}}, operation_name)
+
+
+def _make_etag(body):
+    return '"%s"' % hashlib.md5(body).hexdigest()
+
+
+_put_lock = threading.Lock()
+memory_storage_client = MemoryStorageClient()
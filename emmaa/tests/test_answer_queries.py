@@ -1,12 +1,22 @@
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from os.path import abspath, dirname, join
 from datetime import datetime
 from nose.plugins.attrib import attr
+from botocore.exceptions import ClientError
 from emmaa.answer_queries import QueryManager, format_results, \
-    load_model_manager_from_s3, is_query_result_diff
+    load_model_manager_from_s3, is_query_result_diff, ModelManagerCache, \
+    QueryResultCache, hash_result_json, FileReportSender, _reset_after_fork, \
+    ModelManagerPreloader, LocalQueryJobStore
 from emmaa.queries import Query
 from emmaa.model_tests import ModelManager
+from emmaa.db.schema import Result
 from emmaa.tests.test_db import _get_test_db
 from emmaa.model import EmmaaModel
+from emmaa.util import get_s3_client
 
 
 test_query = {'type': 'path_property', 'path': {'type': 'Activation',
@@ -43,6 +53,246 @@ def test_load_model_manager_from_s3():
     assert isinstance(mm, ModelManager)
 
 
+class _LocalModelManagerCache(ModelManagerCache):
+    # Load fake entries with a given size instead of loading from S3
+    def _load(self, model_name):
+        return {'model_manager': model_name, 'etag': None,
+                'last_modified': None, 'size': 10, 'checked': time.time()}
+
+    def _get_size(self, model_name):
+        return 10
+
+    def _is_stale(self, model_name, entry, force_check=False):
+        return False
+
+
+def test_model_manager_cache_eviction():
+    cache = _LocalModelManagerCache(max_entries=2, max_bytes=25,
+                                    check_interval=3600)
+    assert cache.get('aml') == 'aml'
+    assert cache.get('luad') == 'luad'
+    assert cache.get('aml') == 'aml'
+    # Adding a third model evicts the least recently used one
+    assert cache.get('skcm') == 'skcm'
+    assert list(cache.entries) == ['aml', 'skcm']
+    metrics = cache.get_metrics()
+    assert metrics['hits'] == 1
+    assert metrics['misses'] == 3
+    assert metrics['evictions'] == 1
+    assert metrics['bytes'] == 20
+    # Size limit is applied together with the number of entries
+    cache.max_entries = 5
+    cache.get('brca')
+    assert list(cache.entries) == ['skcm', 'brca']
+    # The load locks of models that left the cache are dropped
+    assert set(cache._load_locks) == {'skcm', 'brca'}
+    cache.remove('skcm')
+    assert set(cache._load_locks) == {'brca'}
+    cache.clear()
+    assert not cache._load_locks
+
+
+def test_model_manager_cache_failed_check():
+    os.environ['EMMAA_STORAGE_BACKEND'] = 'memory'
+    client = get_s3_client()
+    heads = []
+
+    def head_object(**kwargs):
+        heads.append(kwargs['Key'])
+        raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}},
+                          'HeadObject')
+    client.head_object = head_object
+    try:
+        cache = ModelManagerCache(check_interval=3600)
+        entry = {'model_manager': 'aml', 'etag': None, 'last_modified': None,
+                 'size': 10, 'checked': 0}
+        cache.put('aml', entry)
+        # A failed check keeps the cached model and is not repeated before
+        # the check interval passed
+        assert cache.get('aml') == 'aml'
+        assert cache.get('aml') == 'aml'
+        assert len(heads) == 1
+        assert time.time() - entry['checked'] < 60
+    finally:
+        del client.head_object
+        del os.environ['EMMAA_STORAGE_BACKEND']
+        client.clear()
+
+
+def test_preloader_does_not_evict():
+    cache = _LocalModelManagerCache(max_entries=2, max_bytes=100,
+                                    check_interval=3600)
+    preloader = ModelManagerPreloader(lambda: ['aml', 'luad', 'skcm'],
+                                      cache=cache)
+    preloader.preload()
+    assert list(cache.entries) == ['aml', 'luad']
+    # A model loaded for a query stays cached over the next passes
+    cache.get('skcm')
+    preloader.preload()
+    preloader.preload()
+    metrics = cache.get_metrics()
+    assert metrics['misses'] == 3
+    assert metrics['evictions'] == 1
+    assert list(cache.entries) == ['luad', 'skcm']
+    # Refreshing does not count as a use of the cached models
+    cache.get('luad')
+    preloader.preload()
+    assert list(cache.entries) == ['skcm', 'luad']
+    # The size limit is also respected
+    cache = _LocalModelManagerCache(max_entries=5, max_bytes=15,
+                                    check_interval=3600)
+    ModelManagerPreloader(lambda: ['aml', 'luad'], cache=cache).preload()
+    assert list(cache.entries) == ['aml']
+
+
+def test_reset_after_fork():
+    cache = _LocalModelManagerCache(check_interval=3600)
+    cache.get('aml')
+    # Another thread of the parent holds the locks while it forks
+    cache._get_load_lock('aml').acquire()
+    cache._lock.acquire()
+    _reset_after_fork()
+    assert cache._lock.acquire(timeout=1)
+    cache._lock.release()
+    assert cache._get_load_lock('aml').acquire(timeout=1)
+    assert cache.get('aml') == 'aml'
+    # Pending results are dropped as nothing computes them in the child
+    result_cache = QueryResultCache()
+    result_cache.get_or_compute(('q', 'v1'), lambda: 'result')
+    result_cache.entries[('q', 'v2')] = Future()
+    result_cache._lock.acquire()
+    _reset_after_fork()
+    assert result_cache._lock.acquire(timeout=1)
+    result_cache._lock.release()
+    assert list(result_cache.entries) == [('q', 'v1')]
+    assert result_cache.get_or_compute(('q', 'v2'), lambda: 'new') == 'new'
+
+
+def test_query_result_cache():
+    cache = QueryResultCache(max_entries=2)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'result'
+    # Concurrent identical requests are computed once
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(
+            lambda _: cache.get_or_compute(('q', 'v1'), compute), range(4)))
+    assert results == ['result'] * 4
+    assert len(calls) == 1
+    metrics = cache.get_metrics()
+    assert metrics['misses'] == 1
+    assert metrics['hits'] + metrics['waits'] == 3
+    # A new model manager version is a different key
+    cache.get_or_compute(('q', 'v2'), compute)
+    assert len(calls) == 2
+    cache.get_or_compute(('q2', 'v2'), compute)
+    assert list(cache.entries) == [('q', 'v2'), ('q2', 'v2')]
+
+
+class _Interrupt(BaseException):
+    pass
+
+
+def test_query_result_cache_interrupted():
+    cache = QueryResultCache()
+
+    def interrupted():
+        time.sleep(0.2)
+        raise _Interrupt()
+
+    def wait_for_result():
+        time.sleep(0.1)
+        try:
+            return cache.get_or_compute(('q', 'v1'), lambda: 'result')
+        except _Interrupt:
+            return 'interrupted'
+    # A thread waiting for an interrupted computation is not blocked
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(wait_for_result)
+        try:
+            cache.get_or_compute(('q', 'v1'), interrupted)
+        except _Interrupt:
+            pass
+        assert future.result(timeout=5) == 'interrupted'
+    assert not cache.entries
+    assert cache.get_or_compute(('q', 'v1'), lambda: 'result') == 'result'
+
+
+class _LocalModel(object):
+    def __init__(self, stmts, name):
+        self.name = name
+        self.assembled_stmts = stmts
+
+
+class _LocalModelManager(object):
+    # Answer queries with a fixed response after a delay
+    def __init__(self, stmts, name='test', delay=0):
+        self.model = _LocalModel(stmts, name)
+        self.mc_types = {'pysb': {}}
+        self.delay = delay
+        self.calls = 0
+
+    def answer_query(self, query):
+        self.calls += 1
+        time.sleep(self.delay)
+        return [('pysb', test_response)]
+
+
+def test_local_model_manager_version():
+    from indra.statements import Activation, Agent
+    stmt1 = Activation(Agent('BRAF'), Agent('MAP2K1'))
+    stmt2 = Activation(Agent('MAP2K1'), Agent('MAPK1'))
+    mm1 = _LocalModelManager([stmt1])
+    mm2 = _LocalModelManager([stmt1, stmt2])
+    mm3 = _LocalModelManager([stmt1])
+    qm = QueryManager(db='db', model_managers=[mm1, mm2])
+    version1 = qm._get_model_manager_version('test', mm1)
+    assert version1 == qm._get_model_manager_version('test', mm1)
+    assert version1 != qm._get_model_manager_version('test', mm2)
+    # The version does not depend on the identity of the model manager
+    qm2 = QueryManager(db='db', model_managers=[mm3])
+    assert version1 == qm2._get_model_manager_version('test', mm3)
+
+
+@attr('nonpublic')
+def test_answer_immediate_query_timeout():
+    db = _get_test_db()
+    slow_mm = _LocalModelManager([], 'slow', delay=1)
+    fast_mm = _LocalModelManager([], 'fast')
+    qm = QueryManager(db=db, model_managers=[slow_mm, fast_mm],
+                      max_workers=2, timeout=0.2,
+                      result_cache=QueryResultCache())
+    results = qm.answer_immediate_query('tester@test.com', 1, query_object,
+                                        ['slow'], subscribe=True)
+    assert not results
+    # Asking again while the slow model is answering does not use another
+    # thread, so the timed out queries do not block the next query
+    results = qm.answer_immediate_query('tester@test.com', 1, query_object,
+                                        ['slow'], subscribe=True)
+    assert not results
+    start = time.time()
+    results = qm.answer_immediate_query('tester@test.com', 1, query_object,
+                                        ['fast'], subscribe=True)
+    assert time.time() - start < 0.5
+    assert len(results) == 1
+    assert results[0]['model'] == 'fast'
+    # The late results of the slow model are saved when they are available
+    time.sleep(1.5)
+    results = qm.answer_immediate_query('tester@test.com', 1, query_object,
+                                        ['slow'], subscribe=True)
+    assert len(results) == 1
+    assert results[0]['model'] == 'slow'
+    assert slow_mm.calls == 1
+    # The late results are saved once although two requests timed out
+    with db.get_session() as sess:
+        assert sess.query(Result).filter(
+            Result.query_hash == query_object.get_hash_with_model('slow')
+        ).count() == 1
+
+
 def test_format_results():
     results = [('test', query_object, 'pysb', test_response, datetime.now())]
     formatted_results = format_results(results)
@@ -69,6 +319,50 @@ def test_answer_immediate_query():
     assert isinstance(results[0]['date'], str)
 
 
+@attr('nonpublic')
+def test_submit_immediate_query():
+    db = _get_test_db()
+    qm = QueryManager(db=db, model_managers=[test_mm])
+    job_id = qm.submit_immediate_query('tester@test.com', 1, query_object,
+                                       ['test'], subscribe=False)
+    for _ in range(60):
+        status = qm.get_job_status(job_id)
+        if status['status'] == 'done':
+            break
+        time.sleep(1)
+    assert status['status'] == 'done', status
+    assert status['done_models'] == ['test']
+    assert not status['pending_models']
+    assert not status['errors']
+    results = status['result']
+    assert len(results) == 1
+    assert results[0]['model'] == 'test'
+    assert 'BRAF activates MAP2K1.' in results[0]['response'], \
+        results[0]['response']
+    assert qm.get_job_status('unknown') is None
+
+
+def test_local_query_job_store():
+    store = LocalQueryJobStore(ttl=0)
+    store.add_job('job1', query_object, ['aml', 'luad'])
+    store.add_results('job1', 'aml', [('aml', query_object, 'pysb',
+                                       test_response, datetime.now())])
+    status = store.get_job_status('job1')
+    assert status['status'] == 'running'
+    assert status['done_models'] == ['aml']
+    assert status['pending_models'] == ['luad']
+    assert len(status['result']) == 1
+    store.add_error('job1', 'luad', 'Failed')
+    status = store.get_job_status('job1')
+    assert status['status'] == 'done'
+    assert status['errors'] == {'luad': 'Failed'}
+    # Finished jobs are removed after the TTL when a new job is added
+    store.add_job('job2', query_object, ['aml'])
+    assert store.get_job_status('job1') is None
+    assert store.get_job_status('job2')['status'] == 'running'
+    assert store.get_job_status('unknown') is None
+
+
 @attr('nonpublic')
 def test_answer_get_registered_queries():
     db = _get_test_db()
@@ -86,9 +380,30 @@ def test_answer_get_registered_queries():
     assert isinstance(results[0]['date'], str)
 
 
+@attr('nonpublic')
+def test_answer_changed_registered_queries():
+    db = _get_test_db()
+    qm = QueryManager(db=db, model_managers=[test_mm])
+    qm.db.put_queries('tester@test.com', 1, query_object, ['test'],
+                      subscribe=True)
+    timings = qm.answer_changed_registered_queries('test')
+    assert 'answer_queries' in timings
+    latest = qm.db.get_latest_results_for_model('test')
+    assert len(latest) == 1
+    # Answering again does not add a new result as nothing changed
+    qm.answer_changed_registered_queries('test')
+    assert qm.db.get_latest_results_for_model('test') == latest
+    with qm.db.get_session() as sess:
+        assert sess.query(Result).count() == 1
+
+
 def test_is_diff():
     assert not is_query_result_diff(query_not_appl, query_not_appl)
     assert is_query_result_diff(test_response, query_not_appl)
+    assert hash_result_json(query_not_appl) == hash_result_json(
+        {str(k): v for k, v in query_not_appl.items()})
+    assert hash_result_json(test_response) != hash_result_json(
+        query_not_appl)
 
 
 @attr('nonpublic')
@@ -148,3 +463,37 @@ def test_report_files():
     assert msg
     assert 'A new result to query' in msg
     assert 'BRAF activates MAP2K1.' in msg
+
+
+@attr('nonpublic')
+def test_send_user_reports():
+    db = _get_test_db()
+    qm = QueryManager(db=db, model_managers=[test_mm])
+    qm.db.put_queries('tester@test.com', 1, query_object, ['test'],
+                      subscribe=True)
+    qm.db.put_results('test', [(query_object, 'pysb', query_not_appl)])
+    report_dir = tempfile.mkdtemp()
+    try:
+        sender = FileReportSender(report_dir)
+        assert qm.send_user_reports(sender) == 1
+        with open(join(report_dir, 'tester@test.com.txt'), 'r') as f:
+            msg = f.read()
+        assert 'This is the first result to query' in msg, msg
+        # Nothing changed since the last report, so nothing is reported
+        assert not list(qm.iter_user_reports())
+        assert qm.send_user_reports(sender) == 0
+        assert len(list(qm.iter_user_reports(only_changed=False))) == 1
+        time.sleep(1)
+        qm.db.put_results('test', [(query_object, 'pysb', test_response)])
+        assert qm.send_user_reports(sender) == 1
+        with open(join(report_dir, 'tester@test.com.txt'), 'r') as f:
+            msg = f.read()
+        assert 'A new result to query' in msg, msg
+        assert 'Query is not applicable for this model' in msg
+        assert 'BRAF activates MAP2K1.' in msg
+        with open(join(report_dir, 'tester@test.com.html'), 'r') as f:
+            msg = f.read()
+        assert processed_link in msg
+        assert not list(qm.iter_user_reports())
+    finally:
+        shutil.rmtree(report_dir)
@@ -1,7 +1,11 @@
+import os
 import re
+import json
 
-from emmaa.util import RE_DATEFORMAT
-from emmaa_service.api import get_model_stats, model_last_updated
+from emmaa.util import RE_DATEFORMAT, get_s3_client
+from emmaa_service import api
+from emmaa_service.api import get_model_stats, model_last_updated, \
+    get_test_history_index
 
 MODEL = 'aml'
 
@@ -15,3 +19,26 @@ def test_last_updated():
 def test_get_model_statistics():
     model_json = get_model_stats(MODEL)
     assert isinstance(model_json, dict)
+
+
+def test_get_test_history_index():
+    os.environ['EMMAA_STORAGE_BACKEND'] = 'memory'
+    client = get_s3_client()
+    key = 'results/test/test_history.json'
+    history = {'dates': ['2019-09-01-00-00-00'], 'tests': {}}
+    try:
+        assert get_test_history_index('test') is None
+        # A missing index is checked again after the interval
+        api.test_history_cache['test']['checked'] = 0
+        client.put_object(Bucket='emmaa', Key=key, Body=json.dumps(history))
+        assert get_test_history_index('test') == history
+        # The index is cached until it is checked again
+        client.put_object(Bucket='emmaa', Key=key, Body=json.dumps(
+            {'dates': [], 'tests': {}}))
+        assert get_test_history_index('test') == history
+        api.test_history_cache['test']['checked'] = 0
+        assert get_test_history_index('test')['dates'] == []
+    finally:
+        del os.environ['EMMAA_STORAGE_BACKEND']
+        api.test_history_cache.clear()
+        client.clear()
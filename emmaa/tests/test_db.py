@@ -1,9 +1,14 @@
 import time
 import random
+from os import environ
+from datetime import datetime, timedelta
 
 from nose.plugins.attrib import attr
 
-from emmaa.db import Query, Result, EmmaaDatabaseManager
+from emmaa.db import Query, Result, ResultArchive, UserQuery, \
+    EmmaaDatabaseManager
+from emmaa.db.config import get_pool_settings
+from emmaa.db.migrations import compact_results, archive_results
 from emmaa.queries import Query as QueryObject, PathProperty
 
 
@@ -25,6 +30,24 @@ def _get_test_db():
     return db
 
 
+def test_pool_settings():
+    environ['EMMAA_DB_POOL_SIZE'] = '7'
+    environ['EMMAA_DB_POOL_PRE_PING'] = 'false'
+    try:
+        settings = get_pool_settings(include_config=False)
+    finally:
+        environ.pop('EMMAA_DB_POOL_SIZE')
+        environ.pop('EMMAA_DB_POOL_PRE_PING')
+    assert settings['pool_size'] == 7
+    assert settings['pool_pre_ping'] is False
+    assert settings['max_overflow'] == 10
+    # Pool settings are not used for sqlite and sessions are still timed
+    db = EmmaaDatabaseManager('sqlite://', pool_settings=settings)
+    with db.get_session() as sess:
+        sess.execute('SELECT 1')
+    assert db.get_pool_status()['checkouts'] == 1
+
+
 @attr('nonpublic')
 def test_instantiation():
     db = _get_test_db()
@@ -41,6 +64,28 @@ def test_put_queries():
     assert len(queries) == 2, len(queries)
 
 
+@attr('nonpublic')
+def test_put_queries_again():
+    db = _get_test_db()
+    for _ in range(2):
+        db.put_queries('joshua', 1, test_queries[0], ['aml', 'luad'],
+                       subscribe=False)
+        db.put_queries('', None, test_queries[0], ['aml'], subscribe=False)
+    db.put_queries('joshua', 1, test_queries[0], ['aml'], subscribe=True)
+    with db.get_session() as sess:
+        assert sess.query(Query).count() == 2
+        user_queries = {(uq.user_id, uq.query_hash): uq
+                        for uq in sess.query(UserQuery).all()}
+        assert len(user_queries) == 3, user_queries
+        aml_hash = test_queries[0].get_hash_with_model('aml')
+        luad_hash = test_queries[0].get_hash_with_model('luad')
+        assert user_queries[(1, aml_hash)].count == 3
+        assert user_queries[(1, aml_hash)].subscription
+        assert user_queries[(1, luad_hash)].count == 2
+        assert not user_queries[(1, luad_hash)].subscription
+        assert user_queries[(None, aml_hash)].count == 2
+
+
 @attr('nonpublic')
 def test_get_queries():
     db = _get_test_db()
@@ -69,6 +114,21 @@ def test_put_results():
     assert len(db_results) == len(results)
 
 
+@attr('nonpublic')
+def test_put_results_batch():
+    db = _get_test_db()
+    models = ['aml', 'luad']
+    db.put_queries('joshua', 1, test_queries[0], models)
+    db.put_results_batch({model: [(test_queries[0], 'pysb',
+                                   _get_random_result())]
+                          for model in models})
+    with db.get_session() as sess:
+        db_results = sess.query(Result).all()
+    assert len(db_results) == len(models)
+    results = db.get_results('joshua')
+    assert {result[0] for result in results} == set(models)
+
+
 @attr('nonpublic')
 def test_get_results():
     db = _get_test_db()
@@ -117,3 +177,91 @@ def test_get_latest_results():
     assert any(results[0][1].matches(q) for q in test_queries)
     assert all(isinstance(result[2], str) for result in results)
     assert all(isinstance(result[3], dict) for result in results)
+
+    # The previous results are the first set and there are no older ones
+    previous = db.get_results('joshua', latest_order=2)
+    assert len(previous) == len(results), len(previous)
+    assert all(prev[4] < res[4] for prev, res in zip(previous, results))
+    assert not db.get_results('joshua', latest_order=3)
+
+
+@attr('nonpublic')
+def test_compact_results():
+    db = _get_test_db()
+    db.put_queries('joshua', 1, test_queries[0], ['aml'])
+    fine = {'12': [['This is fine.', '']]}
+    not_ok = {'34': [['This is not ok.', '']]}
+    for result_json in [fine, fine, not_ok]:
+        db.put_results('aml', [(test_queries[0], 'pysb', result_json)])
+    assert compact_results(db) == 1
+    with db.get_session() as sess:
+        assert sess.query(Result).count() == 2
+        assert sess.query(ResultArchive).count() == 1
+    # Running it again does not change anything
+    assert compact_results(db) == 0
+
+
+@attr('nonpublic')
+def test_archive_results():
+    db = _get_test_db()
+    db.put_queries('joshua', 1, test_queries[0], ['aml'])
+    db.put_queries('other', 2, test_queries[1], ['aml'])
+    fine = {'12': [['This is fine.', '']]}
+    for query in test_queries:
+        db.put_results('aml', [(query, 'pysb', fine)])
+    old_date = datetime.now() - timedelta(days=100)
+    with db.get_session() as sess:
+        sess.query(Result).update({Result.date: old_date},
+                                  synchronize_session=False)
+    db.update_results_reported('joshua', old_date)
+    for query in test_queries:
+        db.put_results('aml', [(query, 'pysb', fine)])
+    # The old result that was reported to joshua is kept, the other one is
+    # archived
+    assert archive_results(db, days=90) == 1
+    with db.get_session() as sess:
+        assert sess.query(Result).count() == 3
+        assert sess.query(ResultArchive).count() == 1
+    rows = list(db.get_subscribed_result_deltas(only_changed=True))
+    assert [row[0] for row in rows] == ['other']
+
+
+@attr('nonpublic')
+def test_get_result_deltas():
+    db = _get_test_db()
+    db.put_queries('joshua', 1, test_queries[0], ['aml', 'luad'])
+    fine = {'12': [['This is fine.', '']]}
+    not_ok = {'34': [['This is not ok.', '']]}
+    db.put_results('aml', [(test_queries[0], 'pysb', fine)])
+    db.put_results('aml', [(test_queries[0], 'pysb', fine)])
+    db.put_results('luad', [(test_queries[0], 'pysb', fine)])
+    db.put_results('luad', [(test_queries[0], 'pysb', not_ok)])
+    aml_hash = test_queries[0].get_hash_with_model('aml')
+    luad_hash = test_queries[0].get_hash_with_model('luad')
+    deltas = db.get_result_deltas([aml_hash, luad_hash])
+    assert not deltas[(aml_hash, 'pysb')][2]
+    latest_id, previous_id, changed = deltas[(luad_hash, 'pysb')]
+    assert changed
+    assert db.get_result_jsons([previous_id]) == {previous_id: fine}
+    # A result that did not change in a later check is not new anymore
+    time.sleep(1)
+    db.update_results_checked([latest_id])
+    assert not db.get_result_deltas([luad_hash])[(luad_hash, 'pysb')][2]
+
+
+@attr('nonpublic')
+def test_get_subscribed_result_deltas():
+    db = _get_test_db()
+    for ix, query in enumerate(test_queries * 2):
+        db.put_queries(f'user{ix}@test.com', ix + 1, query, ['aml'])
+    fine = {'12': [['This is fine.', '']]}
+    db.put_results('aml', [(query, 'pysb', fine) for query in test_queries])
+    # Users are loaded in batches but are still in order
+    rows = list(db.get_subscribed_result_deltas(batch_size=3))
+    assert [row[0] for row in rows] == [f'user{ix}@test.com'
+                                        for ix in range(4)]
+    assert all(row[7] and row[6] is None for row in rows)
+    db.update_results_reported('user0@test.com', rows[0][5])
+    rows = list(db.get_subscribed_result_deltas(only_changed=True))
+    assert [row[0] for row in rows] == [f'user{ix}@test.com'
+                                        for ix in range(1, 4)]
@@ -1,9 +1,15 @@
+import pickle
+import networkx as nx
 from nose.plugins.attrib import attr
-from indra.explanation.model_checker import PathResult, PysbModelChecker
+from indra.explanation.model_checker import PathResult, PysbModelChecker, \
+    SignedGraphModelChecker
+from indra.statements import Activation, Agent, Inhibition
 from indra.statements.statements import Statement
 from emmaa.model import EmmaaModel
+from emmaa import model_tests
 from emmaa.model_tests import (StatementCheckingTest, run_model_tests_from_s3,
-                               load_tests_from_s3, ModelManager)
+                               load_tests_from_s3, ModelManager,
+                               ReachabilityIndex)
 from emmaa.analyze_tests_results import TestRound, StatsGenerator
 
 from emmaa.tests.test_db import _get_test_db
@@ -44,3 +50,96 @@ def test_run_tests_from_s3():
     assert len(sg.latest_round.statements) == 2
     assert len(sg.latest_round.mc_types_results['pysb']) == 1
     assert len(sg.latest_round.tests) == 1
+
+
+class _LocalModel(object):
+    # A minimal stand-in for EmmaaModel with a test config only
+    def __init__(self, test_config):
+        self.test_config = test_config
+
+
+def _make_signed_graph_mm(test_config, index=False):
+    graph = nx.MultiDiGraph()
+    graph.add_edge('A', 'B', sign=0)
+    graph.add_edge('B', 'C', sign=1)
+    graph.add_edge('C', 'D', sign=0)
+    graph.add_edge('E', 'A', sign=0)
+    mm = ModelManager.__new__(ModelManager)
+    mm.model = _LocalModel(test_config)
+    mc = SignedGraphModelChecker(graph)
+    mm.mc_types = {'signed_graph': {
+        'model': graph, 'model_checker': mc, 'test_results': []}}
+    if not index:
+        mm.mc_types['signed_graph']['reachability'] = None
+    return mm
+
+
+def test_check_statements_batched():
+    a, b, c, d, e = [Agent(name) for name in 'ABCDE']
+    stmts = [Inhibition(a, c), Activation(a, c), Inhibition(a, d),
+             Activation(d, a), Inhibition(a, e), Activation(b, a),
+             Inhibition(e, d), Activation(a, Agent('F'))]
+    batched_mm = _make_signed_graph_mm({})
+    mc = batched_mm.get_updated_mc('signed_graph', stmts)
+    batched = batched_mm.check_statements('signed_graph', mc)
+    single_mm = _make_signed_graph_mm({'batch_path_search': False})
+    mc = single_mm.get_updated_mc('signed_graph', stmts)
+    single = single_mm.check_statements('signed_graph', mc)
+    index_mm = _make_signed_graph_mm({}, index=True)
+    mc = index_mm.get_updated_mc('signed_graph', stmts)
+    indexed = index_mm.check_statements('signed_graph', mc)
+    assert len(batched) == len(single) == len(indexed) == len(stmts)
+    for res1, res2, res3 in zip(batched, single, indexed):
+        assert res1.path_found == res2.path_found == res3.path_found
+        assert res1.result_code == res2.result_code == res3.result_code, \
+            (res1, res2, res3)
+        assert res1.paths == res2.paths == res3.paths
+    assert [res.result_code for res in batched] == [
+        'PATHS_FOUND', 'NO_PATHS_FOUND', 'PATHS_FOUND', 'NO_PATHS_FOUND',
+        'OBJECT_NOT_FOUND', 'NO_PATHS_FOUND', 'PATHS_FOUND',
+        'OBJECT_NOT_FOUND']
+
+
+def test_reachability_index():
+    graph = nx.DiGraph()
+    graph.add_edges_from([('A', 'B'), ('B', 'C'), ('C', 'B'), ('C', 'D'),
+                          ('E', 'E'), ('E', 'A'), ('F', 'D')])
+    index = ReachabilityIndex(graph)
+    for source in graph.nodes:
+        for target in graph.nodes:
+            expected = any(target in nx.descendants(graph, succ) | {succ}
+                           for succ in graph.successors(source))
+            assert index.has_path(source, target) == expected, \
+                (source, target)
+    assert not index.has_path('A', 'G')
+
+
+def test_mc_lock():
+    mm = _make_signed_graph_mm({})
+    lock = mm.get_mc_lock()
+    assert mm.get_mc_lock() is lock
+    # The lock is not pickled but created again
+    mm = pickle.loads(pickle.dumps(mm))
+    assert '_mc_lock' not in mm.__dict__
+    assert mm.get_mc_lock() is not lock
+
+
+def test_reachability_index_lazy():
+    mm = _make_signed_graph_mm({}, index=True)
+    assert 'reachability' not in mm.mc_types['signed_graph']
+    index = mm.get_reachability_index('signed_graph')
+    assert isinstance(index, ReachabilityIndex)
+    assert mm.get_reachability_index('signed_graph') is index
+    # The index is not pickled but rebuilt when needed
+    mm = pickle.loads(pickle.dumps(mm))
+    assert 'reachability' not in mm.mc_types['signed_graph']
+    assert isinstance(mm.get_reachability_index('signed_graph'),
+                      ReachabilityIndex)
+    # The index is not built for large graphs
+    max_nodes = model_tests.REACHABILITY_INDEX_MAX_NODES
+    model_tests.REACHABILITY_INDEX_MAX_NODES = 2
+    try:
+        mm = _make_signed_graph_mm({}, index=True)
+        assert mm.get_reachability_index('signed_graph') is None
+    finally:
+        model_tests.REACHABILITY_INDEX_MAX_NODES = max_nodes
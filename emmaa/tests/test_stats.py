@@ -1,7 +1,15 @@
 import os
 import json
+import jsonpickle
 from nose.plugins.attrib import attr
-from emmaa.analyze_tests_results import TestRound, StatsGenerator
+from indra.explanation.model_checker import PathResult
+from indra.statements import Activation, Agent, Inhibition
+from emmaa.analyze_tests_results import TestRound, StatsGenerator, \
+    changes_over_time_to_rows, rows_to_changes_over_time, \
+    make_stats_from_inputs, update_test_history, get_test_history, \
+    generate_stats_for_models, load_changes_over_time, \
+    save_changes_over_time, update_test_history_on_s3, load_test_history
+from emmaa.util import get_s3_client
 
 
 TestRound.__test__ = False
@@ -42,6 +50,92 @@ def test_test_round():
     assert tr2.find_numeric_delta(tr, 'passed_over_total') == 0
 
 
+def test_stored_hashes():
+    previous = json.loads(json.dumps(previous_results))
+    new = json.loads(json.dumps(new_results))
+    # Stored hashes are used as they are without deserializing statements
+    for results, hashes in [(previous, [1, 2]), (new, [2, 3, 4, 5])]:
+        for stmt_json, stmt_hash in zip(results[0]['statements'], hashes):
+            stmt_json['matches_hash'] = stmt_hash
+    for ix, res in enumerate(new[1:]):
+        res['test_hash'] = str(ix)
+    tr = TestRound(previous)
+    tr2 = TestRound(new)
+    delta = tr2.find_delta_hashes(tr, 'statements')
+    assert sorted(delta['added']) == ['3', '4', '5']
+    assert delta['removed'] == ['1']
+    assert tr2.get_applied_test_hashes() == ['0', '1']
+    assert tr2.get_passed_test_hashes() == ['0', '1']
+    assert tr2._statements is None
+    assert tr2._tests is None
+
+
+def test_duplicate_test_hashes():
+    results = json.loads(json.dumps(new_results))
+    results.append(json.loads(json.dumps(results[1])))
+    for res, test_hash, passed in zip(results[1:], ['test', 'other', 'test'],
+                                      [True, False, False]):
+        res['test_hash'] = test_hash
+        res['pysb']['result_json']['path_found'] = passed
+    # A test applied more than once is counted once with its last result
+    tr = TestRound(results)
+    assert tr.get_applied_test_hashes() == ['test', 'other']
+    assert tr.get_passed_test_hashes() == []
+    results[3]['pysb']['result_json']['path_found'] = True
+    tr = TestRound(results)
+    assert tr.get_passed_test_hashes() == ['test']
+    history = update_test_history(None, tr, '2019-09-01-00-00-00')
+    assert history['tests']['test']['pysb'] == [['Pass', 0, 0]]
+
+
+def test_test_round_lazy():
+    a, b, c = [Agent(name) for name in 'ABC']
+    stmts = [Activation(a, b), Inhibition(b, c), Activation(a, c)]
+    tests = [Activation(a, c), Inhibition(a, c)]
+    results = [PathResult(True, 'PATHS_FOUND', 1, 5),
+               PathResult(False, 'NO_PATHS_FOUND', 1, 5)]
+    pickler = jsonpickle.pickler.Pickler()
+    json_results = [{'model_name': 'test',
+                     'statements': [stmt.to_json() for stmt in stmts],
+                     'mc_types': ['signed_graph'], 'make_links': False}]
+    for test, result in zip(tests, results):
+        json_results.append({
+            'test_type': 'StatementCheckingTest',
+            'test_json': test.to_json(),
+            'signed_graph': {'result_json': pickler.flatten(result),
+                             'path_json': [],
+                             'result_code': result.result_code}})
+    tr = TestRound(json_results)
+    assert tr.mc_types == ['signed_graph']
+    assert tr.get_total_statements() == 3
+    assert tr.get_stmt_hashes() == [str(stmt.get_hash()) for stmt in stmts]
+    assert tr.get_statement_types() == [('Activation', 2), ('Inhibition', 1)]
+    test_hashes = [str(test.get_hash()) for test in tests]
+    assert tr.get_applied_test_hashes() == test_hashes
+    assert tr.get_passed_test_hashes('signed_graph') == test_hashes[:1]
+    assert tr.passed_over_total('signed_graph') == 0.5
+    # None of the above needed to deserialize statements or results
+    assert tr._statements is None
+    assert tr._tests is None
+    assert not tr._mc_types_results
+    assert tr.get_path_or_code_by_hash(test_hashes[1], 'signed_graph') == \
+        'NO_PATHS_FOUND'
+    assert isinstance(tr.mc_types_results['signed_graph'][0], PathResult)
+
+
+def test_model_summary_top():
+    tr = TestRound(new_results)
+    assert tr.get_statement_types(top=1) == [('Activation', 4)]
+    agent_distr = tr.get_agent_distribution()
+    assert len(agent_distr) == 5
+    assert tr.get_agent_distribution(top=3) == agent_distr[:3]
+    assert [count for _, count in agent_distr] == [2, 2, 2, 1, 1]
+    assert tr.get_statements_by_evidence(top=2) == \
+        tr.get_statements_by_evidence()[:2]
+    # The summary is computed from the statement JSON
+    assert tr._statements is None
+
+
 @attr('nonpublic')
 def test_stats_generator():
     latest_round = TestRound(new_results)
@@ -68,9 +162,151 @@ def test_stats_generator():
     tests_delta = sg.json_stats['tests_delta']
     assert len(tests_delta['applied_hashes_delta']['added']) == 1
     assert len(tests_delta['pysb']['passed_hashes_delta']['added']) == 1
+    # Only the latest round is stored in the stats
     changes = sg.json_stats['changes_over_time']
+    assert changes['number_of_statements'] == [4]
+    assert len(changes['dates']) == 1
+    assert changes['pysb']['number_passed_tests'] == [2]
+    changes = sg.get_changes_over_time()
     assert changes['number_of_statements'] == [2, 4]
     assert changes['number_applied_tests'] == [1, 2]
     assert len(changes['dates']) == 2
     assert changes['pysb']['number_passed_tests'] == [1, 2]
     assert changes['pysb']['passed_ratio'] == [1, 1]
+    assert len(sg.previous_changes) == 1
+    assert sg.changes_row['pysb'] == {'number_passed_tests': 2,
+                                      'passed_ratio': 1.0}
+
+
+def test_changes_over_time_rows():
+    changes = {'dates': ['2019-09-01-00-00-00', '2019-09-02-00-00-00'],
+               'number_of_statements': [2, 4],
+               'number_applied_tests': [1, 2],
+               'pysb': {'number_passed_tests': [1, 2],
+                        'passed_ratio': [1.0, 1.0]},
+               'signed_graph': {'number_passed_tests': [0],
+                                'passed_ratio': [0.0]}}
+    rows = changes_over_time_to_rows(changes)
+    assert len(rows) == 2
+    assert 'signed_graph' not in rows[0]
+    assert rows[1]['signed_graph'] == {'number_passed_tests': 0,
+                                       'passed_ratio': 0.0}
+    assert rows_to_changes_over_time(rows) == changes
+
+
+@attr('nonpublic')
+def test_make_stats_from_inputs():
+    previous_changes = changes_over_time_to_rows(
+        previous_stats['changes_over_time'])
+    json_stats, changes = make_stats_from_inputs(
+        {'model_name': 'test', 'latest_results': new_results,
+         'previous_results': previous_results,
+         'previous_changes': previous_changes})
+    assert json_stats['model_summary']['number_of_statements'] == 4
+    tests_delta = json_stats['tests_delta']
+    assert len(tests_delta['applied_hashes_delta']['added']) == 1
+    assert len(changes) == 2
+    assert changes[0] == previous_changes[0]
+    assert changes[1]['number_of_statements'] == 4
+
+
+def test_regenerate_stats():
+    os.environ['EMMAA_STORAGE_BACKEND'] = 'memory'
+    client = get_s3_client()
+    # Without links the stats do not need the INDRA DB REST config
+    previous, new = json.loads(json.dumps([previous_results, new_results]))
+    previous[0]['make_links'] = new[0]['make_links'] = False
+    try:
+        for date, results in [('2019-09-01-00-00-00', previous),
+                              ('2019-09-02-00-00-00', new)]:
+            client.put_object(Bucket='emmaa',
+                              Key=f'results/test/results_{date}.json',
+                              Body=json.dumps(results))
+        # The latest round was logged with the date its stats were made
+        rows = changes_over_time_to_rows(previous_stats['changes_over_time'])
+        rows[0]['date'] = '2019-09-01-00-10-00'
+        rows.append(dict(rows[0], date='2019-09-02-00-10-00'))
+        save_changes_over_time('test', rows, client=client)
+        client.put_object(Bucket='emmaa',
+                          Key='stats/test/stats_2019-09-02-00-10-00.json',
+                          Body='{}')
+        # Generating the stats of the round again replaces them
+        for processes in [1, 2]:
+            generate_stats_for_models(['test'], processes=processes)
+            rows = load_changes_over_time('test')
+            assert [row['date'] for row in rows] == [
+                '2019-09-01-00-10-00', '2019-09-02-00-00-00']
+            assert rows[1]['number_of_statements'] == 4
+            stats_keys = [c['Key'] for c in client.list_objects(
+                Bucket='emmaa', Prefix='stats/test/stats_')['Contents']]
+            assert stats_keys == ['stats/test/stats_2019-09-02-00-10-00.json']
+        # A new round is added
+        client.put_object(Bucket='emmaa',
+                          Key='results/test/results_2019-09-03-00-00-00.json',
+                          Body=json.dumps(new))
+        generate_stats_for_models(['test'], processes=1)
+        assert len(load_changes_over_time('test')) == 3
+        assert len(client.list_objects(
+            Bucket='emmaa', Prefix='stats/test/stats_')['Contents']) == 2
+    finally:
+        del os.environ['EMMAA_STORAGE_BACKEND']
+        client.clear()
+
+
+def test_test_history():
+    rounds = []
+    for passed in [False, True, True, None, True]:
+        results = json.loads(json.dumps(new_results[:2]))
+        results[1]['test_hash'] = 'test'
+        results[1]['pysb']['result_json']['path_found'] = passed
+        # The test was not applied in a round if passed is None
+        rounds.append(results if passed is not None else results[:1])
+    history = None
+    for ix, results in enumerate(rounds):
+        history = update_test_history(history, TestRound(results),
+                                      f'2019-09-0{ix + 1}-00-00-00')
+    # Adding the same round again does not change the history
+    history = update_test_history(history, TestRound(rounds[-1]),
+                                  '2019-09-05-00-00-00')
+    assert len(history['dates']) == 5
+    assert history['tests']['test']['pysb'] == [
+        ['Fail', 0, 0], ['Pass', 1, 2], ['Pass', 4, 4]]
+    test_history = get_test_history('test', 'test', history=history)
+    assert test_history['pysb'][1] == {
+        'status': 'Pass', 'start': '2019-09-02-00-00-00',
+        'end': '2019-09-03-00-00-00', 'rounds': 2}
+    assert get_test_history('test', 'test', 'signed_graph',
+                            history=history) == {}
+
+
+def test_update_test_history_on_s3():
+    os.environ['EMMAA_STORAGE_BACKEND'] = 'memory'
+    client = get_s3_client()
+    dates = ['2019-09-01-00-00-00', '2019-09-02-00-00-00']
+    rounds = []
+    for passed in [False, True]:
+        results = json.loads(json.dumps(new_results[:2]))
+        results[1]['test_hash'] = 'test'
+        results[1]['pysb']['result_json']['path_found'] = passed
+        rounds.append(TestRound(results))
+    get_object = client.get_object
+
+    def get_object_and_update(**kwargs):
+        # Another process adds the first round after the index is read
+        del client.get_object
+        try:
+            return get_object(**kwargs)
+        finally:
+            update_test_history_on_s3('test', rounds[0], dates[0])
+    client.get_object = get_object_and_update
+    try:
+        history = update_test_history_on_s3('test', rounds[1], dates[1])
+        assert history['dates'] == dates
+        assert history['tests']['test']['pysb'] == [
+            ['Fail', 0, 0], ['Pass', 1, 1]]
+        assert load_test_history('test') == history
+    finally:
+        if 'get_object' in client.__dict__:
+            del client.get_object
+        del os.environ['EMMAA_STORAGE_BACKEND']
+        client.clear()
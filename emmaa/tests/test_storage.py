@@ -0,0 +1,160 @@
+import os
+import shutil
+import tempfile
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError
+from emmaa.storage import MemoryStorageClient, DirectoryStorageClient
+from emmaa.util import get_s3_client, find_latest_s3_file, S3Metrics, \
+    fetch_s3_objects
+
+
+def _check_client(client):
+    client.put_object(Bucket='emmaa', Key='models/a/config.json', Body=b'{}')
+    client.put_object(Bucket='emmaa', Key='models/b/model_1.pkl',
+                      Body='model')
+    client.put_object(Bucket='emmaa', Key='results/a/results.json',
+                      Body=b'[]')
+    obj = client.get_object(Bucket='emmaa', Key='models/b/model_1.pkl')
+    assert obj['Body'].read() == b'model'
+    head = client.head_object(Bucket='emmaa', Key='models/b/model_1.pkl')
+    assert head['ETag'] == obj['ETag']
+    assert head['LastModified']
+    resp = client.list_objects(Bucket='emmaa', Prefix='models/')
+    assert [c['Key'] for c in resp['Contents']] == [
+        'models/a/config.json', 'models/b/model_1.pkl']
+    resp = client.list_objects_v2(Bucket='emmaa', Prefix='models/',
+                                  Delimiter='/')
+    assert 'Contents' not in resp
+    assert resp['CommonPrefixes'] == [{'Prefix': 'models/a/'},
+                                      {'Prefix': 'models/b/'}]
+    pages = list(client.get_paginator('list_objects_v2').paginate(
+        Bucket='emmaa', Prefix='results/'))
+    assert len(pages) == 1
+    assert pages[0]['KeyCount'] == 1
+    assert 'Contents' not in client.list_objects(Bucket='emmaa',
+                                                 Prefix='stats/')
+    for method in [client.get_object, client.head_object]:
+        try:
+            method(Bucket='emmaa', Key='models/c/config.json')
+            assert False, 'Expected ClientError'
+        except ClientError:
+            pass
+    # Conditional writes fail if the object changed or already exists
+    resp = client.put_object(Bucket='emmaa', Key='models/b/model_1.pkl',
+                             Body='model2', IfMatch=head['ETag'])
+    client.put_object(Bucket='emmaa', Key='models/c/config.json',
+                      Body=b'{}', IfNoneMatch='*')
+    for kwargs in [{'Key': 'models/b/model_1.pkl', 'IfMatch': head['ETag']},
+                   {'Key': 'models/c/config.json', 'IfNoneMatch': '*'}]:
+        try:
+            client.put_object(Bucket='emmaa', Body=b'', **kwargs)
+            assert False, 'Expected ClientError'
+        except ClientError as e:
+            assert e.response['Error']['Code'] == 'PreconditionFailed'
+    obj = client.get_object(Bucket='emmaa', Key='models/b/model_1.pkl')
+    assert obj['Body'].read() == b'model2'
+    assert obj['ETag'] == resp['ETag']
+
+
+def test_memory_storage():
+    _check_client(MemoryStorageClient())
+
+
+def test_directory_storage():
+    path = tempfile.mkdtemp()
+    try:
+        _check_client(DirectoryStorageClient(path))
+        assert os.path.isfile(os.path.join(path, 'emmaa', 'models', 'a',
+                                           'config.json'))
+    finally:
+        shutil.rmtree(path)
+
+
+def test_storage_backend_from_env():
+    os.environ['EMMAA_STORAGE_BACKEND'] = 'memory'
+    try:
+        client = get_s3_client()
+        assert isinstance(client, MemoryStorageClient)
+        client.put_object(Bucket='emmaa', Key='stats/a/stats_2019-01-01-'
+                          '00-00-00.json', Body=b'{}')
+        client.put_object(Bucket='emmaa', Key='stats/a/stats_2019-02-01-'
+                          '00-00-00.json', Body=b'{}')
+        assert find_latest_s3_file('emmaa', 'stats/a/stats_', '.json') == \
+            'stats/a/stats_2019-02-01-00-00-00.json'
+    finally:
+        del os.environ['EMMAA_STORAGE_BACKEND']
+        client.clear()
+
+
+def test_fetch_s3_objects():
+    os.environ['EMMAA_STORAGE_BACKEND'] = 'memory'
+    try:
+        client = get_s3_client()
+        for ix in range(3):
+            client.put_object(Bucket='emmaa', Key=f'results/a/{ix}.json',
+                              Body=str(ix))
+        keys = ['results/a/2.json', None, 'results/a/missing.json',
+                'results/a/0.json', 'results/a/1.json']
+        assert fetch_s3_objects(keys, max_workers=2) == \
+            [b'2', None, None, b'0', b'1']
+        assert fetch_s3_objects(['results/a/1.json']) == [b'1']
+        assert fetch_s3_objects([]) == []
+    finally:
+        del os.environ['EMMAA_STORAGE_BACKEND']
+        client.clear()
+
+
+class _RawResponse(object):
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+def test_shared_s3_client():
+    client = get_s3_client()
+    assert client is get_s3_client()
+    assert client is not get_s3_client(unsigned=False)
+    assert client.meta.config.max_pool_connections >= 10
+    metrics = S3Metrics()
+    metrics.register(client)
+
+    # Answer requests locally instead of sending them to S3
+    def respond(request, **kwargs):
+        if request.method == 'HEAD':
+            return AWSResponse(request.url, 200, {'ETag': '"etag"'},
+                               _RawResponse(b''))
+        return AWSResponse(request.url, 404, {}, _RawResponse(
+            b'<Error><Code>NoSuchKey</Code><Message></Message></Error>'))
+    client.meta.events.register('before-send.s3', respond)
+    try:
+        client.head_object(Bucket='emmaa', Key='test')
+        try:
+            client.get_object(Bucket='emmaa', Key='test')
+            assert False, 'Expected ClientError'
+        except ClientError:
+            pass
+    finally:
+        client.meta.events.unregister('before-send.s3', respond)
+        client.meta.events.unregister('before-call.s3', metrics._before_call)
+        client.meta.events.unregister('after-call.s3', metrics._after_call)
+        client.meta.events.unregister('after-call-error.s3',
+                                      metrics._after_call_error)
+    stats = metrics.to_json()
+    assert stats['HeadObject']['requests'] == 1
+    assert stats['HeadObject']['errors'] == 0
+    assert stats['GetObject']['errors'] == 1
+
+
+def test_s3_clients_after_fork():
+    if not hasattr(os, 'register_at_fork'):
+        return
+    client = get_s3_client()
+    pid = os.fork()
+    if pid == 0:
+        # The child creates its own client instead of sharing the parent's
+        os._exit(0 if get_s3_client() is not client else 1)
+    _, status = os.waitpid(pid, 0)
+    assert status == 0
+    assert get_s3_client() is client
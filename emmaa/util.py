@@ -1,12 +1,17 @@
 import os
 import re
+import time
 import boto3
 import logging
+import threading
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from botocore import UNSIGNED
+from botocore.exceptions import ClientError
 from botocore.client import Config
 from inflection import camelize
 from indra.statements import get_all_descendants
+from emmaa.storage import get_storage_backend, get_local_storage_client
 
 
 FORMAT = '%Y-%m-%d-%H-%M-%S'
@@ -14,6 +19,15 @@ RE_DATEFORMAT = r'\d{4}\-\d{2}\-\d{2}\-\d{2}\-\d{2}\-\d{2}'
 logger = logging.getLogger(__name__)
 
 
+# The connection pool and retries of S3 clients can be set in the environment.
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get('EMMAA_S3_MAX_POOL_CONNECTIONS',
+                                             50))
+S3_RETRY_MODE = os.environ.get('EMMAA_S3_RETRY_MODE', 'standard')
+S3_MAX_ATTEMPTS = int(os.environ.get('EMMAA_S3_MAX_ATTEMPTS', 5))
+# Number of objects downloaded at the same time by fetch_s3_objects.
+S3_FETCH_WORKERS = int(os.environ.get('EMMAA_S3_FETCH_WORKERS', 8))
+
+
 def strip_out_date(keystring):
     """Strips out datestring of format FORMAT from a keystring"""
     try:
@@ -105,9 +119,85 @@ def find_number_of_files_on_s3(bucket, prefix, extension=None):
     return len(files)
 
 
+class S3Metrics(object):
+    """Collects the number, errors and latency of S3 requests per operation.
+    """
+    def __init__(self):
+        self.operations = {}
+        self._lock = threading.Lock()
+        self._context_key = f'emmaa_s3_metrics_{id(self)}'
+
+    def register(self, client):
+        """Record the requests made with a boto3 client."""
+        events = client.meta.events
+        events.register_first('before-call.s3', self._before_call)
+        events.register('after-call.s3', self._after_call)
+        events.register('after-call-error.s3', self._after_call_error)
+
+    def _before_call(self, model, context, **kwargs):
+        # The operation is not passed to the error event, so it is kept in
+        # the request context together with the start time
+        context[self._context_key] = (model.name, time.time())
+
+    def _after_call(self, http_response, context, **kwargs):
+        # Error responses like a missing key are raised after this event
+        self._add(context, error=http_response.status_code >= 300)
+
+    def _after_call_error(self, context, **kwargs):
+        self._add(context, error=True)
+
+    def _add(self, context, error):
+        if self._context_key not in context:
+            return
+        operation, start = context.pop(self._context_key)
+        seconds = time.time() - start
+        with self._lock:
+            op = self.operations.setdefault(
+                operation, {'requests': 0, 'errors': 0, 'time': 0.0,
+                            'max_time': 0.0})
+            op['requests'] += 1
+            op['errors'] += int(error)
+            op['time'] += seconds
+            op['max_time'] = max(op['max_time'], seconds)
+
+    def to_json(self):
+        with self._lock:
+            return {operation: {
+                'requests': op['requests'], 'errors': op['errors'],
+                'mean_time': op['time'] / op['requests'],
+                'max_time': op['max_time']}
+                for operation, op in self.operations.items()}
+
+
+s3_metrics = S3Metrics()
+_s3_clients = {}
+_s3_clients_lock = threading.Lock()
+
+
+def _clear_s3_clients_after_fork():
+    # A forked child must not reuse the connections of the parent's clients
+    # and inherits the locks in the state the parent's threads held them in
+    global _s3_clients_lock
+    _s3_clients_lock = threading.Lock()
+    _s3_clients.clear()
+    s3_metrics._lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_clear_s3_clients_after_fork)
+
+
 def get_s3_client(unsigned=True):
     """Return a boto3 S3 client with optional unsigned config.
 
+    One signed and one unsigned client are created per process and shared
+    by all callers (boto3 clients are thread safe), so their connection
+    pools are reused. Requests made with them are recorded in s3_metrics.
+    A forked child process creates its own clients.
+    If a local storage backend is set with the EMMAA_STORAGE_BACKEND
+    environment variable, a client of that backend with the same interface
+    is returned instead (see emmaa.storage).
+
     Parameters
     ----------
     unsigned : Optional[bool]
@@ -116,13 +206,86 @@ def get_s3_client(unsigned=True):
 
     Returns
     -------
-    botocore.client.S3
-        A client object to AWS S3.
+    botocore.client.S3 or emmaa.storage.LocalStorageClient
+        A client object to AWS S3 or a local stand-in for it.
     """
-    if unsigned:
-        return boto3.client('s3', config=Config(signature_version=UNSIGNED))
-    else:
-        return boto3.client('s3')
+    if get_storage_backend() != 's3':
+        return get_local_storage_client()
+    unsigned = bool(unsigned)
+    client = _s3_clients.get(unsigned)
+    if client is not None:
+        return client
+    with _s3_clients_lock:
+        if unsigned not in _s3_clients:
+            config = Config(
+                max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                retries={'mode': S3_RETRY_MODE,
+                         'max_attempts': S3_MAX_ATTEMPTS})
+            if unsigned:
+                config = config.merge(Config(signature_version=UNSIGNED))
+            # Sessions are not thread safe, so each client gets its own
+            client = boto3.session.Session().client('s3', config=config)
+            s3_metrics.register(client)
+            _s3_clients[unsigned] = client
+        return _s3_clients[unsigned]
+
+
+def clear_s3_clients():
+    """Remove the shared S3 clients so new ones are created when needed.
+
+    This is needed after changing the AWS credentials or configuration of
+    the process.
+    """
+    with _s3_clients_lock:
+        _s3_clients.clear()
+
+
+def fetch_s3_objects(keys, bucket='emmaa', unsigned=True,
+                     max_workers=S3_FETCH_WORKERS):
+    """Download several objects from s3 at the same time.
+
+    The objects are downloaded in threads with the shared S3 client, so
+    loading them takes about as long as loading the largest one.
+
+    Parameters
+    ----------
+    keys : list[str or None]
+        The keys of the objects to download. None can be given in place of
+        a key that is not needed, e.g. when an earlier listing did not find
+        it.
+    bucket : Optional[str]
+        The bucket of the objects. Default: emmaa
+    unsigned : Optional[bool]
+        If True, an unsigned client is used. Default: True
+    max_workers : Optional[int]
+        The maximum number of objects downloaded at the same time.
+
+    Returns
+    -------
+    list[bytes or None]
+        The contents of the objects in the order of the keys. The content
+        is None for keys that were None or not found on s3.
+    """
+    client = get_s3_client(unsigned=unsigned)
+
+    def fetch(key):
+        if key is None:
+            return None
+        logger.info(f'Loading {key} from {bucket}')
+        try:
+            obj = client.get_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            logger.info(f'Could not find {key} in {bucket}.')
+            return None
+        return obj['Body'].read()
+
+    needed = [key for key in keys if key is not None]
+    if len(needed) < 2:
+        return [fetch(key) for key in keys]
+    with ThreadPoolExecutor(min(max_workers, len(needed))) as executor:
+        return list(executor.map(fetch, keys))
 
 
 def get_class_from_name(cls_name, parent_cls):
@@ -1,11 +1,13 @@
 import re
 import json
-import boto3
+import time
 import logging
 import argparse
+from os import environ
 from urllib import parse
 from botocore.exceptions import ClientError
-from flask import abort, Flask, request, Response, render_template, jsonify
+from flask import abort, Flask, request, Response, render_template, jsonify, \
+    url_for
 from flask_jwt_extended import get_jwt_identity, jwt_optional
 
 from indra.statements import get_all_descendants, IncreaseAmount, \
@@ -14,7 +16,7 @@ from indra.statements import get_all_descendants, IncreaseAmount, \
 
 from emmaa.util import find_latest_s3_file, strip_out_date, get_s3_client
 from emmaa.model import load_config_from_s3
-from emmaa.answer_queries import QueryManager, load_model_manager_from_s3
+from emmaa.answer_queries import QueryManager, ModelManagerPreloader
 from emmaa.queries import PathProperty, get_agent_from_text, GroundingError
 
 from indralab_auth_tools.auth import auth, config_auth, resolve_auth
@@ -43,7 +45,7 @@ qm = QueryManager()
 
 
 def _get_model_meta_data():
-    s3 = boto3.client('s3')
+    s3 = get_s3_client(unsigned=False)
     resp = s3.list_objects(Bucket=EMMAA_BUCKET_NAME, Prefix='models/',
                            Delimiter='/')
     model_data = []
@@ -98,6 +100,34 @@ def get_model_stats(model, extension='.json'):
     return json.loads(model_data_object['Body'].read().decode('utf8'))
 
 
+def get_model_changes_over_time(model, start_date=None, end_date=None):
+    """Gets the changes over time for the given model
+
+    Parameters
+    ----------
+    model : str
+        Model name to look for
+    start_date : str
+        If given, only include test rounds on or after this date.
+    end_date : str
+        If given, only include test rounds on or before this date.
+
+    Returns
+    -------
+    changes : json
+        The json formatted changes over time in the format of the statistics
+        or None if the model does not have a changes over time log.
+    """
+    # Imported here because emmaa.analyze_tests_results loads the INDRA DB
+    # REST client and the EnglishAssembler, which slows down startup
+    from emmaa.analyze_tests_results import load_changes_over_time, \
+        rows_to_changes_over_time
+    rows = load_changes_over_time(model, start_date, end_date)
+    if rows is None:
+        return None
+    return rows_to_changes_over_time(rows)
+
+
 def model_last_updated(model, extension='.pkl'):
     """Find the most recent pickle file of model and return its creation date
 
@@ -128,14 +158,31 @@ def model_last_updated(model, extension='.pkl'):
         return ''
 
 
-GLOBAL_PRELOAD = False
+def _get_model_names():
+    return [model for model, _ in _get_model_meta_data()]
+
+
+# Model managers are preloaded in a background thread so that the service
+# can start accepting requests right away.
+GLOBAL_PRELOAD = environ.get('EMMAA_PRELOAD', '').lower() in ('1', 'true')
+# The test history index of a model is cached and only checked for changes
+# on s3 once in this many seconds.
+TEST_HISTORY_CHECK_INTERVAL = float(
+    environ.get('EMMAA_TEST_HISTORY_CHECK_INTERVAL', 300))
 model_cache = {}
-if GLOBAL_PRELOAD:
-    # Load all the model configs
-    model_meta_data = _get_model_meta_data()
-    # Load all the model managers for queries
-    for model, _ in model_meta_data:
-        load_model_manager_from_s3(model)
+test_history_cache = {}
+preloader = ModelManagerPreloader(_get_model_names)
+
+
+@app.before_request
+def start_preloader():
+    # The thread is only started on the first request of each process and
+    # not at import. When the app is imported before the server forks its
+    # workers (e.g. Gunicorn with --preload), a thread started at import
+    # would load all model managers into the master and could hold locks
+    # that the forked workers inherit.
+    if GLOBAL_PRELOAD:
+        preloader.start()
 
 
 def get_queryable_stmt_types():
@@ -259,6 +306,12 @@ def get_model_dashboard(model):
         [('', 'Network on Ndex'),
          (f'http://www.ndexbio.org/#/network/{ndex_id}', ndex_id)]]
     model_stats = get_model_stats(model)
+    # The statistics only contain the latest round, the history is in a
+    # separate log that can be limited to a date range
+    changes = get_model_changes_over_time(model, request.args.get('start'),
+                                          request.args.get('end'))
+    if changes is not None:
+        model_stats['changes_over_time'] = changes
     all_new_tests = [(k, v) for k, v in model_stats['test_round_summary'][
         'all_test_results'].items()]
     current_model_types = [mt for mt in ALL_MODEL_TYPES if mt in
@@ -294,6 +347,55 @@ def get_model_dashboard(model):
                                model, model_stats, current_model_types))
 
 
+@app.route('/stats/<model>/changes_over_time')
+def get_changes_over_time(model):
+    changes = get_model_changes_over_time(model, request.args.get('start'),
+                                          request.args.get('end'))
+    if changes is None:
+        abort(Response(f'No changes over time found for {model}', 404))
+    return jsonify(changes)
+
+
+def get_test_history_index(model):
+    """Return the cached test history index of a model.
+
+    The cached index is checked against the ETag of the index on s3 at most
+    once per TEST_HISTORY_CHECK_INTERVAL and only downloaded again if it
+    changed.
+    """
+    from emmaa.analyze_tests_results import load_test_history, \
+        get_test_history_etag
+    cached = test_history_cache.get(model)
+    now = time.time()
+    if cached and now - cached['checked'] < TEST_HISTORY_CHECK_INTERVAL:
+        return cached['history']
+    etag = get_test_history_etag(model)
+    if etag is None:
+        history = None
+    elif cached and cached['etag'] == etag:
+        history = cached['history']
+    else:
+        history = load_test_history(model)
+    test_history_cache[model] = {'etag': etag, 'history': history,
+                                 'checked': now}
+    return history
+
+
+@app.route('/test_history/<model>/<test_hash>')
+def get_test_history_json(model, test_hash):
+    from emmaa.analyze_tests_results import get_test_history
+    model_type = request.args.get('model_type')
+    if model_type and model_type not in ALL_MODEL_TYPES:
+        abort(Response(f'Model type {model_type} does not exist', 404))
+    history = get_test_history_index(model)
+    test_history = get_test_history(model, test_hash, model_type,
+                                    history=history) if history else None
+    if not test_history:
+        abort(Response(f'No history found for test {test_hash} in {model}',
+                       404))
+    return jsonify(test_history)
+
+
 @app.route('/tests/<model>/<model_type>/<test_hash>')
 def get_model_tests_page(model, model_type, test_hash):
     if model_type not in ALL_MODEL_TYPES:
@@ -404,6 +506,19 @@ def process_query():
         logger.info('Test passed')
         res = {'result': 'test passed', 'ref': None}
 
+    elif request.json.get('async'):
+        # Answer the query in the background and let the client poll
+        # /query/status/<job_id> for the results.
+        logger.info('Query submitted asynchronously')
+        try:
+            job_id = qm.submit_immediate_query(
+                user_email, user_id, query, models, subscribe)
+        except Exception as e:
+            logger.exception(e)
+            raise(e)
+        res = {'job_id': job_id,
+               'status_url': url_for('get_query_status', job_id=job_id)}
+
     else:
         logger.info('Query submitted')
         try:
@@ -419,6 +534,17 @@ def process_query():
     return Response(json.dumps(res), mimetype='application/json')
 
 
+@app.route('/query/status/<job_id>', methods=['GET'])
+def get_query_status(job_id):
+    # The QueryManager keeps jobs in a LocalQueryJobStore in the memory of
+    # the process answering them, so the service has to run a single worker
+    # process (with several threads) until a shared job store is used.
+    status = qm.get_job_status(job_id)
+    if status is None:
+        abort(Response(f'Unknown query job: {job_id}', 404))
+    return Response(json.dumps(status), mimetype='application/json')
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser('Run the EMMAA dashboard service.')
     parser.add_argument('--host', default='0.0.0.0')
@@ -426,13 +552,8 @@ if __name__ == '__main__':
     parser.add_argument('--preload', action='store_true')
     args = parser.parse_args()
 
-    # TODO: make pre-loading available when running service via Gunicorn
-    if args.preload and not GLOBAL_PRELOAD:
-        # Load all the model configs
-        model_meta_data = _get_model_meta_data()
-        # Load all the model mamangers for queries
-        for model, _ in model_meta_data:
-            load_model_manager_from_s3(model)
+    if args.preload:
+        preloader.start()
 
     print(app.url_map)  # Get all avilable urls and link them
     app.run(host=args.host, port=args.port)
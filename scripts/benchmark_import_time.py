@@ -0,0 +1,91 @@
+"""Measure the import time of EMMAA's main entry points.
+
+Each module is imported in a fresh interpreter with `python -X importtime`
+and the cumulative import time of the module is reported together with its
+slowest dependencies. If a limit is given, the script exits with a non-zero
+status when any of the modules takes longer to import, so it can be used as
+a regression guard for startup time, e.g.:
+
+$ python scripts/benchmark_import_time.py --max-seconds 2
+"""
+import re
+import sys
+import argparse
+import subprocess
+
+
+ENTRY_POINTS = ['emmaa.model', 'emmaa.model_tests', 'emmaa.answer_queries',
+                'emmaa.analyze_tests_results', 'emmaa_service.api']
+IMPORT_TIME_LINE = re.compile(
+    r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$')
+
+
+def get_import_times(module):
+    """Return the import times of a module and all modules it imports.
+
+    Parameters
+    ----------
+    module : str
+        The name of the module to import.
+
+    Returns
+    -------
+    times : list[tuple]
+        A list of tuples (module name, self time, cumulative time, depth) for
+        each imported module with times in seconds.
+    """
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    if proc.returncode != 0:
+        raise ImportError(f'Could not import {module}:\n{proc.stderr}')
+    times = []
+    for line in proc.stderr.splitlines():
+        m = IMPORT_TIME_LINE.match(line)
+        if m:
+            self_us, cumulative_us, indent, name = m.groups()
+            times.append((name, int(self_us) / 1e6, int(cumulative_us) / 1e6,
+                          len(indent) // 2))
+    return times
+
+
+def get_total_import_time(module, times):
+    """Return the cumulative import time of a module in seconds."""
+    for name, _, cumulative, _ in times:
+        if name == module:
+            return cumulative
+    return 0.0
+
+
+def report(module, times, top=10):
+    total = get_total_import_time(module, times)
+    print(f'{module}: {total:.3f} s ({len(times)} modules imported)')
+    slowest = sorted(times, key=lambda t: t[1], reverse=True)[:top]
+    for name, self_time, cumulative, _ in slowest:
+        print(f'    {name}: self {self_time:.3f} s, '
+              f'cumulative {cumulative:.3f} s')
+    return total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure the import time of EMMAA entry points.')
+    parser.add_argument('-m', '--modules', nargs='+', default=ENTRY_POINTS,
+                        help='Modules to import.')
+    parser.add_argument('-t', '--top', type=int, default=10,
+                        help='Number of slowest imports to show per module.')
+    parser.add_argument('--max-seconds', type=float,
+                        help='Fail if any module takes longer to import.')
+    args = parser.parse_args()
+
+    too_slow = []
+    for module in args.modules:
+        times = get_import_times(module)
+        total = report(module, times, args.top)
+        if args.max_seconds is not None and total > args.max_seconds:
+            too_slow.append(module)
+    if too_slow:
+        print(f'Import time exceeds {args.max_seconds} s for: '
+              f'{", ".join(too_slow)}')
+        sys.exit(1)
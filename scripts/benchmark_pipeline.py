@@ -0,0 +1,184 @@
+"""Measure how the test and stats pipeline scales with the size of a model.
+
+A synthetic model of INDRA Statements and a synthetic test corpus are
+generated for each size and the whole pipeline (ModelManager, making and
+running tests, results_to_json, TestRound, StatsGenerator and uploading the
+results) is run offline. The time and peak memory of each stage are
+reported. Uploads go to the in-memory storage backend (see emmaa.storage)
+unless another one is set with EMMAA_STORAGE_BACKEND. If a limit is given,
+the script exits with a non-zero status when the pipeline takes longer at
+any size, so it can be used as a regression guard, e.g.:
+
+$ python scripts/benchmark_pipeline.py -s 1000 10000 100000
+$ python scripts/benchmark_pipeline.py -s 1000 --max-seconds 60
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tracemalloc
+from indra.statements import Activation, Inhibition, IncreaseAmount, \
+    DecreaseAmount, Agent, Evidence
+from emmaa.model import EmmaaModel
+from emmaa.model_tests import ModelManager, TestManager, \
+    ScopeTestConnector, StatementCheckingTest
+from emmaa.analyze_tests_results import TestRound, StatsGenerator, \
+    save_stats_to_s3, update_test_history
+from emmaa.util import make_date_str
+
+
+# Run offline unless another storage backend is set
+os.environ.setdefault('EMMAA_STORAGE_BACKEND', 'memory')
+
+
+STMT_TYPES = [Activation, Inhibition, IncreaseAmount, DecreaseAmount]
+MODEL_NAME = 'benchmark'
+
+
+def make_agent(ix):
+    """Return a synthetic grounded Agent."""
+    return Agent(f'GENE{ix}', db_refs={'HGNC': str(ix)})
+
+
+def make_statements(num_stmts, num_agents, seed=0):
+    """Return a list of random statements between a number of agents."""
+    rng = random.Random(seed)
+    stmts = []
+    for ix in range(num_stmts):
+        subj, obj = rng.sample(range(num_agents), 2)
+        evidence = [Evidence(source_api='benchmark', text=f'Sentence {ix}.')
+                    for _ in range(rng.randint(1, 5))]
+        stmt_type = rng.choice(STMT_TYPES)
+        stmts.append(stmt_type(make_agent(subj), make_agent(obj),
+                               evidence=evidence))
+    return stmts
+
+
+def make_tests(num_tests, num_agents, seed=1):
+    """Return a list of random tests between a number of agents."""
+    rng = random.Random(seed)
+    tests = []
+    for _ in range(num_tests):
+        subj, obj = rng.sample(range(num_agents), 2)
+        stmt_type = rng.choice([Activation, Inhibition])
+        tests.append(StatementCheckingTest(
+            stmt_type(make_agent(subj), make_agent(obj))))
+    return tests
+
+
+def make_model(stmts, mc_types):
+    """Return an EmmaaModel with the statements as its assembled model."""
+    config = {'search_terms': [],
+              'test': {'mc_types': mc_types, 'make_links': False}}
+    model = EmmaaModel(MODEL_NAME, config)
+    model.assembled_stmts = stmts
+    return model
+
+
+class StageTimer(object):
+    """Records the time and peak memory of pipeline stages."""
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.stages = []
+
+    def run(self, name, func, *args, **kwargs):
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            seconds = time.time() - start
+            peak = None
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            self.stages.append((name, seconds, peak))
+
+    def total(self):
+        return sum(seconds for _, seconds, _ in self.stages)
+
+
+def run_pipeline(num_stmts, num_tests, num_agents, mc_types,
+                 trace_memory=True):
+    """Run the pipeline on a synthetic model and return the stage timer."""
+    timer = StageTimer(trace_memory)
+    stmts = timer.run('make_statements', make_statements, num_stmts,
+                      num_agents)
+    tests = timer.run('make_tests_corpus', make_tests, num_tests, num_agents)
+    model = make_model(stmts, mc_types)
+    mm = timer.run('model_manager', ModelManager, model)
+    tm = TestManager([mm], tests)
+    timer.run('make_tests', tm.make_tests, ScopeTestConnector())
+    timer.run('run_tests', tm.run_tests)
+    results_json = timer.run('results_to_json', mm.results_to_json)
+    # Test results are read from JSON as they are after a download from s3
+    results_json = json.loads(json.dumps(results_json))
+    tr = timer.run('test_round', TestRound, results_json)
+    # The round is compared to a second copy of itself as the previous round
+    previous_tr = TestRound(results_json)
+    sg = StatsGenerator(MODEL_NAME, latest_round=tr,
+                        previous_round=previous_tr, previous_changes=[])
+    timer.run('stats', sg.make_stats)
+    timer.run('test_history', update_test_history, None, tr, make_date_str())
+    timer.run('upload_stats', save_stats_to_s3, MODEL_NAME, sg.json_stats,
+              [sg.changes_row])
+    return timer
+
+
+def report(num_stmts, num_tests, timer):
+    print(f'{num_stmts} statements, {num_tests} tests: '
+          f'{timer.total():.2f} s')
+    for name, seconds, peak in timer.stages:
+        memory = f', peak {peak / 1e6:.1f} MB' if peak is not None else ''
+        print(f'    {name}: {seconds:.3f} s{memory}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the test and stats pipeline on synthetic '
+                    'models.')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                        default=[1000, 10000],
+                        help='Numbers of statements in the synthetic models.')
+    parser.add_argument('--tests-per-stmt', type=float, default=0.1,
+                        help='Number of tests per statement in the corpus.')
+    parser.add_argument('--stmts-per-agent', type=float, default=5,
+                        help='Number of statements per agent in the models.')
+    parser.add_argument('--mc-types', nargs='+',
+                        default=['signed_graph', 'unsigned_graph'],
+                        help='Model checkers to run the tests with. PySB '
+                             'assembly is slow for large models.')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Do not trace memory, which slows down the '
+                             'stages.')
+    parser.add_argument('--json', help='Write the results to a JSON file.')
+    parser.add_argument('--max-seconds', type=float,
+                        help='Fail if the pipeline takes longer for any '
+                             'size.')
+    args = parser.parse_args()
+
+    results = []
+    too_slow = []
+    for size in args.sizes:
+        num_tests = max(1, int(size * args.tests_per_stmt))
+        num_agents = max(2, int(size / args.stmts_per_agent))
+        timer = run_pipeline(size, num_tests, num_agents, args.mc_types,
+                             not args.no_memory)
+        report(size, num_tests, timer)
+        results.append({'statements': size, 'tests': num_tests,
+                        'total': timer.total(),
+                        'stages': [{'name': name, 'seconds': seconds,
+                                    'peak_memory': peak}
+                                   for name, seconds, peak in timer.stages]})
+        if args.max_seconds is not None and timer.total() > args.max_seconds:
+            too_slow.append(size)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+    if too_slow:
+        print(f'Pipeline takes longer than {args.max_seconds} s for sizes: '
+              f'{", ".join(str(size) for size in too_slow)}')
+        sys.exit(1)
@@ -0,0 +1,88 @@
+"""Measure how the time to submit a query depends on the size of the database.
+
+The query table is filled with a given number of synthetic queries and then
+the time EmmaaDatabaseManager.put_queries takes to submit new and repeated
+queries is measured. The database is dropped and recreated, so only use a
+database dedicated to testing, e.g.:
+
+$ python scripts/benchmark_put_queries.py -s 100 1000 10000
+
+PostgreSQL databases use INSERT ... ON CONFLICT upserts, other dialects
+use the ORM based fallback.
+"""
+import time
+import argparse
+from emmaa.db import EmmaaDatabaseManager, Query
+from emmaa.queries import Query as QueryObject
+
+
+TEST_DB = 'postgresql://postgres:@localhost/emmaadb_test'
+MODELS = ['aml', 'brca', 'luad', 'paad', 'prad', 'skcm']
+
+
+def make_query(ix):
+    """Return a synthetic path property query with unique agent names."""
+    return QueryObject._from_json(
+        {'type': 'path_property', 'path': {
+            'type': 'Activation',
+            'subj': {'type': 'Agent', 'name': f'SUBJ{ix}'},
+            'obj': {'type': 'Agent', 'name': f'OBJ{ix}'}}})
+
+
+def fill_queries(db, start, end):
+    """Add queries with indices in the given range on all models."""
+    queries = []
+    for ix in range(start, end):
+        query = make_query(ix)
+        query_json = query.to_json()
+        for model in MODELS:
+            queries.append(Query(hash=query.get_hash_with_model(model),
+                                 model_id=model, json=query_json))
+    with db.get_session() as sess:
+        sess.add_all(queries)
+
+
+def time_put_queries(db, queries, user_id=1):
+    """Return the times in seconds to put each of the queries twice."""
+    times = []
+    for query in queries + queries:
+        start = time.time()
+        db.put_queries('tester@test.com', user_id, query, MODELS,
+                       subscribe=True)
+        times.append(time.time() - start)
+    return times
+
+
+def report(size, times):
+    times = sorted(times)
+    mean = sum(times) / len(times)
+    p95 = times[int(0.95 * (len(times) - 1))]
+    print(f'{size * len(MODELS):>9} queries in db: '
+          f'mean {1000 * mean:.2f} ms, p95 {1000 * p95:.2f} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark query submission against database size.')
+    parser.add_argument('--db', default=TEST_DB,
+                        help='Address of a database used for testing.')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                        default=[100, 1000, 10000],
+                        help='Numbers of queries per model to fill the '
+                             'database with.')
+    parser.add_argument('-n', '--num-queries', type=int, default=20,
+                        help='Number of queries to submit at each size.')
+    args = parser.parse_args()
+
+    db = EmmaaDatabaseManager(args.db)
+    db.drop_tables(force=True)
+    db.create_tables()
+    db.add_user(1, 'tester@test.com')
+    filled = 0
+    for size in sorted(args.sizes):
+        fill_queries(db, filled, size)
+        filled = size
+        # Submit queries that are not in the database yet
+        queries = [make_query(-ix - 1 - size)
+                   for ix in range(args.num_queries)]
+        report(size, time_put_queries(db, queries))
@@ -0,0 +1,23 @@
+"""Build the test history index of models from all their test results.
+
+The index is updated after each test round, so this is only needed once for
+models that have test results from before the index existed, e.g.:
+
+$ python scripts/build_test_history.py -m aml brca
+"""
+import argparse
+from emmaa.analyze_tests_results import build_test_history
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build the test history index of models stored on '
+                    'Amazon S3.')
+    parser.add_argument('-m', '--models', nargs='+', required=True,
+                        help='Model names.')
+    args = parser.parse_args()
+
+    for model_name in args.models:
+        history = build_test_history(model_name)
+        num_rounds = len(history['dates']) if history else 0
+        print(f'Indexed {num_rounds} test rounds of {model_name}.')
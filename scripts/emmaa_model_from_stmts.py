@@ -1,11 +1,11 @@
 import json
-import boto3
 import argparse
 import datetime
 from indra.databases import ndex_client
 from indra.assemblers.cx import CxAssembler
 from indra.tools import assemble_corpus as ac
 from emmaa.model import EmmaaModel
+from emmaa.util import get_s3_client
 from emmaa.statements import to_emmaa_stmts
 
 
@@ -45,7 +45,7 @@ def create_upload_model(model_name, full_name, indra_stmts, ndex_id=None):
     emmaa_model.add_statements(emmaa_stmts)
     # Upload model to S3 with config as YAML and JSON
     emmaa_model.save_to_s3()
-    s3_client = boto3.client('s3')
+    s3_client = get_s3_client(unsigned=False)
     config_json = json.dumps(config_dict)
     s3_client.put_object(Body=config_json.encode('utf8'),
                          Key='models/%s/config.json' % model_name,
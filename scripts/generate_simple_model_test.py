@@ -1,11 +1,11 @@
 import pickle
 import datetime
 import json
-import boto3
 from indra.statements import *
 from indra.sources import trips
 from indra.assemblers.cx import CxAssembler
 from emmaa.model import EmmaaModel
+from emmaa.util import get_s3_client
 from emmaa.statements import EmmaaStatement
 from emmaa.model_tests import StatementCheckingTest
 
@@ -44,7 +44,7 @@ if __name__ == '__main__':
     test = generate_test()
     # Upload model to S3 as json
     model.save_to_s3()
-    s3_client = boto3.client('s3')
+    s3_client = get_s3_client(unsigned=False)
     config_json = json.dumps(config, indent=1)
     s3_client.put_object(Body=config_json.encode('utf8'),
                          Key='models/%s/config.json' % model_name,
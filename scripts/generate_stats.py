@@ -0,0 +1,33 @@
+"""Generate test round statistics for several models in one batch.
+
+Inputs are loaded from S3 concurrently, statistics are computed in a pool of
+processes and uploaded as they are ready, e.g.:
+
+$ python scripts/generate_stats.py -m aml brca --processes 4
+$ python scripts/generate_stats.py --all
+"""
+import argparse
+from emmaa.analyze_tests_results import generate_stats_for_models, \
+    STATS_IO_WORKERS, STATS_PROCESSES
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate statistics for several models stored on '
+                    'Amazon S3.')
+    models = parser.add_mutually_exclusive_group(required=True)
+    models.add_argument('-m', '--models', nargs='+', help='Model names.')
+    models.add_argument('--all', action='store_true',
+                        help='Generate statistics for all models.')
+    parser.add_argument('--threads', type=int, default=STATS_IO_WORKERS,
+                        help='Number of threads loading and uploading data.')
+    parser.add_argument('--processes', type=int, default=STATS_PROCESSES,
+                        help='Number of processes computing statistics.')
+    parser.add_argument('--no-upload', action='store_true',
+                        help='Do not upload the statistics to S3.')
+    args = parser.parse_args()
+
+    stats = generate_stats_for_models(
+        None if args.all else args.models, upload=not args.no_upload,
+        io_workers=args.threads, processes=args.processes)
+    print(f'Generated statistics for {len(stats)} models.')
@@ -0,0 +1,38 @@
+"""Migrate the EMMAA database and apply the retention policy for results.
+
+$ python scripts/manage_result_history.py migrate
+$ python scripts/manage_result_history.py compact
+$ python scripts/manage_result_history.py archive --days 90
+"""
+import argparse
+from emmaa.db import get_db
+from emmaa.db.migrations import migrate, archive_results, compact_results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Manage the schema and the history of query results in '
+                    'the EMMAA database.')
+    parser.add_argument('--db', default='primary',
+                        help='Name of the database in the config.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    subparsers.add_parser('migrate', help='Apply schema migrations.')
+    archive_parser = subparsers.add_parser(
+        'archive', help='Move old results to the archive table.')
+    archive_parser.add_argument('--days', type=int, default=90,
+                                help='Age in days of results to archive.')
+    compact_parser = subparsers.add_parser(
+        'compact', help='Remove results that did not change.')
+    compact_parser.add_argument('--delete', action='store_true',
+                                help='Delete removed results instead of '
+                                     'archiving them.')
+    args = parser.parse_args()
+
+    db = get_db(args.db)
+    if args.command == 'migrate':
+        migrate(db)
+    elif args.command == 'archive':
+        archive_results(db, args.days)
+    elif args.command == 'compact':
+        compact_results(db, archive=not args.delete)
@@ -7,7 +7,11 @@ if __name__ == '__main__':
             description='Script to run tests against models, both stored on '
                         'Amazon S3.')
     parser.add_argument('-m', '--model', help='Model name', required=True)
+    parser.add_argument('--only-changed-queries', action='store_true',
+                        help='Only save results of registered queries that '
+                             'changed.')
     args = parser.parse_args()
 
     run_model_tests_from_s3(
-        args.model, upload_results=True, upload_stats=True)
+        args.model, upload_results=True, upload_stats=True,
+        only_changed_queries=args.only_changed_queries)